@@ -0,0 +1,69 @@
+"""Microbenchmark for callback query handling latency.
+
+Runs button_handler against stub updates so only the bot's own work is
+measured (routing, menu lookup, admin check), not network time.
+
+    python benchmarks/callback_latency.py [iterations]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+CHAT_ID = -100123
+
+
+async def noop(*args, **kwargs):
+    return None
+
+
+async def get_chat_member(chat_id, user_id):
+    return SimpleNamespace(status="administrator")
+
+
+def make_update(data):
+    query = SimpleNamespace(
+        data=data,
+        answer=noop,
+        edit_message_text=noop,
+        message=SimpleNamespace(chat=SimpleNamespace(id=CHAT_ID)),
+    )
+    return SimpleNamespace(
+        callback_query=query,
+        message=None,
+        effective_user=SimpleNamespace(id=1),
+        effective_chat=SimpleNamespace(id=CHAT_ID),
+    )
+
+
+async def bench(data, iterations, context):
+    update = make_update(data)
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await main.button_handler(update, context)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return (
+        statistics.median(samples) * 1e6,
+        samples[int(len(samples) * 0.99) - 1] * 1e6,
+    )
+
+
+async def run(iterations):
+    # Toggles persist settings into main.state, an in-memory backend unless the bot was started
+    context = SimpleNamespace(bot=SimpleNamespace(get_chat_member=get_chat_member, username="bench_bot"))
+    print(f"{'callback_data':<20} {'median us':>10} {'p99 us':>10}")
+    for data in ("help", "help_admin", "features", "toggle_antiflood", "unknown"):
+        median, p99 = await bench(data, iterations, context)
+        print(f"{data:<20} {median:>10.1f} {p99:>10.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,136 @@
+"""Local stand-in for api.telegram.org.
+
+Serves the Bot API methods the bot uses from FakeTelegramAPI over HTTP,
+with simulated latency and 429 rate limits, so the real polling or
+webhook stack can be load tested. Point the bot at it with
+
+    BOT_API_BASE_URL=http://127.0.0.1:8081 BOT_TOKEN=1:fake python main.py
+
+Control endpoints used by loadgen.py:
+    POST /_control/updates   JSON list of Update dicts to queue for getUpdates
+    GET  /_control/stats     call, error and queue counters as JSON
+
+    python benchmarks/fake_api_server.py --port 8081 --latency 30 --jitter 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from urllib.parse import parse_qsl
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakebot import FakeTelegramAPI, RateLimiter  # noqa: E402
+
+
+def decode_value(value):
+    """Form values are JSON encoded unless they are plain strings"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_body(content_type, body):
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return {k: decode_value(v) for k, v in parse_qsl(body.decode(), keep_blank_values=True)}
+    # multipart uploads: the fake only needs to acknowledge them
+    return {}
+
+
+class FakeAPIServer:
+    """Minimal HTTP/1.1 keep-alive server in front of a FakeTelegramAPI"""
+
+    def __init__(self, api):
+        self.api = api
+        self.connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self.route(method, path.split("?", 1)[0], headers, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def route(self, method, path, headers, body):
+        if path == "/_control/updates" and method == "POST":
+            updates = json.loads(body)
+            for update in updates:
+                self.api.updates.put_nowait(update)
+            return 200, {"ok": True, "queued": len(updates)}
+        if path == "/_control/stats":
+            return 200, {
+                "calls": self.api.calls,
+                "errors": self.api.errors,
+                "queued_updates": self.api.updates.qsize(),
+                "connections": self.connections,
+            }
+        parts = path.strip("/").split("/")
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        params = parse_body(headers.get("content-type", ""), body)
+        return await self.api.call(parts[1], params)
+
+
+async def serve(args):
+    limiter = None if args.no_rate_limit else RateLimiter(args.chat_rate, args.chat_burst, args.global_rate)
+    api = FakeTelegramAPI(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+        limiter=limiter,
+        admin_ids=args.admin,
+    )
+    server = await asyncio.start_server(FakeAPIServer(api).handle, args.host, args.port)
+    print(f"Fake Bot API listening on http://{args.host}:{args.port}")
+    async with server:
+        await server.serve_forever()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="base latency per call in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls failing with 400")
+    parser.add_argument("--chat-rate", type=float, default=1.0, help="sends per second allowed per chat")
+    parser.add_argument("--chat-burst", type=int, default=3, help="burst size per chat")
+    parser.add_argument("--global-rate", type=float, default=30.0, help="sends per second allowed overall")
+    parser.add_argument("--no-rate-limit", action="store_true", help="never answer with 429")
+    parser.add_argument("--admin", type=int, action="append", default=[1], help="user ids reported as admins")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve(parse_args()))
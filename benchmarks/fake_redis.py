@@ -0,0 +1,225 @@
+"""Minimal in-memory Redis (RESP2) server for exercising RedisBackend.
+
+Implements the commands the bot's state driver sends: PING, SELECT, GET,
+SET (EX/NX), MGET, MSET, DEL, INCRBY, HINCRBY, HSET, HDEL, HGET, HGETALL, SCAN and
+MULTI/EXEC. Point the bot at it with
+
+    STATE_URL=redis://127.0.0.1:6380/0 python main.py
+
+    python benchmarks/fake_redis.py --port 6380
+"""
+import argparse
+import asyncio
+import fnmatch
+import time
+
+
+class CommandError(Exception):
+    pass
+
+
+class Status(str):
+    """Simple-string reply such as +OK, as opposed to a bulk string value"""
+
+
+OK = Status("OK")
+
+
+class FakeRedis:
+    """Keyspace shared by all connections; values are str or dict (hashes)"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def lookup(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            del self.expires[key]
+            self.data.pop(key, None)
+        return self.data.get(key)
+
+    def hash(self, key):
+        value = self.lookup(key)
+        if value is None:
+            value = self.data[key] = {}
+        if not isinstance(value, dict):
+            raise CommandError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def integer(self, value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise CommandError("ERR value is not an integer or out of range")
+
+    def execute(self, name, args):
+        handler = getattr(self, f"cmd_{name.lower()}", None)
+        if handler is None:
+            raise CommandError(f"ERR unknown command '{name}'")
+        return handler(*args)
+
+    def cmd_ping(self, *args):
+        return args[0] if args else Status("PONG")
+
+    def cmd_select(self, db):
+        return OK
+
+    def cmd_get(self, key):
+        value = self.lookup(key)
+        if isinstance(value, dict):
+            raise CommandError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def cmd_mget(self, *keys):
+        return [v if isinstance(v, str) else None for v in map(self.lookup, keys)]
+
+    def cmd_set(self, key, value, *options):
+        options = [o.upper() for o in options]
+        if "NX" in options and self.lookup(key) is not None:
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if "EX" in options:
+            self.expires[key] = time.monotonic() + self.integer(options[options.index("EX") + 1])
+        return OK
+
+    def cmd_mset(self, *pairs):
+        for key, value in zip(pairs[::2], pairs[1::2]):
+            self.cmd_set(key, value)
+        return OK
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self.lookup(key) is not None:
+                removed += 1
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return removed
+
+    def cmd_incrby(self, key, amount):
+        value = self.integer(self.lookup(key) or 0) + self.integer(amount)
+        self.data[key] = str(value)
+        return value
+
+    def cmd_hincrby(self, key, field, amount):
+        fields = self.hash(key)
+        value = self.integer(fields.get(field, 0)) + self.integer(amount)
+        fields[field] = str(value)
+        return value
+
+    def cmd_hset(self, key, *pairs):
+        fields = self.hash(key)
+        added = sum(1 for field in pairs[::2] if field not in fields)
+        fields.update(zip(pairs[::2], pairs[1::2]))
+        return added
+
+    def cmd_hdel(self, key, *fields):
+        value = self.lookup(key) or {}
+        removed = sum(1 for field in fields if value.pop(field, None) is not None)
+        if not value:
+            self.data.pop(key, None)
+        return removed
+
+    def cmd_hget(self, key, field):
+        value = self.lookup(key) or {}
+        return value.get(field)
+
+    def cmd_hgetall(self, key):
+        value = self.lookup(key) or {}
+        return [x for item in value.items() for x in item]
+
+    def cmd_scan(self, cursor, *options):
+        options = list(options)
+        pattern = options[options.index("MATCH") + 1] if "MATCH" in options else "*"
+        keys = [k for k in list(self.data) if fnmatch.fnmatchcase(k, pattern) and self.lookup(k) is not None]
+        return ["0", keys]
+
+
+def encode(reply):
+    if isinstance(reply, CommandError):
+        return f"-{reply}\r\n".encode()
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, int):
+        return f":{reply}\r\n".encode()
+    if isinstance(reply, list):
+        return f"*{len(reply)}\r\n".encode() + b"".join(encode(r) for r in reply)
+    if isinstance(reply, Status):
+        return f"+{reply}\r\n".encode()
+    data = reply.encode()
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        return line.decode().split()
+    args = []
+    for _ in range(int(line[1:])):
+        size = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(size + 2))[:-2].decode())
+    return args
+
+
+class FakeRedisServer:
+    def __init__(self, store=None):
+        self.store = store or FakeRedis()
+
+    async def handle(self, reader, writer):
+        queued = None
+        try:
+            while True:
+                command = await read_command(reader)
+                if command is None:
+                    break
+                name, args = command[0].upper(), command[1:]
+                if name == "MULTI":
+                    queued, reply = [], OK
+                elif name == "EXEC":
+                    reply = []
+                    for queued_name, queued_args in queued or []:
+                        try:
+                            reply.append(self.store.execute(queued_name, queued_args))
+                        except CommandError as e:
+                            reply.append(e)
+                    queued = None
+                elif queued is not None:
+                    queued.append((name, args))
+                    reply = Status("QUEUED")
+                else:
+                    try:
+                        reply = self.store.execute(name, args)
+                    except CommandError as e:
+                        reply = e
+                writer.write(encode(reply))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def start_server(host="127.0.0.1", port=6380):
+    return await asyncio.start_server(FakeRedisServer().handle, host, port)
+
+
+async def serve(args):
+    server = await start_server(args.host, args.port)
+    print(f"Fake Redis listening on {args.host}:{args.port}")
+    async with server:
+        await server.serve_forever()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6380)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve(parse_args()))
@@ -0,0 +1,181 @@
+"""In-process fake of the Telegram Bot API.
+
+FakeTelegramAPI answers Bot API methods with plausible results, records
+every call and can inject latency, errors and 429 rate limits.
+FakeRequest plugs it into python-telegram-bot as a request backend, so
+the real Bot and Application run unchanged without touching the network.
+"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from telegram.request import BaseRequest
+
+BOT_ID = 777000
+BOT_USER = {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+# Methods answered with a sent Message object
+MESSAGE_METHODS = {
+    "sendMessage", "sendPoll", "sendDice", "sendPhoto", "sendDocument", "sendSticker",
+    "sendVoice", "sendVideo", "sendAnimation", "sendAudio", "editMessageText",
+}
+
+
+def user(user_id, first_name=None):
+    return {"id": user_id, "is_bot": False, "first_name": first_name or f"User{user_id}"}
+
+
+class RateLimiter:
+    """Token buckets approximating Telegram's per-chat and global send limits"""
+
+    def __init__(self, chat_rate=1.0, chat_burst=3, global_rate=30.0):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_rate = global_rate
+        self.buckets = {}
+
+    def take(self, key, rate, burst):
+        tokens, last = self.buckets.get(key, (burst, time.monotonic()))
+        now = time.monotonic()
+        tokens = min(burst, tokens + (now - last) * rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+        self.buckets[key] = (tokens - 1, now)
+        return 0.0
+
+    def check(self, chat_id):
+        """Return 0 if a send is allowed, otherwise seconds to wait"""
+        wait = self.take("global", self.global_rate, self.global_rate)
+        if not wait and chat_id is not None:
+            wait = self.take(chat_id, self.chat_rate, self.chat_burst)
+        return wait
+
+
+class FakeTelegramAPI:
+    """Answers Bot API calls from memory"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit_rate=0.0, admin_ids=(), seed=0,
+                 limiter=None, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.limiter = limiter
+        self.admin_ids = set(admin_ids)
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.updates = asyncio.Queue()
+        self.next_message_id = 1_000_000
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.errors.clear()
+
+    def error(self, code, description, **parameters):
+        payload = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            payload["parameters"] = parameters
+        return code, payload
+
+    async def call(self, method, params):
+        """Handle one Bot API call; returns (HTTP status, JSON payload)"""
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self.get_updates(params)}
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.random() * self.jitter)
+        if self.limiter and method in MESSAGE_METHODS:
+            wait = self.limiter.check(params.get("chat_id"))
+            if wait:
+                retry_after = max(1, round(wait))
+                self.errors[method] += 1
+                return self.error(429, f"Too Many Requests: retry after {retry_after}", retry_after=retry_after)
+        if self.rate_limit_rate and self.random.random() < self.rate_limit_rate:
+            self.errors[method] += 1
+            return self.error(429, "Too Many Requests: retry after 1", retry_after=1)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors[method] += 1
+            return self.error(400, "Bad Request: injected error")
+        return 200, {"ok": True, "result": self.result(method, params)}
+
+    async def get_updates(self, params):
+        """Return queued updates, long-polling up to the requested timeout"""
+        limit = int(params.get("limit", 100))
+        result = []
+        try:
+            result.append(await asyncio.wait_for(self.updates.get(), float(params.get("timeout", 0)) or 0.01))
+        except asyncio.TimeoutError:
+            return result
+        while len(result) < limit and not self.updates.empty():
+            result.append(self.updates.get_nowait())
+        return result
+
+    def message(self, params):
+        self.next_message_id += 1
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": int(params.get("message_id", self.next_message_id)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    def result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method in MESSAGE_METHODS:
+            return self.message(params)
+        if method == "getChatMember":
+            user_id = int(params["user_id"])
+            status = "administrator" if user_id in self.admin_ids else "member"
+            member = {"status": status, "user": user(user_id)}
+            if status == "administrator":
+                member.update({
+                    "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True,
+                    "can_delete_messages": True, "can_manage_video_chats": True,
+                    "can_restrict_members": True, "can_promote_members": False,
+                    "can_change_info": True, "can_invite_users": True,
+                    "can_post_stories": False, "can_edit_stories": False, "can_delete_stories": False,
+                })
+            return member
+        if method == "getChatAdministrators":
+            return [{"status": "creator", "user": user(uid), "is_anonymous": False} for uid in sorted(self.admin_ids)]
+        if method == "getChatMemberCount":
+            return 1000
+        if method == "getChat":
+            chat_id = int(params["chat_id"])
+            return {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}", "accent_color_id": 0,
+                    "max_reaction_count": 11, "accepted_gift_types": {"unlimited_gifts": False,
+                    "limited_gifts": False, "unique_gifts": False, "premium_subscription": False}}
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": self.updates.qsize()}
+        return True
+
+
+class FakeRequest(BaseRequest):
+    """Request backend answering every call from a FakeTelegramAPI"""
+
+    def __init__(self, api):
+        self.api = api
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        status, payload = await self.api.call(endpoint, params)
+        return status, json.dumps(payload).encode()
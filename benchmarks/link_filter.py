@@ -0,0 +1,57 @@
+"""Cost of link moderation per message as the rule list grows.
+
+Times main.link_violation on messages with URL, text-link and mention
+entities against per-chat rule sets of increasing size. With the domain
+trie the time per message should stay flat.
+
+    python benchmarks/link_filter.py [iterations]
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from telegram import Chat, Message, MessageEntity, User  # noqa: E402
+
+# The invite link is last so every entity is examined before the violation is found
+TEXT = "docs at https://docs.example.com/a, ask @helpdesk, read this or join t.me/+AbCdEf"
+
+
+def make_message():
+    def span(part):
+        return TEXT.index(part), len(part)
+
+    entities = [
+        MessageEntity(MessageEntity.URL, *span("https://docs.example.com/a")),
+        MessageEntity(MessageEntity.MENTION, *span("@helpdesk")),
+        MessageEntity(MessageEntity.TEXT_LINK, *span("this"), url="https://blog.site9999.net/post"),
+        MessageEntity(MessageEntity.URL, *span("t.me/+AbCdEf")),
+    ]
+    return Message(1, datetime.now(), Chat(-1, "supergroup"), from_user=User(5, "a", False),
+                   text=TEXT, entities=entities)
+
+
+def main_bench(iterations):
+    message = make_message()
+    print(f"{'rules':>7} {'us/message':>11}")
+    for size in (10, 100, 1000, 10000):
+        chat_id = f"-{size}"
+        main.settings[chat_id]["link_protection"] = True
+        main.link_rules[chat_id] = {
+            "allow": [f"*.site{i}.net" for i in range(size)] + ["*.example.com"],
+            "deny": [f"@spam{i}" for i in range(size)],
+        }
+        main.get_link_rules(chat_id)
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            main.link_violation(chat_id, message)
+        elapsed = time.perf_counter() - start
+        print(f"{size:>7} {elapsed / iterations * 1e6:>11.1f}")
+
+
+if __name__ == "__main__":
+    main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,97 @@
+"""Load generator for end-to-end tests against fake_api_server.py.
+
+Drives many virtual chats at a target message rate, either by queueing
+updates on the fake API for the bot to fetch with getUpdates (polling)
+or by POSTing them straight to the bot's webhook.
+
+    python benchmarks/loadgen.py --chats 5000 --rate 500 --duration 60
+    python benchmarks/loadgen.py --mode webhook --webhook-url http://127.0.0.1:8443/bot
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from scenarios import UpdateFactory, sentence  # noqa: E402
+
+TICK = 0.05
+
+
+async def send_polling(client, args, batch):
+    await client.post(f"{args.api}/_control/updates", content=json.dumps(batch))
+
+
+async def send_webhook(client, args, batch):
+    await asyncio.gather(*(
+        client.post(args.webhook_url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": args.secret})
+        if args.secret else client.post(args.webhook_url, json=update)
+        for update in batch
+    ), return_exceptions=True)
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    factory = UpdateFactory()
+    send = send_webhook if args.mode == "webhook" else send_polling
+    chats = [-1_000_000_000_000 - i for i in range(args.chats)]
+
+    sent = 0
+    owed = 0.0
+    start = time.monotonic()
+    async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=args.connections)) as client:
+        while time.monotonic() - start < args.duration:
+            tick_start = time.monotonic()
+            owed += args.rate * TICK
+            batch = []
+            while owed >= 1:
+                owed -= 1
+                batch.append(factory.message(rng.choice(chats), 100 + rng.randrange(args.users), sentence(rng)))
+            if batch:
+                await send(client, args, batch)
+                sent += len(batch)
+            await asyncio.sleep(max(0.0, TICK - (time.monotonic() - tick_start)))
+            if int(time.monotonic() - start) != int(tick_start - start):
+                print(f"{time.monotonic() - start:5.0f}s  sent {sent}  ({sent / (time.monotonic() - start):.0f}/s)")
+
+        elapsed = time.monotonic() - start
+        print(f"\nSent {sent} updates in {elapsed:.1f}s ({sent / elapsed:.0f}/s) across {args.chats} chats")
+
+        if args.mode == "polling":
+            # Wait for the bot to drain the queue, then show what it did
+            drain_start = time.monotonic()
+            while True:
+                stats = (await client.get(f"{args.api}/_control/stats")).json()
+                if not stats["queued_updates"] or time.monotonic() - drain_start > args.drain_timeout:
+                    break
+                await asyncio.sleep(0.5)
+            print(f"Backlog drained in {time.monotonic() - drain_start:.1f}s "
+                  f"({stats['queued_updates']} still queued)")
+            print(f"API calls: {stats['calls']}")
+            print(f"API errors: {stats['errors']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--api", default="http://127.0.0.1:8081", help="fake API base URL")
+    parser.add_argument("--webhook-url", default="http://127.0.0.1:8443/bot")
+    parser.add_argument("--secret", help="webhook secret token")
+    parser.add_argument("--chats", type=int, default=1000, help="number of virtual chats")
+    parser.add_argument("--users", type=int, default=10000, help="number of virtual users")
+    parser.add_argument("--rate", type=float, default=100.0, help="target messages per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to generate load")
+    parser.add_argument("--connections", type=int, default=64, help="HTTP connections for webhook mode")
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,51 @@
+"""Benchmark of the per-call cost of handler and API instrumentation.
+
+Compares a bare async handler with the same handler wrapped by
+instrument_handler, and times Histogram.observe on its own.
+
+    python benchmarks/metrics_overhead.py [iterations]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+async def handler(update, context):
+    return None
+
+
+async def time_calls(callback, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await callback(None, None)
+    return (time.perf_counter() - start) / iterations
+
+
+async def run(iterations):
+    instrumented = main.instrument_handler(handler)
+    # Warm up both paths before measuring
+    await time_calls(handler, 1000)
+    await time_calls(instrumented, 1000)
+
+    bare = min([await time_calls(handler, iterations) for _ in range(5)])
+    wrapped = min([await time_calls(instrumented, iterations) for _ in range(5)])
+
+    hist = main.Histogram()
+    start = time.perf_counter()
+    for i in range(iterations):
+        hist.observe(i * 1e-6)
+    observe = (time.perf_counter() - start) / iterations
+
+    print(f"bare handler call:         {bare * 1e9:8.0f} ns")
+    print(f"instrumented handler call: {wrapped * 1e9:8.0f} ns")
+    print(f"overhead per call:         {(wrapped - bare) * 1e9:8.0f} ns")
+    print(f"Histogram.observe:         {observe * 1e9:8.0f} ns")
+
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 200000))
@@ -0,0 +1,105 @@
+"""Benchmark of outbound Bot API throughput for different HTTP pool setups.
+
+Starts fake_api_server in a subprocess with simulated latency, keeps a
+getUpdates long poll running, and fires a burst of concurrent
+deleteMessage/banChatMember calls, as during a raid cleanup. Compares a
+small pool shared with getUpdates against the tuned configuration from
+main.build_application (larger outbound pool, dedicated polling connection).
+
+    python benchmarks/pool_throughput.py [--calls 1000] [--latency 50]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import main  # noqa: E402
+from telegram import Bot  # noqa: E402
+
+
+async def poll_forever(bot):
+    while True:
+        try:
+            await bot.get_updates(timeout=10)
+        except Exception:
+            await asyncio.sleep(0.1)
+
+
+async def burst(bot, calls, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = []
+
+    async def one(i):
+        async with semaphore:
+            try:
+                if i % 2:
+                    await bot.delete_message(-100, i)
+                else:
+                    await bot.ban_chat_member(-100, 10_000 + i)
+            except Exception as e:
+                failures.append(type(e).__name__)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    return time.perf_counter() - start, failures
+
+
+async def run_config(name, base_url, request, get_updates_request, args):
+    bot = Bot("1:bench", base_url=f"{base_url}/bot", request=request, get_updates_request=get_updates_request)
+    await bot.initialize()
+    poller = asyncio.create_task(poll_forever(bot))
+    await asyncio.sleep(0.2)
+    elapsed, failures = await burst(bot, args.calls, args.concurrency)
+    poller.cancel()
+    await asyncio.gather(poller, return_exceptions=True)
+    await bot.shutdown()
+
+    print(f"{name:<34} {args.calls / elapsed:>8.0f} calls/s {elapsed:>7.2f}s  failures: {len(failures)}", end="")
+    if isinstance(request, main.InstrumentedRequest):
+        print(f"  (max in flight {request.max_in_flight}, pool timeouts {request.pool_timeouts})")
+    else:
+        print()
+
+
+async def run(args):
+    # The fake API runs in its own process so it doesn't compete with the client for CPU
+    server = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "fake_api_server.py"),
+        "--port", str(args.port), "--latency", str(args.latency), "--no-rate-limit",
+    ], stdout=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{args.port}"
+    await asyncio.sleep(1.0)
+    print(f"{args.calls} calls, concurrency {args.concurrency}, API latency {args.latency:g}ms\n")
+
+    try:
+        shared = main.HTTPXRequest(connection_pool_size=args.small_pool, pool_timeout=5.0)
+        await run_config(f"shared pool of {args.small_pool}", base_url, shared, shared, args)
+
+        tuned = main.InstrumentedRequest(
+            pool="api", connection_pool_size=main.HTTP_POOL_SIZE, pool_timeout=main.HTTP_POOL_TIMEOUT,
+            read_timeout=main.HTTP_READ_TIMEOUT, connect_timeout=main.HTTP_CONNECT_TIMEOUT
+        )
+        polling = main.InstrumentedRequest(pool="get_updates", connection_pool_size=1)
+        await run_config(f"tuned pool of {main.HTTP_POOL_SIZE} + polling conn", base_url, tuned, polling, args)
+    finally:
+        server.terminate()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=50.0, help="fake API latency in ms")
+    parser.add_argument("--port", type=int, default=18081, help="port for the fake API server")
+    parser.add_argument("--small-pool", type=int, default=8, help="size of the untuned shared pool")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,182 @@
+"""Offline update-replay benchmark.
+
+Builds the same Application and handlers as main() against an in-process
+fake Bot API, replays synthetic or recorded update streams and reports
+throughput, per-handler latency percentiles and API calls per update.
+
+    python benchmarks/replay.py                      # all scenarios
+    python benchmarks/replay.py raid flood -n 5000
+    python benchmarks/replay.py --updates recorded.jsonl
+    python benchmarks/replay.py --latency 20 --error-rate 0.01
+    python benchmarks/replay.py --save-baseline      # store results as baseline
+    python benchmarks/replay.py --check              # exit 1 on regression
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from functools import wraps
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import main  # noqa: E402
+from fakebot import FakeRequest, FakeTelegramAPI  # noqa: E402
+from scenarios import ADMIN_ID, CHECKS, SCENARIOS  # noqa: E402
+from telegram import Update  # noqa: E402
+
+BASELINE_FILE = os.path.join(BENCH_DIR, "baselines.json")
+# Relative throughput drop reported as a regression
+REGRESSION_TOLERANCE = 0.15
+
+
+def reset_state():
+    """Clear bot state between scenarios"""
+    for name in ("word_filters", "settings", "notes", "welcome_messages", "user_blacklist", "doc_raw",
+                 "note_indexes", "settings_menus", "compiled_welcomes", "pending_welcomes", "last_welcome",
+                 "seen_updates", "seen_update_ids", "stale_deletions", "stale_bans", "spam_windows", "chat_activity",
+                 "known_usernames", "recent_joins", "member_indexes"):
+        getattr(main, name).clear()
+    main.state = main.MemoryBackend()
+
+
+def sample_handlers(application, samples):
+    """Wrap every handler to record exact per-call latencies"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            callback = handler.callback
+            name = callback.__name__
+
+            def wrap(callback, name):
+                @wraps(callback)
+                async def timed(update, context):
+                    start = time.perf_counter()
+                    try:
+                        return await callback(update, context)
+                    finally:
+                        samples[name].append(time.perf_counter() - start)
+                return timed
+
+            handler.callback = wrap(callback, name)
+
+
+def pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def replay(name, setup, raw_updates, args):
+    reset_state()
+    setup(main)
+    api = FakeTelegramAPI(latency=args.latency / 1000, error_rate=args.error_rate, admin_ids={ADMIN_ID})
+    application = main.build_application("1:bench", request=FakeRequest(api), get_updates_request=FakeRequest(api))
+    samples = defaultdict(list)
+    sample_handlers(application, samples)
+
+    await application.initialize()
+    await application.start()
+    updates = [Update.de_json(u, application.bot) for u in raw_updates]
+    api.reset_counters()
+
+    start = time.perf_counter()
+    for update in updates:
+        await application.process_update(update)
+    elapsed = time.perf_counter() - start
+    # Debounced welcomes and other follow-up tasks are awaited by stop(); their
+    # API calls count towards this run but their waiting time does not
+    await application.stop()
+    await application.shutdown()
+    if name in CHECKS:
+        CHECKS[name](main)
+
+    api_calls = sum(api.calls.values())
+    result = {
+        "updates": len(updates),
+        "updates_per_sec": len(updates) / elapsed if elapsed else 0.0,
+        "api_calls_per_update": api_calls / len(updates) if updates else 0.0,
+        "api_errors": sum(api.errors.values()),
+    }
+
+    print(f"\n=== {name}: {len(updates)} updates in {elapsed:.2f}s ===")
+    print(f"throughput:        {result['updates_per_sec']:.0f} updates/s")
+    print(f"API calls/update:  {result['api_calls_per_update']:.2f} ({dict(api.calls.most_common(5))})")
+    print(f"{'handler':<24} {'calls':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for handler, values in sorted(samples.items(), key=lambda x: -sum(x[1])):
+        print(f"{handler:<24} {len(values):>7} {pct(values, 0.5) * 1000:>8.3f} "
+              f"{pct(values, 0.95) * 1000:>8.3f} {pct(values, 0.99) * 1000:>8.3f}")
+    return result
+
+
+def compare(results, baselines):
+    """Print changes against stored baselines; returns True if anything regressed"""
+    regressed = False
+    print("\n=== baseline comparison ===")
+    for name, result in results.items():
+        base = baselines.get(name)
+        if not base:
+            print(f"{name:<10} no baseline")
+            continue
+        change = result["updates_per_sec"] / base["updates_per_sec"] - 1 if base["updates_per_sec"] else 0.0
+        calls_change = result["api_calls_per_update"] - base["api_calls_per_update"]
+        flag = ""
+        if change < -REGRESSION_TOLERANCE or calls_change > 0.01:
+            flag = "  <-- REGRESSION"
+            regressed = True
+        print(f"{name:<10} throughput {change:+.1%}, API calls/update {calls_change:+.2f}{flag}")
+    return regressed
+
+
+def load_recorded(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    if args.updates:
+        streams = {os.path.basename(args.updates): ((lambda main: None), load_recorded(args.updates))}
+    else:
+        names = args.scenarios or list(SCENARIOS)
+        streams = {name: SCENARIOS[name](args.count, rng) for name in names}
+
+    results = {}
+    for name, (setup, updates) in streams.items():
+        results[name] = await replay(name, setup, updates, args)
+
+    baselines = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baselines = json.load(f)
+    regressed = compare(results, baselines)
+
+    if args.save_baseline:
+        baselines.update(results)
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"\nBaselines saved to {BASELINE_FILE}")
+    return 1 if args.check and regressed else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", choices=[[]] + list(SCENARIOS), help="scenarios to run")
+    parser.add_argument("-n", "--count", type=int, default=2000, help="updates per scenario")
+    parser.add_argument("--updates", help="replay a recorded JSONL file of Update dicts instead")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake API latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of API calls that fail")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="exit with status 1 on regression")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    # Relative paths the bot may write to (audit log, migrated legacy files) resolve to a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix="bot-bench-"))
+    sys.exit(asyncio.run(run(arguments)))
@@ -0,0 +1,150 @@
+"""Synthetic update streams for the replay benchmark.
+
+Each scenario is a function taking (count, rng) and returning
+(setup, updates): setup(main) prepares bot state, updates is a list of
+Bot API Update dicts. CHECKS maps a scenario to a function asserting on
+the bot state its replay left behind.
+"""
+import time
+
+ADMIN_ID = 1
+WORDS = (
+    "hello there how is everyone doing today the weather is nice lets meet "
+    "later for coffee did you see the match yesterday great game"
+).split()
+
+
+class UpdateFactory:
+    """Builds Update dicts with increasing update and message ids"""
+
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 0
+
+    def message(self, chat_id, user_id, text=None, **extra):
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        message.update(extra)
+        return {"update_id": self.update_id, "message": message}
+
+
+def sentence(rng, words=WORDS, length=8):
+    return " ".join(rng.choice(words) for _ in range(length))
+
+
+def normal_chat(count, rng):
+    factory = UpdateFactory()
+    updates = [
+        factory.message(-1000 - rng.randrange(50), 100 + rng.randrange(500), sentence(rng))
+        for _ in range(count)
+    ]
+    return (lambda main: None), updates
+
+
+def raid_joins(count, rng):
+    factory = UpdateFactory()
+    chat_id = -2000
+    updates = []
+    for i in range(count):
+        members = [
+            {"id": 10_000 + i * 5 + j, "is_bot": False, "first_name": f"Raider{i * 5 + j}"}
+            for j in range(5)
+        ]
+        updates.append(factory.message(chat_id, members[0]["id"], new_chat_members=members))
+    return (lambda main: None), updates
+
+
+def flood_burst(count, rng):
+    factory = UpdateFactory()
+    chat_id = -3000
+
+    def setup(main):
+        main.settings[str(chat_id)]["antiflood"] = True
+
+    updates = [factory.message(chat_id, 200 + rng.randrange(5), sentence(rng, length=3)) for _ in range(count)]
+    return setup, updates
+
+
+def filter_heavy(count, rng):
+    factory = UpdateFactory()
+    chat_id = -4000
+    banned = [f"spamword{i}" for i in range(300)]
+
+    def setup(main):
+        main.word_filters[str(chat_id)] = list(banned)
+
+    updates = []
+    for i in range(count):
+        text = sentence(rng)
+        if i % 10 == 0:
+            text += " " + rng.choice(banned)
+        updates.append(factory.message(chat_id, 300 + rng.randrange(200), text))
+    return setup, updates
+
+
+def admin_storm(count, rng):
+    factory = UpdateFactory()
+    chat_id = -5000
+    commands = ["/settings", "/filters", "/notes", "/rules", "/stats", "/addfilter spam", "/save tip hello"]
+    # A GIF comes with both an animation and a document; it must be saved as an animation
+    gif = factory.message(
+        chat_id, ADMIN_ID,
+        animation={"file_id": "gif-file", "file_unique_id": "gif-unique", "width": 320, "height": 240, "duration": 3},
+        document={"file_id": "gif-file", "file_unique_id": "gif-unique", "mime_type": "video/mp4"},
+    )["message"]
+    updates = [factory.message(chat_id, ADMIN_ID, "/save gif", reply_to_message=gif)]
+    for _ in range(count - 1):
+        command = rng.choice(commands + ["/warn"])
+        if command == "/warn":
+            target = factory.message(chat_id, 400 + rng.randrange(20), "hi")["message"]
+            updates.append(factory.message(chat_id, ADMIN_ID, command, reply_to_message=target))
+        else:
+            updates.append(factory.message(chat_id, ADMIN_ID, command))
+    return (lambda main: None), updates
+
+
+def spam_wave(count, rng):
+    factory = UpdateFactory()
+    chat_id = -6000
+    spam = "free crypto giveaway join t.me/+{} now and claim 500 usdt before it ends"
+
+    def setup(main):
+        main.settings[str(chat_id)]["antiraid"] = True
+
+    updates = []
+    for i in range(count):
+        # Every tenth message is a copy of the same spam from a fresh account
+        if i % 10 == 0:
+            updates.append(factory.message(chat_id, 50_000 + i, spam.format(rng.randrange(10**6))))
+        else:
+            updates.append(factory.message(chat_id, 600 + rng.randrange(300), sentence(rng)))
+    return setup, updates
+
+
+def gif_saved_as_animation(main):
+    note = main.notes[str(-5000)].get("gif")
+    assert isinstance(note, dict) and note["type"] == "animation", f"GIF note saved as {note!r}"
+
+
+SCENARIOS = {
+    "normal": normal_chat,
+    "raid": raid_joins,
+    "flood": flood_burst,
+    "filters": filter_heavy,
+    "admin": admin_storm,
+    "spam": spam_wave,
+}
+
+CHECKS = {
+    "admin": gif_saved_as_animation,
+}
@@ -0,0 +1,101 @@
+"""Throughput of the sharded mode for increasing worker counts.
+
+Starts N worker processes running main.run_shard against an in-process
+fake Bot API each, feeds the "normal" replay scenario spread over many
+chats through the same per-worker IPC queues the dispatcher uses (routed
+by main.shard_for), and reports end-to-end updates/s and the speedup over
+a single worker. Scaling is bounded by the number of CPU cores.
+
+    python benchmarks/shard_scaling.py                    # 1, 2, 4 workers
+    python benchmarks/shard_scaling.py -w 1 2 4 8 -n 20000 --chats 256
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+# Workers inherit the environment; keep their start/stop logging out of the report
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import main  # noqa: E402
+from fakebot import FakeRequest, FakeTelegramAPI  # noqa: E402
+from scenarios import ADMIN_ID, normal_chat  # noqa: E402
+
+
+def worker(index, count, inbox, stats, ready, done, latency):
+    """Shard worker with a fake Bot API; reports processed updates when drained"""
+    os.chdir(tempfile.mkdtemp(prefix=f"bot-shard{index}-"))
+    main.METRICS_PORT = 0
+    # main() refuses memory:// with SHARD_WORKERS; the normal scenario shares no state between chats
+    main.STATE_URL = "memory://"
+    main.shard_index, main.shard_count, main.shard_stats = index, count, stats
+
+    api = FakeTelegramAPI(latency=latency / 1000, admin_ids={ADMIN_ID})
+    application = main.build_application("1:bench", request=FakeRequest(api), polling=False)
+    ready.put(index)
+    asyncio.run(main.run_shard(application, inbox))
+    done.put((index, main.last_update["count"]))
+
+
+def run(count, updates, latency):
+    context = multiprocessing.get_context("spawn")
+    stats = context.Array("q", count * len(main.SHARD_STATS))
+    inboxes = [context.Queue() for _ in range(count)]
+    ready, done = context.Queue(), context.Queue()
+    processes = [
+        context.Process(target=worker, args=(i, count, inboxes[i], stats, ready, done, latency))
+        for i in range(count)
+    ]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.get()
+
+    start = time.perf_counter()
+    for update in updates:
+        chat_id = update["message"]["chat"]["id"]
+        inboxes[main.shard_for(chat_id, count)].put(update)
+    for inbox in inboxes:
+        inbox.put(None)
+    processed = dict(done.get() for _ in processes)
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    return elapsed, processed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("-n", "--count", type=int, default=5000, help="updates to replay")
+    parser.add_argument("--chats", type=int, default=64, help="spread the updates over this many chats")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake API latency in ms")
+    return parser.parse_args()
+
+
+def main_bench(args):
+    _, updates = normal_chat(args.count, random.Random(0))
+    rng = random.Random(1)
+    chat_ids = [-1000 - i for i in range(args.chats)]
+    for update in updates:
+        update["message"]["chat"]["id"] = rng.choice(chat_ids)
+
+    print(f"{len(updates)} updates over {args.chats} chats, {os.cpu_count()} CPU core(s)\n")
+    print(f"{'workers':>7} {'updates/s':>10} {'speedup':>8}  per-worker updates")
+    base = None
+    for count in args.workers:
+        elapsed, processed = run(count, updates, args.latency)
+        rate = len(updates) / elapsed
+        base = base or rate
+        print(f"{count:>7} {rate:>10.0f} {rate / base:>7.2f}x  {[processed[i] for i in sorted(processed)]}")
+
+
+if __name__ == "__main__":
+    main_bench(parse_args())
@@ -0,0 +1,77 @@
+"""Cost and accuracy of the cross-user duplicate spam detector.
+
+Feeds main.SpamWindow a stream of ordinary chat messages mixed with spam
+waves (one text posted by many users, each copy slightly varied), then
+reports the time per message for increasing window sizes and how many
+wave messages ended up in a cluster big enough to trigger. The time per
+message should stay flat as the window grows.
+
+    python benchmarks/spam_waves.py [messages]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+WORDS = (
+    "hello there how is everyone doing today the weather is nice lets meet "
+    "later for coffee did you see the match yesterday great game"
+).split()
+SPAM = "🔥 FREE crypto giveaway!! join t.me/+{} now and claim 500 USDT before it ends"
+
+
+def vary(text, rng):
+    """A spam copy as raiders send it: random tag, case and punctuation changes"""
+    text = text.format(rng.randrange(10**6))
+    if rng.random() < 0.5:
+        text = text.upper()
+    return text + rng.choice(["", "!!", " 💰", " ...", " ✅✅"])
+
+
+def stream(count, rng):
+    """(text, user_id, is_spam) with a 20-message spam wave every 500 messages"""
+    messages = []
+    for i in range(count):
+        if i % 500 < 20:
+            messages.append((vary(SPAM, rng), 10_000 + i, True))
+        else:
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randrange(4, 14)))
+            messages.append((text, rng.randrange(300), False))
+    return messages
+
+
+def run(messages, window_size):
+    main.SPAM_WINDOW_SIZE = window_size
+    window = main.SpamWindow()
+    caught = false_positives = 0
+    start = time.perf_counter()
+    for message_id, (text, user_id, is_spam) in enumerate(messages):
+        text = main.normalize_spam_text(text)
+        if len(text) < main.SPAM_MIN_LENGTH:
+            continue
+        # One message per 50ms keeps thousands of messages inside the time window
+        cluster = window.add(text, user_id, message_id, message_id * 0.05)
+        if len(cluster.users) > main.SPAM_USER_LIMIT:
+            caught += is_spam
+            false_positives += not is_spam
+    elapsed = time.perf_counter() - start
+    return elapsed / len(messages), caught, false_positives
+
+
+def main_bench(count):
+    rng = random.Random(0)
+    messages = stream(count, rng)
+    spam = sum(is_spam for _, _, is_spam in messages)
+    print(f"{count} messages, {spam} spam\n")
+    print(f"{'window':>7} {'us/message':>11} {'flagged spam':>13} {'false pos.':>11}")
+    for size in (100, 500, 2000, 10000):
+        per_message, caught, false_positives = run(messages, size)
+        print(f"{size:>7} {per_message * 1e6:>11.1f} {caught:>13} {false_positives:>11}")
+
+
+if __name__ == "__main__":
+    main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
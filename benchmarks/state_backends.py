@@ -0,0 +1,158 @@
+"""Conformance check and hot-path timings for the state backend drivers.
+
+Runs the same sequence of state API calls against the memory, SQLite and
+Redis drivers (the latter against fake_redis.py in a subprocess, or a real
+server via --redis-url), asserting identical results, then times what a
+message update costs: the per-chat document prefetch (one get per
+document, one pipelined get_many, and get_many_incr carrying the flood
+counters along) and the activity/flood counters.
+
+    python benchmarks/state_backends.py [-n 2000] [--redis-url redis://127.0.0.1:6379/15]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import main  # noqa: E402
+
+
+async def conformance(backend):
+    """Exercise every state API call; raises AssertionError on a mismatch"""
+    await backend.delete("t:a", "t:b", "t:n", "t:ttl", "t:h", "t:c")
+    assert await backend.get("t:a") is None
+    await backend.set("t:a", '{"x": 1}')
+    await backend.set_many({"t:b": "b", "t:n": "5"})
+    assert await backend.get_many(["t:a", "t:missing", "t:b"]) == ['{"x": 1}', None, "b"]
+    assert await backend.incr("t:n", 2) == 7
+
+    assert await backend.incr("t:ttl", ttl=1) == 1
+    assert await backend.incr("t:ttl", ttl=1) == 2
+    await asyncio.sleep(1.1)
+    assert await backend.get("t:ttl") is None
+    assert await backend.incr("t:ttl", ttl=1) == 1
+
+    assert await backend.get_many_incr(["t:a", "t:missing"], "t:c", ttl=5) == (['{"x": 1}', None], 1)
+    assert await backend.get_many_incr(["t:c"], "t:c", 2) == (["1"], 3)
+    await backend.delete("t:c")
+
+    assert await backend.hincr("t:h", "u1") == 1
+    assert await backend.hincr("t:h", "u1", 4) == 5
+    await backend.hset("t:h", {"u2": 0})
+    assert await backend.hgetall("t:h") == {"u1": "5", "u2": "0"}
+    assert await backend.hget("t:h", "u1") == "5" and await backend.hget("t:h", "missing") is None
+    await backend.hdel("t:h", "u2", "missing")
+    assert await backend.hgetall("t:h") == {"u1": "5"}
+
+    assert await backend.apply([("set", "t:b", "B"), ("hash", "t:h2", {"x": 1}), ("hash", "t:h2", {"y": 2})]) == 3
+    assert await backend.get("t:b") == "B" and await backend.hgetall("t:h2") == {"y": "2"}
+
+    def failing():
+        yield "set", "t:b", "lost"
+        raise ValueError("bad record")
+    try:
+        await backend.apply(failing())
+    except ValueError:
+        pass
+    assert await backend.get("t:b") == "B"
+    assert await backend.apply([("delete", "t:h2", None), ("set", "t:d", "D"), ("delete", "t:d", None)]) == 1
+    assert await backend.hgetall("t:h2") == {} and await backend.get("t:d") is None
+
+    assert sorted(await backend.keys("t:")) == ["t:a", "t:b", "t:h", "t:n", "t:ttl"]
+    await backend.delete("t:a", "t:h")
+    assert await backend.get("t:a") is None and await backend.hgetall("t:h") == {}
+
+
+async def timed(label, count, fn):
+    start = time.perf_counter()
+    for i in range(count):
+        await fn(i)
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<34} {elapsed / count * 1e6:>9.1f} us/op")
+
+
+async def hot_path(backend, count):
+    kinds = list(main.CHAT_DOCS)
+    chats = [str(-1000 - i) for i in range(50)]
+    await backend.set_many({main.doc_key(k, c): '{"antiflood": true}' for k in kinds for c in chats})
+
+    def keys(i):
+        return [main.doc_key(kind, chats[i % len(chats)]) for kind in kinds]
+
+    async def one_get_per_doc(i):
+        for key in keys(i):
+            await backend.get(key)
+
+    async def pipelined(i):
+        await backend.get_many(keys(i))
+
+    async def activity(i):
+        await backend.hincr(f"activity:{chats[i % len(chats)]}", str(i % 500))
+
+    async def flood(i):
+        await backend.incr(f"flood:{chats[i % len(chats)]}:{i % 500}", ttl=5)
+
+    async def separate(i):
+        chat = chats[i % len(chats)]
+        await backend.get_many(keys(i))
+        await backend.incr(f"flood:{chat}:{i % 500}", ttl=10)
+        await backend.get(f"flood:{chat}:{i % 500}:prev")
+        await backend.hincr(f"activity:{chat}", str(i % 500))
+
+    async def batched(i):
+        chat = chats[i % len(chats)]
+        await backend.get_many_incr(keys(i) + [f"flood:{chat}:{i % 500}:prev"], f"flood:{chat}:{i % 500}", ttl=10)
+
+    await timed(f"prefetch: {len(kinds)} x get", count, one_get_per_doc)
+    await timed("prefetch: get_many", count, pipelined)
+    await timed("activity hincr", count, activity)
+    await timed("flood incr with TTL", count, flood)
+    await timed("update: separate calls", count, separate)
+    await timed("update: get_many_incr", count, batched)
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="bot-state-")
+    urls = {"memory": "memory://", "sqlite": f"sqlite:///{workdir}/state.db"}
+    server = None
+    if args.redis_url:
+        urls["redis"] = args.redis_url
+    else:
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, "fake_redis.py"), "--port", str(args.port)],
+            stdout=subprocess.DEVNULL
+        )
+        urls["redis (fake)"] = f"redis://127.0.0.1:{args.port}/0"
+        await asyncio.sleep(1.0)
+
+    try:
+        for name, url in urls.items():
+            backend = main.make_backend(url)
+            await backend.connect()
+            try:
+                await conformance(backend)
+                print(f"{name}: conformance ok")
+                await hot_path(backend, args.count)
+            finally:
+                await backend.close()
+    finally:
+        if server:
+            server.terminate()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--count", type=int, default=2000, help="operations per timing")
+    parser.add_argument("--redis-url", help="use a real Redis server instead of the fake")
+    parser.add_argument("--port", type=int, default=16380, help="port for the fake Redis server")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -1,22 +1,163 @@
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatPermissions
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from logging.handlers import QueueHandler, QueueListener
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatPermissions, MessageEntity
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, TypeHandler, filters
 from telegram.constants import ParseMode
-from datetime import datetime, timedelta
+from telegram.error import RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+from datetime import datetime, timedelta, timezone
+import argparse
 import json
 import os
 import re
-from collections import defaultdict
+import secrets
+import unicodedata
+import html
+from collections import defaultdict, Counter, OrderedDict, deque
 import asyncio
+import atexit
+import queue
+import contextvars
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import types
+import weakref
+from urllib.parse import urlsplit
+import httpx
+from functools import lru_cache, wraps
+import heapq
+import bisect
+from array import array
+import time
+import glob
+import gzip
+import multiprocessing
+import signal
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:  # optional: without Pillow the media filter matches exact files only
+    Image = None
 
 # Logging setup
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# "json" for structured output, "text" for the classic format
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Identical errors beyond LOG_DEDUP_BURST per LOG_DEDUP_WINDOW seconds are suppressed
+LOG_DEDUP_WINDOW = 60
+LOG_DEDUP_BURST = 5
+# Message templates tracked for deduplication; the least recently logged are forgotten
+LOG_DEDUP_KEYS = 1000
+# Structured fields copied from `extra=` into JSON log lines
+LOG_FIELDS = ("chat_id", "user_id", "handler", "latency_ms", "suppressed")
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, including structured fields"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DuplicateFilter(logging.Filter):
+    """Rate-limit repeats of the same message template and exception type"""
+
+    def __init__(self):
+        super().__init__()
+        # key -> (window start, count, suppressed), least recently logged first
+        self.seen = OrderedDict()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        exc_type = record.exc_info[0] if record.exc_info else None
+        key = (record.name, record.levelno, record.msg, exc_type)
+        now = time.monotonic()
+        window_start, count, suppressed = self.seen.pop(key, (now, 0, 0))
+        if len(self.seen) >= LOG_DEDUP_KEYS:
+            self.seen.popitem(last=False)
+        if now - window_start >= LOG_DEDUP_WINDOW:
+            if suppressed:
+                record.suppressed = suppressed
+            window_start, count, suppressed = now, 0, 0
+        if count >= LOG_DEDUP_BURST:
+            self.seen[key] = (window_start, count, suppressed + 1)
+            return False
+        self.seen[key] = (window_start, count + 1, suppressed)
+        return True
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread"""
+
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    """Route all logging through a queue drained by a background thread"""
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(DuplicateFilter())
+    
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every request at INFO, which floods the queue under load
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Bot Token
-BOT_TOKEN = "8123726548:AAFKM_mphiAabUzHU7QXKKQqoCz2s-YM1_M"
+BOT_TOKEN = os.getenv("BOT_TOKEN", "8123726548:AAFKM_mphiAabUzHU7QXKKQqoCz2s-YM1_M")
+# Bot API server, e.g. a local fake for load tests (default: api.telegram.org)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "").rstrip("/")
+# HTTP backends: a keep-alive pool for outbound calls and a dedicated
+# connection for getUpdates. HTTP_VERSION=2 needs httpx[http2].
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+HTTP_VERSION = os.getenv("HTTP_VERSION", "1.1")
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+HTTP_WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", "10"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "5"))
+# Long-poll duration of getUpdates in seconds
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+# Number of updates processed at once; 1 keeps strict arrival order
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "1"))
+# Webhook mode is used when WEBHOOK_URL is set (needs python-telegram-bot[webhooks])
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+# Worker processes sharing the chats by chat id; 0 or 1 runs everything in one process.
+# Workers share state through the backend, so sharding needs sqlite:// or redis://.
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
 
-# Data storage
+# Legacy JSON data files, imported into the state backend on first start
 ADMIN_FILE = "admins.json"
 WARNINGS_FILE = "warnings.json"
 FILTERS_FILE = "filters.json"
@@ -25,9 +166,11 @@ NOTES_FILE = "notes.json"
 WELCOME_FILE = "welcome.json"
 BLACKLIST_FILE = "blacklist.json"
 
-# Global dictionaries
+# State backend: memory:// (not persisted), sqlite:///path/to/file.db or redis://host:port/db
+STATE_URL = os.getenv("STATE_URL", "sqlite:///bot_state.db")
+
+# Per-chat documents, cached here and reloaded from the backend for every update
 admins = defaultdict(list)
-warnings = defaultdict(lambda: defaultdict(int))
 word_filters = defaultdict(list)
 settings = defaultdict(lambda: {
     "antiflood": False,
@@ -42,130 +185,1697 @@ settings = defaultdict(lambda: {
 notes = defaultdict(dict)
 welcome_messages = defaultdict(lambda: "Welcome {user}! 👋")
 user_blacklist = defaultdict(list)
-flood_control = defaultdict(lambda: defaultdict(list))
-user_activity = defaultdict(lambda: defaultdict(int))
-
-# Load data functions
-def load_data():
-    global admins, warnings, word_filters, settings, notes, welcome_messages, user_blacklist
-    for file, data_dict in [
-        (ADMIN_FILE, admins),
-        (WARNINGS_FILE, warnings),
-        (FILTERS_FILE, word_filters),
-        (SETTINGS_FILE, settings),
-        (NOTES_FILE, notes),
-        (WELCOME_FILE, welcome_messages),
-        (BLACKLIST_FILE, user_blacklist)
-    ]:
-        if os.path.exists(file):
-            with open(file, 'r') as f:
-                loaded = json.load(f)
-                data_dict.update(loaded)
-
-def save_data(filename, data):
-    with open(filename, 'w') as f:
-        json.dump(dict(data), f, indent=2)
+link_rules = defaultdict(lambda: {"allow": [], "deny": []})
+media_rules = defaultdict(lambda: {"types": [], "blocked": [], "hashes": {}})
+
+# ==================== STATE BACKENDS ====================
+
+class StateError(Exception):
+    """Error reported by a state backend"""
+
+class MemoryBackend:
+    """In-process driver; everything is lost on restart"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def lookup(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            del self.expires[key]
+            self.data.pop(key, None)
+        return self.data.get(key)
+
+    async def get(self, key):
+        return self.lookup(key)
+
+    async def get_many(self, keys):
+        return [self.lookup(key) for key in keys]
+
+    async def set(self, key, value, ttl=None):
+        self.data[key] = value
+        if ttl:
+            self.expires[key] = time.monotonic() + ttl
+        else:
+            self.expires.pop(key, None)
+
+    async def set_many(self, mapping):
+        for key, value in mapping.items():
+            await self.set(key, value)
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+
+    async def incr(self, key, amount=1, ttl=None):
+        value = int(self.lookup(key) or 0) + amount
+        self.data[key] = str(value)
+        if ttl and key not in self.expires:
+            self.expires[key] = time.monotonic() + ttl
+        return value
+
+    async def get_many_incr(self, keys, counter, amount=1, ttl=None):
+        return [self.lookup(key) for key in keys], await self.incr(counter, amount, ttl)
+
+    async def hincr(self, key, field, amount=1):
+        fields = self.data.setdefault(key, {})
+        value = fields[field] = str(int(fields.get(field, 0)) + amount)
+        return int(value)
+
+    async def hset(self, key, mapping):
+        self.data.setdefault(key, {}).update({f: str(v) for f, v in mapping.items()})
+
+    async def hdel(self, key, *fields):
+        hash_fields = self.lookup(key) or {}
+        for field in fields:
+            hash_fields.pop(field, None)
+        if not hash_fields:
+            self.data.pop(key, None)
+
+    async def hget(self, key, field):
+        return (self.lookup(key) or {}).get(field)
+
+    async def hgetall(self, key):
+        return dict(self.lookup(key) or {})
+
+    async def apply(self, ops):
+        # Everything is validated before anything changes
+        ops = list(ops)
+        for op, key, value in ops:
+            self.expires.pop(key, None)
+            if op == "set":
+                self.data[key] = value
+            elif value:
+                self.data[key] = {f: str(v) for f, v in value.items()}
+            else:
+                self.data.pop(key, None)
+        return sum(op != "delete" for op, _, _ in ops)
+
+    async def keys(self, prefix):
+        return [key for key in list(self.data) if key.startswith(prefix) and self.lookup(key) is not None]
+
+class SQLiteBackend:
+    """SQLite driver; one connection used from a dedicated thread"""
+
+    # Expired keys are purged after this many writes
+    PURGE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.executor = None
+        self.db = None
+        self.writes = 0
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def open(self):
+        db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA busy_timeout=5000")
+        db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)")
+        db.execute("CREATE TABLE IF NOT EXISTS hash (key TEXT, field TEXT, value TEXT NOT NULL, PRIMARY KEY (key, field))")
+        self.db = db
+
+    async def connect(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-state")
+        await self.run(self.open)
+
+    async def close(self):
+        if self.db:
+            await self.run(self.db.close)
+            self.db = None
+        self.executor.shutdown(wait=False)
+
+    def wrote(self):
+        self.writes += 1
+        if self.writes % self.PURGE_EVERY == 0:
+            self.db.execute("DELETE FROM kv WHERE expires <= ?", (time.time(),))
+
+    def _get_many(self, keys):
+        found = dict(self.db.execute(
+            f"SELECT key, value FROM kv WHERE key IN ({','.join('?' * len(keys))}) "
+            f"AND (expires IS NULL OR expires > ?)",
+            (*keys, time.time())
+        ))
+        return [found.get(key) for key in keys]
+
+    def _set_many(self, mapping, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        self.db.executemany(
+            "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+            [(key, value, expires) for key, value in mapping.items()]
+        )
+        self.wrote()
+
+    def _delete(self, keys):
+        self.db.executemany("DELETE FROM kv WHERE key = ?", [(key,) for key in keys])
+        self.db.executemany("DELETE FROM hash WHERE key = ?", [(key,) for key in keys])
+
+    def _incr(self, key, amount, ttl):
+        now = time.time()
+        # One statement, so concurrent processes never lose an increment
+        (value,) = self.db.execute(
+            "INSERT INTO kv (key, value, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET "
+            "value = CASE WHEN kv.expires <= ? THEN excluded.value ELSE CAST(kv.value AS INTEGER) + excluded.value END, "
+            "expires = CASE WHEN kv.expires <= ? THEN excluded.expires ELSE kv.expires END "
+            "RETURNING value",
+            (key, amount, now + ttl if ttl else None, now, now)
+        ).fetchone()
+        self.wrote()
+        return int(value)
+
+    def _get_many_incr(self, keys, counter, amount, ttl):
+        return self._get_many(keys), self._incr(counter, amount, ttl)
+
+    def _hincr(self, key, field, amount):
+        (value,) = self.db.execute(
+            "INSERT INTO hash (key, field, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(key, field) DO UPDATE SET value = CAST(hash.value AS INTEGER) + excluded.value "
+            "RETURNING value",
+            (key, field, amount)
+        ).fetchone()
+        return int(value)
+
+    def _hset(self, key, mapping):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO hash (key, field, value) VALUES (?, ?, ?)",
+            [(key, field, str(value)) for field, value in mapping.items()]
+        )
+
+    def _hdel(self, key, fields):
+        self.db.executemany("DELETE FROM hash WHERE key = ? AND field = ?", [(key, field) for field in fields])
+
+    def _hget(self, key, field):
+        row = self.db.execute("SELECT value FROM hash WHERE key = ? AND field = ?", (key, field)).fetchone()
+        return row[0] if row else None
+
+    def _hgetall(self, key):
+        return dict(self.db.execute("SELECT field, value FROM hash WHERE key = ?", (key,)))
+
+    def _apply(self, ops):
+        count = 0
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            for op, key, value in ops:
+                if op == "set":
+                    self.db.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, NULL)", (key, value))
+                elif op == "delete":
+                    self._delete([key])
+                    continue
+                else:
+                    self.db.execute("DELETE FROM hash WHERE key = ?", (key,))
+                    self.db.executemany(
+                        "INSERT INTO hash (key, field, value) VALUES (?, ?, ?)",
+                        [(key, field, str(v)) for field, v in value.items()]
+                    )
+                count += 1
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return count
+
+    def _keys(self, prefix):
+        pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        rows = self.db.execute(
+            "SELECT key FROM kv WHERE key LIKE ? ESCAPE '\\' AND (expires IS NULL OR expires > ?) "
+            "UNION SELECT DISTINCT key FROM hash WHERE key LIKE ? ESCAPE '\\'",
+            (pattern, time.time(), pattern)
+        )
+        return [key for (key,) in rows]
+
+    async def get(self, key):
+        return (await self.run(self._get_many, [key]))[0]
+
+    async def get_many(self, keys):
+        return await self.run(self._get_many, list(keys))
+
+    async def set(self, key, value, ttl=None):
+        await self.run(self._set_many, {key: value}, ttl)
+
+    async def set_many(self, mapping):
+        await self.run(self._set_many, mapping)
+
+    async def delete(self, *keys):
+        await self.run(self._delete, keys)
+
+    async def incr(self, key, amount=1, ttl=None):
+        return await self.run(self._incr, key, amount, ttl)
+
+    async def get_many_incr(self, keys, counter, amount=1, ttl=None):
+        return await self.run(self._get_many_incr, list(keys), counter, amount, ttl)
+
+    async def hincr(self, key, field, amount=1):
+        return await self.run(self._hincr, key, field, amount)
+
+    async def hset(self, key, mapping):
+        await self.run(self._hset, key, mapping)
+
+    async def hdel(self, key, *fields):
+        await self.run(self._hdel, key, fields)
+
+    async def hget(self, key, field):
+        return await self.run(self._hget, key, field)
+
+    async def hgetall(self, key):
+        return await self.run(self._hgetall, key)
+
+    async def apply(self, ops):
+        # ops is consumed in the database thread, inside the transaction
+        return await self.run(self._apply, ops)
+
+    async def keys(self, prefix):
+        return await self.run(self._keys, prefix)
+
+class RedisBackend:
+    """Redis (RESP2) driver; concurrent callers share one pipelined connection"""
+
+    def __init__(self, host="127.0.0.1", port=6379, db=0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.reader = None
+        self.writer = None
+        self.pending = deque()
+        self.reader_task = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.reader_task = asyncio.create_task(self.read_replies())
+        if self.db:
+            await self.execute("SELECT", self.db)
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            self.reader_task.cancel()
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+            self.writer = None
+
+    @staticmethod
+    def encode(command):
+        out = [f"*{len(command)}\r\n".encode()]
+        for arg in command:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    async def read_reply(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            return StateError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            if rest == b"-1":
+                return None
+            return (await self.reader.readexactly(int(rest) + 2))[:-2].decode()
+        if kind == b"*":
+            if rest == b"-1":
+                return None
+            return [await self.read_reply() for _ in range(int(rest))]
+        raise StateError(f"Unexpected Redis reply: {line!r}")
+
+    async def read_replies(self):
+        """Resolve pending commands in order as their replies arrive"""
+        try:
+            while True:
+                reply = await self.read_reply()
+                future = self.pending.popleft()
+                if future.done():
+                    continue
+                if isinstance(reply, StateError):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except Exception as e:
+            while self.pending:
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_exception(e if isinstance(e, (StateError, ConnectionError)) else StateError(str(e)))
+
+    async def pipeline(self, *commands):
+        """Send several commands in one write and wait for all replies"""
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in commands]
+        self.pending.extend(futures)
+        self.writer.write(b"".join(self.encode(command) for command in commands))
+        await self.writer.drain()
+        return await asyncio.gather(*futures)
+
+    async def execute(self, *command):
+        return (await self.pipeline(command))[0]
+
+    async def get(self, key):
+        return await self.execute("GET", key)
+
+    async def get_many(self, keys):
+        return await self.execute("MGET", *keys) if keys else []
+
+    async def set(self, key, value, ttl=None):
+        if ttl:
+            await self.execute("SET", key, value, "EX", max(1, int(ttl)))
+        else:
+            await self.execute("SET", key, value)
+
+    async def set_many(self, mapping):
+        if mapping:
+            await self.execute("MSET", *[x for item in mapping.items() for x in item])
+
+    async def delete(self, *keys):
+        if keys:
+            await self.execute("DEL", *keys)
+
+    async def incr(self, key, amount=1, ttl=None):
+        if not ttl:
+            return await self.execute("INCRBY", key, amount)
+        # Create the key with its TTL first so the window starts at the first increment
+        replies = await self.pipeline(
+            ("MULTI",), ("SET", key, 0, "EX", max(1, int(ttl)), "NX"), ("INCRBY", key, amount), ("EXEC",)
+        )
+        return replies[-1][1]
+
+    async def get_many_incr(self, keys, counter, amount=1, ttl=None):
+        """MGET plus INCRBY of a counter, sent in one write"""
+        if not ttl:
+            values, count = await self.pipeline(("MGET", *keys), ("INCRBY", counter, amount))
+            return values, count
+        replies = await self.pipeline(
+            ("MGET", *keys), ("MULTI",), ("SET", counter, 0, "EX", max(1, int(ttl)), "NX"),
+            ("INCRBY", counter, amount), ("EXEC",)
+        )
+        return replies[0], replies[-1][1]
+
+    async def hincr(self, key, field, amount=1):
+        return await self.execute("HINCRBY", key, field, amount)
+
+    async def hset(self, key, mapping):
+        if mapping:
+            await self.execute("HSET", key, *[x for item in mapping.items() for x in item])
+
+    async def hdel(self, key, *fields):
+        if fields:
+            await self.execute("HDEL", key, *fields)
+
+    async def hget(self, key, field):
+        return await self.execute("HGET", key, field)
+
+    async def hgetall(self, key):
+        values = await self.execute("HGETALL", key)
+        return dict(zip(values[::2], values[1::2]))
+
+    async def apply(self, ops):
+        commands, count = [("MULTI",)], 0
+        for op, key, value in ops:
+            if op == "set":
+                commands.append(("SET", key, value))
+            else:
+                commands.append(("DEL", key))
+                if op == "delete":
+                    continue
+                if value:
+                    commands.append(("HSET", key, *[x for item in value.items() for x in item]))
+            count += 1
+        commands.append(("EXEC",))
+        # Sent in one write, so no other caller's command lands inside the transaction
+        replies = await self.pipeline(*commands)
+        errors = [reply for reply in replies[-1] or [] if isinstance(reply, StateError)]
+        if errors:
+            raise errors[0]
+        return count
+
+    async def keys(self, prefix):
+        cursor, found = "0", []
+        while True:
+            cursor, batch = await self.execute("SCAN", cursor, "MATCH", f"{prefix}*", "COUNT", 1000)
+            found.extend(batch)
+            if cursor == "0":
+                return found
+
+def make_backend(url):
+    """Create the driver for a STATE_URL"""
+    parts = urlsplit(url)
+    if parts.scheme == "memory":
+        return MemoryBackend()
+    if parts.scheme == "sqlite":
+        # sqlite:///relative.db or sqlite:////absolute/path.db
+        return SQLiteBackend(parts.path[1:])
+    if parts.scheme == "redis":
+        return RedisBackend(parts.hostname or "127.0.0.1", parts.port or 6379, int(parts.path.strip("/") or 0))
+    raise ValueError(f"Unsupported STATE_URL: {url}")
+
+# The active backend; replaced by init_state() when the bot starts
+state = MemoryBackend()
+
+# ==================== CHAT STATE ====================
+
+# Per-chat documents stored as JSON under "<kind>:<chat_id>"
+CHAT_DOCS = {
+    "admins": admins,
+    "filters": word_filters,
+    "settings": settings,
+    "notes": notes,
+    "welcome": welcome_messages,
+    "blacklist": user_blacklist,
+    "links": link_rules,
+    "media": media_rules,
+}
+# Legacy file of every document kind; warnings become the "warnings:<chat_id>" hash of per-user warning lists
+LEGACY_FILES = {
+    "admins": ADMIN_FILE,
+    "filters": FILTERS_FILE,
+    "settings": SETTINGS_FILE,
+    "notes": NOTES_FILE,
+    "welcome": WELCOME_FILE,
+    "blacklist": BLACKLIST_FILE,
+    "warnings": WARNINGS_FILE,
+}
+
+# Raw JSON last read or written per (kind, chat_id), so unchanged documents are not decoded again
+doc_raw = {}
+
+# Timing of the most recent document write, reported by /ping
+last_save = {"at": None, "duration": 0.0, "max_duration": 0.0}
+
+# Totals reported by /sys for the chats this process owns, kept current as documents are
+# loaded and saved: kind -> total, and (kind, chat_id) -> that chat's share of it
+COUNTED_DOCS = ("settings", "filters", "notes")
+doc_totals = dict.fromkeys(COUNTED_DOCS, 0)
+doc_sizes = {}
+
+def count_doc(kind, chat_id, doc):
+    if kind not in doc_totals:
+        return
+    size = 0 if doc is None else 1 if kind == "settings" else len(doc)
+    doc_totals[kind] += size - doc_sizes.get((kind, chat_id), 0)
+    if size:
+        doc_sizes[(kind, chat_id)] = size
+    else:
+        doc_sizes.pop((kind, chat_id), None)
+
+def doc_key(kind, chat_id):
+    return f"{kind}:{chat_id}"
+
+def drop_derived(kind, chat_id):
+    """Forget caches built from a chat document that changed"""
+    if kind == "settings":
+        settings_menus.pop(chat_id, None)
+    elif kind == "notes":
+        note_indexes.pop(chat_id, None)
+    elif kind == "welcome":
+        compiled_welcomes.pop(chat_id, None)
+    elif kind == "links":
+        link_tries.pop(chat_id, None)
+    elif kind == "media":
+        media_indexes.pop(chat_id, None)
+
+def chat_doc_keys(chat_id):
+    return [doc_key(kind, chat_id) for kind in CHAT_DOCS]
+
+def apply_chat_docs(chat_id, raws):
+    """Take in a chat's documents as read from the backend, in CHAT_DOCS order"""
+    for kind, raw in zip(CHAT_DOCS, raws):
+        if doc_raw.get((kind, chat_id)) == raw:
+            continue
+        doc_raw[(kind, chat_id)] = raw
+        if raw is None:
+            CHAT_DOCS[kind].pop(chat_id, None)
+        else:
+            CHAT_DOCS[kind][chat_id] = json.loads(raw)
+        count_doc(kind, chat_id, CHAT_DOCS[kind].get(chat_id))
+        drop_derived(kind, chat_id)
+
+async def load_chat(chat_id):
+    """Refresh every document of a chat from the backend in one round trip"""
+    apply_chat_docs(chat_id, await state.get_many(chat_doc_keys(chat_id)))
+
+async def load_chat_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before all handlers so they see the chat's current state.
+    
+    When antiflood is on, the sender's flood counters come back in the
+    same round trip as the chat's documents.
+    """
+    flood_counts.set(None)
+    if not update.effective_chat:
+        return
+    chat_id = str(update.effective_chat.id)
+    keys = chat_doc_keys(chat_id)
+    message = update.message
+    if message and message.from_user and settings.get(chat_id, {}).get("antiflood", False):
+        flood_key, previous_key, _ = flood_window(chat_id, message)
+        raws, count = await state.get_many_incr(keys + [previous_key], flood_key, ttl=FLOOD_WINDOW_SECONDS * 2)
+        flood_counts.set((count, int(raws.pop() or 0)))
+    else:
+        raws = await state.get_many(keys)
+    apply_chat_docs(chat_id, raws)
+
+async def save_chat(kind, chat_id):
+    """Write one chat document to the backend"""
+    start = time.perf_counter()
+    raw = json.dumps(CHAT_DOCS[kind][chat_id])
+    await state.set(doc_key(kind, chat_id), raw)
+    doc_raw[(kind, chat_id)] = raw
+    count_doc(kind, chat_id, CHAT_DOCS[kind][chat_id])
+    duration = time.perf_counter() - start
+    last_save.update(at=time.monotonic(), duration=duration, max_duration=max(duration, last_save["max_duration"]))
+
+def read_legacy_file(filename):
+    """Contents of a legacy data file merged with its per-shard copies"""
+    root, ext = os.path.splitext(filename)
+    paths = [filename] + sorted(glob.glob(f"{root}.shard*{ext}"))
+    merged = {}
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                merged.update(json.load(f))
+    return merged, [p for p in paths if os.path.exists(p)]
+
+async def migrate_legacy_files(backend):
+    """Import the JSON data files into a persistent backend, then rename them"""
+    for kind, filename in LEGACY_FILES.items():
+        data, paths = read_legacy_file(filename)
+        if not paths:
+            continue
+        if kind == "warnings":
+            for chat_id, counts in data.items():
+                await backend.hset(doc_key(kind, chat_id), counts)
+        else:
+            await backend.set_many({doc_key(kind, chat_id): json.dumps(doc) for chat_id, doc in data.items()})
+        for path in paths:
+            os.replace(path, f"{path}.migrated")
+        logger.info("Migrated %s (%d chats) into the state backend", filename, len(data))
+
+async def init_state(url=None):
+    """Connect the configured backend, importing legacy JSON files on first use"""
+    global state
+    backend = make_backend(url or STATE_URL)
+    await backend.connect()
+    if not isinstance(backend, MemoryBackend):
+        await migrate_legacy_files(backend)
+    state = backend
+
+async def close_state():
+    await state.close()
+
+# Set in worker processes: index of the shard owned by this process and the number of shards
+shard_index = None
+shard_count = 1
+
+def shard_for(chat_id, count):
+    """Shard owning a chat; stable across restarts for the same worker count"""
+    return int(chat_id) % count
+
+# ==================== AUTO-EXPIRING NOTICES ====================
+
+# How long bot notices stay in the chat before being deleted
+NOTICE_TTL_SECONDS = 30
+# Longest the sweeper sleeps; it also wakes when the earliest notice is due
+NOTICE_SWEEP_INTERVAL = 5
+# Bot API deleteMessages accepts at most this many ids per call
+NOTICE_DELETE_BATCH = 100
+
+notice_queue = []
+notice_expiry = {}
+active_notices = {}
+background_tasks = []
+# Set when a notice is queued ahead of the one the sweeper is sleeping until
+notice_wakeup = None
+
+def queue_notice(expires, chat_id, message_id):
+    if notice_wakeup is not None and (not notice_queue or expires < notice_queue[0][0]):
+        notice_wakeup.set()
+    heapq.heappush(notice_queue, (expires, chat_id, message_id))
+
+async def post_notice(bot, chat_id, text, ttl=NOTICE_TTL_SECONDS, parse_mode=ParseMode.HTML):
+    """Send a notice that is deleted after ttl seconds; repeats are collapsed into one message.
+    
+    Nothing is sent while handling a stale backlog update.
+    """
+    if update_stale.get():
+        return
+    key = (str(chat_id), text)
+    now = time.monotonic()
+    expires = now + ttl
+    notice = active_notices.get(key)
+    
+    if notice and notice["expires"] > now:
+        notice["count"] += 1
+        notice["expires"] = expires
+        notice_expiry[(key[0], notice["message_id"])] = expires
+        queue_notice(expires, key[0], notice["message_id"])
+        try:
+            await bot.edit_message_text(
+                f"{text} (×{notice['count']})",
+                chat_id=chat_id,
+                message_id=notice["message_id"],
+                parse_mode=parse_mode
+            )
+        except Exception as e:
+            logger.error("Error updating notice: %s", e, extra={"chat_id": chat_id})
+        return
+    
+    msg = await bot.send_message(chat_id, text, parse_mode=parse_mode)
+    active_notices[key] = {"message_id": msg.message_id, "count": 1, "expires": expires}
+    notice_expiry[(key[0], msg.message_id)] = expires
+    queue_notice(expires, key[0], msg.message_id)
+
+def pop_expired_notices(now):
+    """Pop all due notices from the queue, grouped by chat"""
+    due = defaultdict(list)
+    while notice_queue and notice_queue[0][0] <= now:
+        expires, chat_id, message_id = heapq.heappop(notice_queue)
+        # Entries superseded by a later extension are skipped
+        if notice_expiry.get((chat_id, message_id)) != expires:
+            continue
+        del notice_expiry[(chat_id, message_id)]
+        due[chat_id].append(message_id)
+    
+    if due:
+        for key in [k for k, n in active_notices.items() if n["expires"] <= now]:
+            del active_notices[key]
+    return due
+
+async def notice_sweeper(bot):
+    """Background task deleting expired notices in batches as they fall due"""
+    global notice_wakeup
+    notice_wakeup = asyncio.Event()
+    while True:
+        notice_wakeup.clear()
+        delay = NOTICE_SWEEP_INTERVAL
+        if notice_queue:
+            delay = min(delay, max(0, notice_queue[0][0] - time.monotonic()))
+        try:
+            await asyncio.wait_for(notice_wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        if catch_up["active"] and time.monotonic() - catch_up["last_stale"] >= CATCH_UP_IDLE_SECONDS:
+            # The backlog was drained and nothing live has arrived since
+            await finish_catch_up(bot)
+        # Backlog deletions left over when the queue ran dry before catch-up ended
+        await flush_stale_deletions(bot)
+        for chat_id, message_ids in pop_expired_notices(time.monotonic()).items():
+            for i in range(0, len(message_ids), NOTICE_DELETE_BATCH):
+                try:
+                    await bot.delete_messages(chat_id, message_ids[i:i + NOTICE_DELETE_BATCH])
+                except Exception as e:
+                    logger.error("Error deleting notices: %s", e, extra={"chat_id": chat_id})
+
+# ==================== BACKLOG CATCH-UP ====================
+
+# Updates whose event is older than this are backlog from downtime
+STALE_UPDATE_SECONDS = int(os.getenv("STALE_UPDATE_SECONDS", "60"))
+# Recently seen update ids, to drop updates delivered twice
+SEEN_UPDATES_LIMIT = 10000
+# Catch-up also ends when no stale update arrived for this long, e.g. a backlog followed by silence
+CATCH_UP_IDLE_SECONDS = 10
+
+# True while handlers run for a stale update: side effects are suppressed
+update_stale = contextvars.ContextVar("update_stale", default=False)
+catch_up = {
+    "active": False, "started": None, "last_stale": None, "duration": None,
+    "stale": 0, "duplicates": 0, "batched_deletes": 0,
+}
+seen_updates = deque(maxlen=SEEN_UPDATES_LIMIT)
+seen_update_ids = set()
+# Messages of stale updates waiting for one deleteMessages call per chat
+stale_deletions = defaultdict(list)
+# (chat_id, user_id) already banned during the current catch-up
+stale_bans = set()
+
+def update_time(update):
+    """When the event behind an update happened, from Telegram's own timestamps"""
+    if update.edited_message or update.edited_channel_post:
+        message = update.edited_message or update.edited_channel_post
+        return message.edit_date or message.date
+    message = update.message or update.channel_post
+    if message:
+        return message.date
+    event = update.chat_member or update.my_chat_member or update.chat_join_request
+    if event:
+        return event.date
+    # Callback and inline queries carry no timestamp and are always live
+    return None
+
+async def flush_stale_deletions(bot):
+    """Delete queued backlog messages with one API call per chat and batch"""
+    pending = list(stale_deletions.items())
+    stale_deletions.clear()
+    for chat_id, message_ids in pending:
+        for i in range(0, len(message_ids), NOTICE_DELETE_BATCH):
+            try:
+                await bot.delete_messages(chat_id, message_ids[i:i + NOTICE_DELETE_BATCH])
+                catch_up["batched_deletes"] += len(message_ids[i:i + NOTICE_DELETE_BATCH])
+            except Exception as e:
+                logger.error("Error deleting backlog messages: %s", e, extra={"chat_id": chat_id})
+
+async def delete_message(bot, message):
+    """Delete a message now, or queue it for a batched delete if it is backlog"""
+    if not update_stale.get():
+        await message.delete()
+        return
+    queued = stale_deletions[message.chat.id]
+    queued.append(message.message_id)
+    if len(queued) >= NOTICE_DELETE_BATCH:
+        await flush_stale_deletions(bot)
+
+async def delete_messages(bot, chat_id, message_ids):
+    """Delete messages by id in batches, or queue them if the update is backlog"""
+    if update_stale.get():
+        stale_deletions[chat_id].extend(message_ids)
+        if len(stale_deletions[chat_id]) >= NOTICE_DELETE_BATCH:
+            await flush_stale_deletions(bot)
+        return
+    for i in range(0, len(message_ids), NOTICE_DELETE_BATCH):
+        await bot.delete_messages(chat_id, message_ids[i:i + NOTICE_DELETE_BATCH])
+
+async def finish_catch_up(bot):
+    """Leave catch-up mode and report how long it took"""
+    catch_up["active"] = False
+    catch_up["duration"] = catch_up["last_stale"] - catch_up["started"]
+    await flush_stale_deletions(bot)
+    stale_bans.clear()
+    logger.info(
+        "Caught up on %d stale updates in %.1fs (%d duplicates dropped, %d messages deleted in batches)",
+        catch_up["stale"], catch_up["duration"], catch_up["duplicates"], catch_up["batched_deletes"]
+    )
+
+async def classify_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs first: drop duplicates and flag backlog updates as stale"""
+    if update.update_id in seen_update_ids:
+        catch_up["duplicates"] += 1
+        raise ApplicationHandlerStop
+    if len(seen_updates) == seen_updates.maxlen:
+        seen_update_ids.discard(seen_updates[0])
+    seen_updates.append(update.update_id)
+    seen_update_ids.add(update.update_id)
+    
+    when = update_time(update)
+    stale = when is not None and (datetime.now(timezone.utc) - when).total_seconds() > STALE_UPDATE_SECONDS
+    update_stale.set(stale)
+    if stale:
+        if not catch_up["active"]:
+            catch_up.update(active=True, started=time.monotonic(), stale=0, duplicates=0, batched_deletes=0)
+            logger.info("Backlog detected, catching up with side effects suppressed")
+        catch_up["stale"] += 1
+        catch_up["last_stale"] = time.monotonic()
+    elif catch_up["active"] and when is not None:
+        await finish_catch_up(context.bot)
+
+# ==================== SECURITY & PROTECTION ====================
+
+async def anti_channel_protection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Prevents channel messages and deletes them"""
+    message = update.message or update.edited_message
+    if message and message.sender_chat and message.sender_chat.type == "channel":
+        chat_id = message.chat.id
+        if settings[str(chat_id)].get("channel_protection", True):
+            try:
+                await delete_message(context.bot, message)
+                await post_notice(context.bot, chat_id, "⚠️ Channel messages are not allowed in this group!")
+            except Exception as e:
+                logger.error("Error deleting channel message: %s", e, extra={"chat_id": chat_id})
+
+async def anti_id_exposure(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Protects user IDs from being exposed"""
+    message = update.message
+    if message and message.forward_from:
+        chat_id = message.chat.id
+        if settings[str(chat_id)].get("id_protection", True):
+            try:
+                await delete_message(context.bot, message)
+                await post_notice(context.bot, chat_id, "🔒 Forwarded messages that expose user IDs are not allowed!")
+            except Exception as e:
+                logger.error("Error in ID protection: %s", e, extra={"chat_id": chat_id})
+
+# ==================== ADMIN COMMANDS ====================
+
+START_TEXT = """
+🤖 <b>Advanced Group Manager Bot</b>
+
+Welcome! I'm a powerful bot with 100+ features for managing your groups.
+
+<b>Key Features:</b>
+✅ Advanced Admin Tools
+✅ Anti-Spam & Raid Protection
+✅ Welcome Messages & Captcha
+✅ Content Filters & Blacklist
+✅ Fun Commands & Games
+✅ Statistics & Analytics
+✅ Auto-Moderation
+✅ Channel & ID Protection
+✅ And much more!
+
+Click below to explore all features! 🚀
+    """
+
+HELP_TEXT = """
+📚 <b>Bot Commands Menu</b>
+
+Select a category to see available commands:
+
+👮 <b>Admin</b> - Moderation & management
+🛡️ <b>Security</b> - Protection features
+💬 <b>Chat</b> - Group utilities
+🎮 <b>Fun</b> - Entertainment commands
+📊 <b>Stats</b> - Analytics & insights
+⚙️ <b>Settings</b> - Bot configuration
+🔍 <b>Search</b> - Find information
+🎯 <b>Misc</b> - Other useful commands
+    """
+
+HELP_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👮 Admin", callback_data="help_admin"),
+     InlineKeyboardButton("🛡️ Security", callback_data="help_security")],
+    [InlineKeyboardButton("💬 Chat", callback_data="help_chat"),
+     InlineKeyboardButton("🎮 Fun", callback_data="help_fun")],
+    [InlineKeyboardButton("📊 Stats", callback_data="help_stats"),
+     InlineKeyboardButton("⚙️ Settings", callback_data="help_settings")],
+    [InlineKeyboardButton("🔍 Search", callback_data="help_search"),
+     InlineKeyboardButton("🎯 Misc", callback_data="help_misc")]
+])
+
+@lru_cache(maxsize=None)
+def start_markup(bot_username):
+    """Build the start keyboard once per bot username"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("➕ Add to Group", url=f"https://t.me/{bot_username}?startgroup=true")],
+        [InlineKeyboardButton("📚 Commands", callback_data="help"), 
+         InlineKeyboardButton("⚙️ Features", callback_data="features")],
+        [InlineKeyboardButton("👨‍💻 Developer", url="https://t.me/narzoxbot")]
+    ])
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start command with beautiful UI"""
+    await update.message.reply_text(START_TEXT, reply_markup=start_markup(context.bot.username), parse_mode=ParseMode.HTML)
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comprehensive help menu"""
+    if update.callback_query:
+        await update.callback_query.edit_message_text(HELP_TEXT, reply_markup=HELP_MARKUP, parse_mode=ParseMode.HTML)
+    else:
+        await update.message.reply_text(HELP_TEXT, reply_markup=HELP_MARKUP, parse_mode=ParseMode.HTML)
+
+# ==================== MODERATION LOG ====================
+
+# Directory of the append-only audit log; shard workers use a subdirectory each
+AUDIT_DIR = os.getenv("AUDIT_DIR", "audit")
+# A new segment is started once the active one reaches this size
+AUDIT_SEGMENT_BYTES = 4 * 1024 * 1024
+# Older segments are deleted, with their indexes, at startup and whenever a new segment starts
+AUDIT_RETENTION_DAYS = int(os.getenv("AUDIT_RETENTION_DAYS", "90"))
+AUDIT_MAX_SEGMENTS = int(os.getenv("AUDIT_MAX_SEGMENTS", "100"))
+# Queued actions are compressed and written by a background thread this often
+AUDIT_FLUSH_INTERVAL = 1
+AUDIT_QUERY_LIMIT = 50
+# Recorded actions (also the /modlog action filters) and their icons
+AUDIT_ACTIONS = {
+    "ban": "🚫", "unban": "✅", "kick": "👢", "mute": "🔇", "unmute": "🔊",
+    "warn": "⚠️", "unwarn": "♻️", "purge": "🗑", "delete": "🗑",
+    "filter": "🔤", "flood": "🌊", "blacklist": "⛔", "link": "🔗", "media": "🖼",
+    "spam": "🛡️", "fban": "🏛", "unfban": "🏛", "import": "📥",
+}
+AUDIT_PERIODS = {"24h": 86400, "7d": 7 * 86400}
+
+def audit_keys(record):
+    """Index keys of a record: its chat, and its action, target and actor within the chat"""
+    chat = f"chat:{record['chat']}"
+    keys = [chat, f"{chat}:action:{record['action']}"]
+    for role in ("target", "actor"):
+        if record.get(role) is not None:
+            keys.append(f"{chat}:{role}:{record[role]}")
+        if record.get(f"{role}_username"):
+            keys.append(f"{chat}:{role}:@{record[f'{role}_username']}")
+    return keys
+
+class AuditLog:
+    """Append-only moderation log in size-rotated gzip segments.
+
+    Every written batch becomes one gzip member appended to the active segment
+    and one line in the segment's .idx file recording where the member is, the
+    time span it covers and the index keys of its records. Queries decompress
+    only the members listed under their key, newest first. Segments past
+    the retention limits are deleted. Methods block and are run in the audit
+    thread.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        # {"name", "members": [(offset, length, first, last)], "keys": {key: [member number]}}
+        self.segments = []
+
+    def path(self, segment, suffix=".log.gz"):
+        return os.path.join(self.directory, segment["name"] + suffix)
+
+    def add_segment(self, name):
+        segment = {"name": name, "members": [], "keys": {}}
+        self.segments.append(segment)
+        return segment
+
+    def index_member(self, segment, entry):
+        number = len(segment["members"])
+        segment["members"].append((entry["offset"], entry["length"], entry["first"], entry["last"]))
+        for key in entry["keys"]:
+            segment["keys"].setdefault(key, []).append(number)
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for path in sorted(glob.glob(os.path.join(self.directory, "audit-*.log.gz"))):
+            segment = self.add_segment(os.path.basename(path)[:-len(".log.gz")])
+            if not os.path.exists(self.path(segment, ".idx")):
+                continue
+            with open(self.path(segment, ".idx")) as f:
+                for line in f:
+                    try:
+                        self.index_member(segment, json.loads(line))
+                    except ValueError:
+                        # Torn last line from a crash; its member stays unindexed
+                        pass
+        self.prune(time.time())
+
+    def prune(self, now):
+        """Delete segments beyond AUDIT_MAX_SEGMENTS or older than AUDIT_RETENTION_DAYS"""
+        cutoff = now - AUDIT_RETENTION_DAYS * 86400
+        # The newest segment is kept even when it is old, as it is the one written to
+        while len(self.segments) > 1:
+            segment = self.segments[0]
+            if segment["members"]:
+                newest = segment["members"][-1][3]
+            else:
+                newest = os.path.getmtime(self.path(segment)) if os.path.exists(self.path(segment)) else 0
+            if len(self.segments) <= AUDIT_MAX_SEGMENTS and newest >= cutoff:
+                break
+            for suffix in (".log.gz", ".idx"):
+                if os.path.exists(self.path(segment, suffix)):
+                    os.remove(self.path(segment, suffix))
+            self.segments.pop(0)
+
+    def active_segment(self):
+        """Segment to append to, starting a new one when the current one is full"""
+        if self.segments:
+            segment = self.segments[-1]
+            members = segment["members"]
+            if not members or members[-1][0] + members[-1][1] < AUDIT_SEGMENT_BYTES:
+                return segment
+            number = int(segment["name"].split("-")[1]) + 1
+        else:
+            number = 1
+        segment = self.add_segment(f"audit-{number:06d}")
+        self.prune(time.time())
+        return segment
+
+    def write(self, records):
+        segment = self.active_segment()
+        data = gzip.compress("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode())
+        with open(self.path(segment), "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        entry = {
+            "offset": offset, "length": len(data), "first": records[0]["t"], "last": records[-1]["t"],
+            "keys": sorted({key for record in records for key in audit_keys(record)}),
+        }
+        with open(self.path(segment, ".idx"), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        self.index_member(segment, entry)
+
+    def query(self, key, since=None, limit=AUDIT_QUERY_LIMIT):
+        """Newest records indexed under `key`, stopping at `since` or `limit`"""
+        found = []
+        for segment in reversed(self.segments):
+            numbers = segment["keys"].get(key)
+            if not numbers:
+                continue
+            with open(self.path(segment), "rb") as f:
+                for number in reversed(numbers):
+                    offset, length, first, last = segment["members"][number]
+                    # Members are in time order, so everything further back is older still
+                    if since is not None and last < since:
+                        return found
+                    f.seek(offset)
+                    lines = gzip.decompress(f.read(length)).decode().splitlines()
+                    for line in reversed(lines):
+                        record = json.loads(line)
+                        if key in audit_keys(record) and (since is None or record["t"] >= since):
+                            found.append(record)
+                            if len(found) >= limit:
+                                return found
+        return found
+
+audit_log = None
+audit_executor = None
+audit_pending = []
+
+def audit_user(role, user):
+    """Record fields for a telegram User or a bare user id"""
+    if isinstance(user, int):
+        return {role: user}
+    fields = {role: user.id, f"{role}_name": user.first_name}
+    if user.username:
+        fields[f"{role}_username"] = user.username.lower()
+    return fields
+
+def audit(chat_id, action, target=None, actor=None, reason=None, count=None):
+    """Queue a moderation action for the audit log; actor None means the bot acted on its own"""
+    if audit_log is None:
+        return
+    record = {"t": round(time.time(), 3), "chat": str(chat_id), "action": action}
+    if target is not None:
+        record.update(audit_user("target", target))
+    if actor is not None:
+        record.update(audit_user("actor", actor))
+    if reason:
+        record["reason"] = reason
+    if count is not None:
+        record["count"] = count
+    audit_pending.append(record)
+
+async def flush_audit():
+    """Write the queued actions as one compressed batch in the audit thread"""
+    if not audit_pending:
+        return
+    batch = list(audit_pending)
+    audit_pending.clear()
+    try:
+        await asyncio.get_running_loop().run_in_executor(audit_executor, audit_log.write, batch)
+    except Exception as e:
+        logger.error("Error writing %d audit records: %s", len(batch), e)
+
+async def audit_writer():
+    """Background task flushing the audit queue"""
+    while True:
+        await asyncio.sleep(AUDIT_FLUSH_INTERVAL)
+        await flush_audit()
+
+async def open_audit_log():
+    global audit_log, audit_executor
+    directory = AUDIT_DIR if shard_index is None else os.path.join(AUDIT_DIR, f"shard{shard_index}")
+    audit_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audit")
+    log = AuditLog(directory)
+    await asyncio.get_running_loop().run_in_executor(audit_executor, log.open)
+    audit_log = log
+
+async def close_audit_log():
+    global audit_log
+    if audit_log is None:
+        return
+    await flush_audit()
+    audit_log = None
+    audit_executor.shutdown(wait=True)
+
+def format_audit(record):
+    when = datetime.fromtimestamp(record["t"], timezone.utc).strftime("%d %b %H:%M")
+    line = f"{when} {AUDIT_ACTIONS.get(record['action'], '•')} <b>{record['action']}</b>"
+    if record.get("target") is not None:
+        line += f" {html.escape(record.get('target_name') or '')} <code>{record['target']}</code>"
+    if record.get("count") is not None:
+        line += f" ×{record['count']}"
+    line += f" by {html.escape(record.get('actor_name') or str(record['actor']))}" if record.get("actor") else " by bot"
+    if record.get("reason"):
+        line += f" — {html.escape(record['reason'])}"
+    return line
+
+MODLOG_USAGE = (
+    "❌ Usage: /modlog [@user | user_id | by @admin | action] [today | 24h | 7d]\n"
+    f"Actions: {', '.join(AUDIT_ACTIONS)}"
+)
+
+def audit_user_key(arg):
+    return arg.lower() if arg.startswith("@") else str(int(arg))
+
+async def modlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Query the audit log of this chat"""
+    if not await is_admin(update, context):
+        return
+    if audit_log is None:
+        await update.message.reply_text("❌ The moderation log is not available!")
+        return
+    
+    chat = f"chat:{update.effective_chat.id}"
+    args = [arg.lower() for arg in context.args]
+    since = None
+    if args and (args[-1] == "today" or args[-1] in AUDIT_PERIODS):
+        now = time.time()
+        period = args.pop()
+        since = now - now % 86400 if period == "today" else now - AUDIT_PERIODS[period]
+    
+    reply = update.message.reply_to_message
+    try:
+        if not args:
+            key = f"{chat}:target:{reply.from_user.id}" if reply and reply.from_user else chat
+        elif len(args) == 2 and args[0] == "by":
+            key = f"{chat}:actor:{audit_user_key(args[1])}"
+        elif len(args) == 1 and args[0] in AUDIT_ACTIONS:
+            key = f"{chat}:action:{args[0]}"
+        elif len(args) == 1:
+            key = f"{chat}:target:{audit_user_key(args[0])}"
+        else:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text(MODLOG_USAGE)
+        return
+    
+    await flush_audit()
+    records = await asyncio.get_running_loop().run_in_executor(audit_executor, audit_log.query, key, since)
+    if not records:
+        await update.message.reply_text("📜 No matching moderation actions!")
+        return
+    text = f"📜 <b>Moderation Log</b> (last {len(records)})\n"
+    for record in records:
+        line = "\n" + format_audit(record)
+        if len(text) + len(line) > 4000:
+            break
+        text += line
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+# ==================== WARNINGS ====================
+
+# Used for any field a chat has not set with /warnpolicy; durations in seconds, 0 = forever
+WARN_POLICY = {"limit": 3, "action": "ban", "duration": 0, "expiry": 0}
+WARN_ACTIONS = ("ban", "mute", "kick")
+WARN_REASON_MAX = 200
+WARN_LIMIT_MAX = 20
+# How often the expirer looks for due expiry index buckets
+WARN_SWEEP_INTERVAL = 60
+# Expiring warnings are indexed in hourly "warnexp:<hour>" hashes of "<chat_id>:<user_id>" fields
+WARN_BUCKET_SECONDS = 3600
+
+DURATION = re.compile(r"(\d+)([mhd])$")
+DURATION_SECONDS = {"m": 60, "h": 3600, "d": 86400}
+WARN_POLICY_USAGE = (
+    "❌ Usage: /warnpolicy limit <N> | action ban|mute|kick [<N>m|h|d] | expire <N>m|h|d|off"
+)
+
+# (bucket end, chat_id, user_id, bucket key) per indexed warning, soonest first
+warn_queue = []
+# (chat_id, user_id) -> lock held while a user's warning list is read and rewritten. Chats are
+# owned by one worker, so a lock in that worker serializes every writer of the list.
+warn_locks = weakref.WeakValueDictionary()
+
+def warn_lock(chat_id, user_id):
+    key = (str(chat_id), str(user_id))
+    lock = warn_locks.get(key)
+    if lock is None:
+        lock = warn_locks[key] = asyncio.Lock()
+    return lock
+
+def parse_duration(text):
+    """Seconds in "30m", "12h" or "7d", or None"""
+    match = DURATION.match(text.lower())
+    return int(match.group(1)) * DURATION_SECONDS[match.group(2)] if match else None
+
+def format_duration(seconds):
+    for unit, size in (("d", 86400), ("h", 3600)):
+        if seconds % size == 0:
+            return f"{seconds // size}{unit}"
+    return f"{max(1, seconds // 60)}m"
+
+def warn_policy(chat_id):
+    return {**WARN_POLICY, **settings[chat_id].get("warn_policy", {})}
+
+def active_warnings(raw, now):
+    """Unexpired warnings in a stored field, each [warned at, expires at or 0, reason, admin id]"""
+    if raw is None:
+        return []
+    # Bare counts from before warnings had reasons or expiry
+    if raw.isdigit():
+        return [[0, 0, None, None] for _ in range(int(raw))]
+    return [w for w in json.loads(raw) if not w[1] or w[1] > now]
+
+async def get_warnings(chat_id, user_id):
+    return active_warnings(await state.hget(doc_key("warnings", chat_id), str(user_id)), time.time())
+
+async def save_warnings(chat_id, user_id, warnings):
+    if warnings:
+        await state.hset(doc_key("warnings", chat_id), {str(user_id): json.dumps(warnings)})
+    else:
+        await state.hdel(doc_key("warnings", chat_id), str(user_id))
+
+async def index_warning(chat_id, user_id, expires):
+    """Add an expiring warning to the time-ordered expiry index"""
+    bucket = int(expires) // WARN_BUCKET_SECONDS
+    key = f"warnexp:{bucket}"
+    await state.hset(key, {f"{chat_id}:{user_id}": 1})
+    heapq.heappush(warn_queue, ((bucket + 1) * WARN_BUCKET_SECONDS, str(chat_id), str(user_id), key))
+
+async def index_chat_warnings(chat_id):
+    """Index the expiring warnings of a chat whose warnings were replaced wholesale"""
+    now = time.time()
+    for user_id, raw in (await state.hgetall(doc_key("warnings", chat_id))).items():
+        for expires in {w[1] for w in active_warnings(raw, now) if w[1]}:
+            await index_warning(chat_id, user_id, expires)
+
+async def load_warn_index():
+    """Queue the indexed warnings of chats this worker owns"""
+    for key in await state.keys("warnexp:"):
+        due = (int(key.split(":", 1)[1]) + 1) * WARN_BUCKET_SECONDS
+        for field in await state.hgetall(key):
+            chat_id, user_id = field.rsplit(":", 1)
+            if shard_index is None or shard_for(chat_id, shard_count) == shard_index:
+                heapq.heappush(warn_queue, (due, chat_id, user_id, key))
+
+async def expire_warnings(now):
+    """Drop the warnings in every due bucket; nothing else is read"""
+    while warn_queue and warn_queue[0][0] <= now:
+        _, chat_id, user_id, key = heapq.heappop(warn_queue)
+        async with warn_lock(chat_id, user_id):
+            raw = await state.hget(doc_key("warnings", chat_id), user_id)
+            if raw is not None and not raw.isdigit():
+                stored = json.loads(raw)
+                active = active_warnings(raw, now)
+                if len(active) < len(stored):
+                    await save_warnings(chat_id, user_id, active)
+        await state.hdel(key, f"{chat_id}:{user_id}")
+
+async def warn_expirer():
+    """Background task removing expired warnings"""
+    while True:
+        await asyncio.sleep(WARN_SWEEP_INTERVAL)
+        try:
+            await expire_warnings(time.time())
+        except Exception as e:
+            logger.error("Error expiring warnings: %s", e)
+
+async def apply_warn_action(bot, chat_id, user_id, policy):
+    until = datetime.now(timezone.utc) + timedelta(seconds=policy["duration"]) if policy["duration"] else None
+    if policy["action"] == "mute":
+        await bot.restrict_chat_member(int(chat_id), user_id, ChatPermissions(can_send_messages=False), until_date=until)
+    elif policy["action"] == "kick":
+        await bot.ban_chat_member(int(chat_id), user_id)
+        await bot.unban_chat_member(int(chat_id), user_id)
+    else:
+        await bot.ban_chat_member(int(chat_id), user_id, until_date=until)
+
+async def add_warning(bot, chat_id, target, actor=None, reason=None):
+    """Warn a user and apply the chat's policy once the limit is reached.
+
+    Returns the number of active warnings and the policy; the user's
+    warnings are cleared after the policy action succeeds.
+    """
+    chat_id = str(chat_id)
+    user_id = target if isinstance(target, int) else target.id
+    policy = warn_policy(chat_id)
+    now = int(time.time())
+    expires = now + policy["expiry"] if policy["expiry"] else 0
+    # Held through the policy action, so no warning added meanwhile is cleared with the rest
+    async with warn_lock(chat_id, user_id):
+        warnings = await get_warnings(chat_id, user_id)
+        warnings.append([now, expires, reason, actor.id if actor else None])
+        await save_warnings(chat_id, user_id, warnings)
+        if expires:
+            await index_warning(chat_id, user_id, expires)
+        count = len(warnings)
+        audit(chat_id, "warn", target, actor, reason=f"{count}/{policy['limit']}" + (f": {reason}" if reason else ""))
+        
+        if count >= policy["limit"]:
+            await apply_warn_action(bot, chat_id, user_id, policy)
+            audit(chat_id, policy["action"], target, actor, reason=f"{count} warnings")
+            await save_warnings(chat_id, user_id, [])
+    return count, policy
+
+def describe_warn_action(policy):
+    verb = {"ban": "banned", "mute": "muted", "kick": "kicked"}[policy["action"]]
+    if policy["duration"] and policy["action"] != "kick":
+        verb += f" for {format_duration(policy['duration'])}"
+    return verb
+
+async def warn_target(update, context):
+    """The replied user, an id or @username argument, or the caller; None if unknown"""
+    message = update.message
+    if message.reply_to_message:
+        return message.reply_to_message.from_user.id, message.reply_to_message.from_user.first_name
+    if context.args:
+        arg = context.args[0]
+        user_id = int(arg) if arg.lstrip("-").isdigit() else await resolve_username(context.bot, update.effective_chat.id, arg)
+        return (user_id, arg) if user_id is not None else (None, arg)
+    return update.effective_user.id, update.effective_user.first_name
+
+async def list_warnings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show a user's active warnings with reasons"""
+    chat_id = str(update.effective_chat.id)
+    user_id, name = await warn_target(update, context)
+    if user_id is None:
+        await update.message.reply_text(f"❌ Unknown user {name}!")
+        return
+    warnings = await get_warnings(chat_id, user_id)
+    if not warnings:
+        await update.message.reply_text(f"✅ {html.escape(name)} has no warnings!", parse_mode=ParseMode.HTML)
+        return
+    
+    policy = warn_policy(chat_id)
+    now = time.time()
+    text = f"⚠️ <b>{html.escape(name)}</b>: {len(warnings)}/{policy['limit']} warnings\n"
+    for n, (warned_at, expires, reason, _) in enumerate(warnings, 1):
+        text += f"\n{n}. {html.escape(reason) if reason else '<i>no reason</i>'}"
+        if warned_at:
+            text += f" · {datetime.fromtimestamp(warned_at, timezone.utc):%Y-%m-%d}"
+        if expires:
+            text += f" · expires in {format_duration(round((expires - now) / 60) * 60)}"
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+async def set_warn_policy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or change the chat's warning limit, action and expiry"""
+    if not await is_admin(update, context):
+        return
+    
+    chat_id = str(update.effective_chat.id)
+    args = [a.lower() for a in context.args]
+    policy = warn_policy(chat_id)
+    
+    if not args:
+        expiry = format_duration(policy["expiry"]) if policy["expiry"] else "never"
+        await update.message.reply_text(
+            f"⚠️ <b>Warn Policy</b>\n\n"
+            f"Limit: {policy['limit']} warnings\n"
+            f"Then: {describe_warn_action(policy)}\n"
+            f"Warnings expire: {expiry}",
+            parse_mode=ParseMode.HTML
+        )
+        return
+    
+    field, values = args[0], args[1:]
+    if field == "limit" and len(values) == 1 and values[0].isdigit() and 1 <= int(values[0]) <= WARN_LIMIT_MAX:
+        policy["limit"] = int(values[0])
+    elif field == "action" and len(values) in (1, 2) and values[0] in WARN_ACTIONS:
+        duration = parse_duration(values[1]) if len(values) == 2 else 0
+        if duration is None:
+            await update.message.reply_text(WARN_POLICY_USAGE)
+            return
+        policy["action"], policy["duration"] = values[0], duration
+    elif field == "expire" and len(values) == 1 and (values[0] == "off" or parse_duration(values[0])):
+        policy["expiry"] = 0 if values[0] == "off" else parse_duration(values[0])
+    else:
+        await update.message.reply_text(WARN_POLICY_USAGE)
+        return
+    await set_setting(chat_id, "warn_policy", policy)
+    await update.message.reply_text("✅ Warn policy updated!")
+
+# ==================== BULK MODERATION ====================
+
+# Bulk jobs make at most BULK_RATE calls per second with BULK_CONCURRENCY in flight
+BULK_RATE = 20
+BULK_CONCURRENCY = 5
+# How often a running job edits its status message
+BULK_PROGRESS_INTERVAL = 3
+BULK_MAX_TARGETS = 10000
+BULK_FILE_MAX_BYTES = 1024 * 1024
+# Joins remembered per chat for "joined <N>m" targets
+JOIN_HISTORY = 5000
+USERNAME_CACHE_SIZE = 100000
+# Stored usernames expire unless seen again; a sighting refreshes the TTL at most daily
+USERNAME_TTL = 30 * 24 * 3600
+USERNAME_REFRESH = 24 * 3600
+
+BULK_TOKEN = re.compile(r"@?\w+")
+JOINED_SPAN = re.compile(r"(\d+)([mh]?)$")
+
+# username -> (user id, time stored), learned from messages and persisted as "username:<name>"
+known_usernames = OrderedDict()
+# chat_id -> (join time, user_id) of recent joins
+recent_joins = defaultdict(lambda: deque(maxlen=JOIN_HISTORY))
+# chat_id -> running bulk moderation job
+bulk_jobs = {}
+
+class RateGate:
+    """Spaces calls evenly at `rate` per second across concurrent workers; a flood wait pauses all of them"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_call = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        at = max(self.next_call, now)
+        self.next_call = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    def pause(self, seconds):
+        self.next_call = max(self.next_call, time.monotonic() + seconds)
+
+def retry_seconds(error):
+    retry = error.retry_after
+    return retry.total_seconds() if isinstance(retry, timedelta) else retry
+
+async def run_bulk(items, action, status, verb, rate=BULK_RATE, concurrency=BULK_CONCURRENCY):
+    """Run action(item) for every item, paced and bounded, editing `status` with progress.
+
+    Returns the number of successes and a Counter of failure reasons.
+    """
+    gate = RateGate(rate)
+    pending = iter(items)
+    done, failures = 0, Counter()
 
-# ==================== SECURITY & PROTECTION ====================
+    async def worker():
+        nonlocal done
+        for item in pending:
+            while True:
+                await gate.wait()
+                try:
+                    await action(item)
+                    done += 1
+                except RetryAfter as e:
+                    gate.pause(retry_seconds(e))
+                    continue
+                except Exception as e:
+                    failures[str(e) or type(e).__name__] += 1
+                    logger.error("%s %s failed: %s", verb, item, e)
+                break
 
-async def anti_channel_protection(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Prevents channel messages and deletes them"""
-    message = update.message or update.edited_message
-    if message and message.sender_chat and message.sender_chat.type == "channel":
-        chat_id = message.chat.id
-        if settings[str(chat_id)].get("channel_protection", True):
+    async def reporter():
+        reported = None
+        while True:
+            await asyncio.sleep(BULK_PROGRESS_INTERVAL)
+            text = f"⏳ {verb}: {done + sum(failures.values())}/{len(items)}"
+            if text == reported:
+                continue
             try:
-                await message.delete()
-                await context.bot.send_message(
-                    chat_id,
-                    "⚠️ Channel messages are not allowed in this group!",
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception as e:
-                logger.error(f"Error deleting channel message: {e}")
+                await status.edit_text(text)
+                reported = text
+            except Exception:
+                pass
 
-async def anti_id_exposure(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Protects user IDs from being exposed"""
-    message = update.message
-    if message and message.forward_from:
-        chat_id = message.chat.id
-        if settings[str(chat_id)].get("id_protection", True):
-            try:
-                await message.delete()
-                await context.bot.send_message(
-                    chat_id,
-                    "🔒 Forwarded messages that expose user IDs are not allowed!",
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception as e:
-                logger.error(f"Error in ID protection: {e}")
+    progress = asyncio.ensure_future(reporter())
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(items))))))
+    finally:
+        progress.cancel()
+    return done, failures
 
-# ==================== ADMIN COMMANDS ====================
+def bulk_summary(done_verb, done, total, failures, what="users"):
+    text = f"✅ {done_verb} {done}/{total} {what}"
+    if failures:
+        text += f"\n❌ {sum(failures.values())} failed:"
+        for reason, count in failures.most_common(3):
+            text += f"\n• {reason} ({count})"
+    return text
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Start command with beautiful UI"""
-    keyboard = [
-        [InlineKeyboardButton("➕ Add to Group", url=f"https://t.me/{context.bot.username}?startgroup=true")],
-        [InlineKeyboardButton("📚 Commands", callback_data="help"), 
-         InlineKeyboardButton("⚙️ Features", callback_data="features")],
-        [InlineKeyboardButton("👨‍💻 Developer", url="https://t.me/narzoxbot")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    text = """
-🤖 <b>Advanced Group Manager Bot</b>
+async def remember_user(user):
+    """Learn a user's @username so bulk commands can target them by name"""
+    if not user or not user.username:
+        return
+    name = user.username.lower()
+    now = time.time()
+    known = known_usernames.get(name)
+    if known and known[0] == user.id and now - known[1] < USERNAME_REFRESH:
+        known_usernames.move_to_end(name)
+        return
+    known_usernames[name] = (user.id, now)
+    known_usernames.move_to_end(name)
+    if len(known_usernames) > USERNAME_CACHE_SIZE:
+        known_usernames.popitem(last=False)
+    await state.set(f"username:{name}", str(user.id), ttl=USERNAME_TTL)
 
-Welcome! I'm a powerful bot with 100+ features for managing your groups.
+async def resolve_username(bot, chat_id, name):
+    """User id of an @username, confirmed with Telegram to still belong to that user; None if unknown"""
+    name = name.lower().lstrip("@")
+    known = known_usernames.get(name)
+    if known:
+        user_id = known[0]
+    else:
+        stored = await state.get(f"username:{name}")
+        if not stored:
+            return None
+        user_id = int(stored)
+    # Usernames can pass to another account; the remembered one may no longer hold it
+    try:
+        member = await bot.get_chat_member(chat_id, user_id)
+    except RetryAfter:
+        raise
+    except Exception:
+        return None
+    if (member.user.username or "").lower() != name:
+        known_usernames.pop(name, None)
+        await state.delete(f"username:{name}")
+        return None
+    return user_id
 
-<b>Key Features:</b>
-✅ Advanced Admin Tools
-✅ Anti-Spam & Raid Protection
-✅ Welcome Messages & Captcha
-✅ Content Filters & Blacklist
-✅ Fun Commands & Games
-✅ Statistics & Analytics
-✅ Auto-Moderation
-✅ Channel & ID Protection
-✅ And much more!
+async def track_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Record usernames, joins, leaves and last-seen times for bulk targeting and /tagall"""
+    message = update.message
+    if not message:
+        return
+    chat_id = str(message.chat.id)
+    when = message.date.timestamp()
+    await remember_user(message.from_user)
+    if message.left_chat_member:
+        await member_left(chat_id, message.left_chat_member)
+    elif message.new_chat_members:
+        joins = recent_joins[message.chat.id]
+        for member in message.new_chat_members:
+            joins.append((when, member.id))
+            await remember_user(member)
+            await member_seen(chat_id, member, when)
+    else:
+        await member_seen(chat_id, message.from_user, when)
 
-Click below to explore all features! 🚀
+async def bulk_targets(message, args):
+    """Targets named by ids, @usernames, "joined <N>m|h" and a replied file.
+
+    Ids are ints; @usernames are kept as strings for the job to resolve.
     """
+    tokens = list(args)
+    reply = message.reply_to_message
+    if reply:
+        # Only "file" in reply to a plain text list posted by an admin reads targets from a file
+        tokens = tokens[1:]
+        document = reply.document
+        if not document or document.mime_type != "text/plain":
+            raise ValueError("reply to a plain text file of ids")
+        if not reply.from_user:
+            raise ValueError("the file must be posted by an admin")
+        member = await message.get_bot().get_chat_member(message.chat.id, reply.from_user.id)
+        if member.status not in ("creator", "administrator"):
+            raise ValueError("the file must be posted by an admin")
+        if document.file_size and document.file_size > BULK_FILE_MAX_BYTES:
+            raise ValueError("file too large")
+        file = await message.get_bot().get_file(document.file_id)
+        tokens += BULK_TOKEN.findall(bytes(await file.download_as_bytearray()).decode("utf-8", "replace"))
     
-    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    targets = {}
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token.lower() == "joined" and i + 1 < len(tokens) and JOINED_SPAN.match(tokens[i + 1].lower()):
+            amount, unit = JOINED_SPAN.match(tokens[i + 1].lower()).groups()
+            since = time.time() - int(amount) * (3600 if unit == "h" else 60)
+            for joined_at, user_id in recent_joins[message.chat.id]:
+                if joined_at >= since:
+                    targets[user_id] = None
+            i += 2
+            continue
+        if token.lstrip("-").isdigit():
+            targets[int(token)] = None
+        elif token.startswith("@"):
+            targets[token.lower()] = None
+        else:
+            raise ValueError(f"can't read {token!r}")
+        i += 1
+    return list(targets)
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Comprehensive help menu"""
-    keyboard = [
-        [InlineKeyboardButton("👮 Admin", callback_data="help_admin"),
-         InlineKeyboardButton("🛡️ Security", callback_data="help_security")],
-        [InlineKeyboardButton("💬 Chat", callback_data="help_chat"),
-         InlineKeyboardButton("🎮 Fun", callback_data="help_fun")],
-        [InlineKeyboardButton("📊 Stats", callback_data="help_stats"),
-         InlineKeyboardButton("⚙️ Settings", callback_data="help_settings")],
-        [InlineKeyboardButton("🔍 Search", callback_data="help_search"),
-         InlineKeyboardButton("🎯 Misc", callback_data="help_misc")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    text = """
-📚 <b>Bot Commands Menu</b>
+async def bulk_action(bot, chat_id, action, user_id, actor):
+    """Apply one moderation action to one user; raises on failure"""
+    if action == "ban":
+        await bot.ban_chat_member(chat_id, user_id)
+    elif action == "unban":
+        await bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+    elif action == "kick":
+        await bot.ban_chat_member(chat_id, user_id)
+        await bot.unban_chat_member(chat_id, user_id)
+    elif action == "mute":
+        await bot.restrict_chat_member(chat_id, user_id, ChatPermissions(can_send_messages=False))
+    elif action == "warn":
+        await add_warning(bot, chat_id, user_id, actor, reason="bulk")
 
-Select a category to see available commands:
+BULK_VERBS = {
+    "ban": ("Banning", "Banned"), "unban": ("Unbanning", "Unbanned"), "kick": ("Kicking", "Kicked"),
+    "mute": ("Muting", "Muted"), "warn": ("Warning", "Warned"),
+}
 
-👮 <b>Admin</b> - Moderation & management
-🛡️ <b>Security</b> - Protection features
-💬 <b>Chat</b> - Group utilities
-🎮 <b>Fun</b> - Entertainment commands
-📊 <b>Stats</b> - Analytics & insights
-⚙️ <b>Settings</b> - Bot configuration
-🔍 <b>Search</b> - Find information
-🎯 <b>Misc</b> - Other useful commands
-    """
-    
-    if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-    else:
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+async def run_bulk_moderation(bot, chat_id, action, targets, actor, status):
+    verb, done_verb = BULK_VERBS[action]
+    try:
+        # Admins and the bot itself are never targets
+        admins = {member.user.id for member in await bot.get_chat_administrators(chat_id)} | {bot.id}
+        users = [target for target in targets if target not in admins]
+        acted = set()
+
+        async def apply(target):
+            user_id = target
+            if isinstance(target, str):
+                # Resolving a name costs a getChatMember call, so it is paced like the actions
+                user_id = await resolve_username(bot, chat_id, target)
+                if user_id is None:
+                    raise LookupError("unknown username")
+                if user_id in admins:
+                    raise LookupError("user is an admin")
+            if user_id in acted:
+                return
+            acted.add(user_id)
+            await bulk_action(bot, chat_id, action, user_id, actor)
+            # Warnings are logged by add_warning, with the policy action they trigger
+            if action != "warn":
+                audit(chat_id, action, user_id, actor, reason="bulk")
+
+        done, failures = await run_bulk(users, apply, status, verb)
+        logger.info("Bulk %s: %d/%d users", action, done, len(users), extra={"chat_id": chat_id})
+        text = bulk_summary(done_verb, done, len(users), failures)
+        if len(users) < len(targets):
+            text += f"\n⏭ Skipped {len(targets) - len(users)} admins"
+        await status.edit_text(text)
+    except Exception as e:
+        logger.error("Bulk %s failed: %s", action, e, extra={"chat_id": chat_id})
+        try:
+            await status.edit_text(f"❌ Bulk {action} stopped: {e}")
+        except Exception:
+            pass
+    finally:
+        if bulk_jobs.get(chat_id) is asyncio.current_task():
+            del bulk_jobs[chat_id]
+
+def is_bulk_request(message, args):
+    """Targets given as arguments, or "file" in reply to a list of ids, rather than a replied message"""
+    if message.reply_to_message:
+        return bool(args) and args[0].lower() == "file"
+    return bool(args)
+
+async def start_bulk_moderation(update: Update, context: ContextTypes.DEFAULT_TYPE, action):
+    """Parse the targets of a bulk command and run it as a background job"""
+    chat_id = update.effective_chat.id
+    if chat_id in bulk_jobs:
+        await update.message.reply_text("❌ A bulk job is already running in this chat!")
+        return
+    try:
+        targets = await bulk_targets(update.message, context.args)
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ {e}\nUsage: /{action} <ids or @usernames> | joined <N>m | /{action} file in reply to a file of ids"
+        )
+        return
+    if len(targets) > BULK_MAX_TARGETS:
+        await update.message.reply_text(f"❌ At most {BULK_MAX_TARGETS} users per job!")
+        return
+    if not targets:
+        await update.message.reply_text("❌ No users to act on!")
+        return
+    status = await update.message.reply_text(f"⏳ {BULK_VERBS[action][0]}: 0/{len(targets)}")
+    bulk_jobs[chat_id] = context.application.create_task(
+        run_bulk_moderation(context.bot, chat_id, action, targets, update.effective_user, status)
+    )
 
 # ==================== MODERATION COMMANDS ====================
 
@@ -174,12 +1884,17 @@ async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
         return
     
+    if is_bulk_request(update.message, context.args):
+        await start_bulk_moderation(update, context, "ban")
+        return
+    
     if update.message.reply_to_message:
         user_id = update.message.reply_to_message.from_user.id
         user_name = update.message.reply_to_message.from_user.first_name
         
         try:
             await context.bot.ban_chat_member(update.effective_chat.id, user_id)
+            audit(update.effective_chat.id, "ban", update.message.reply_to_message.from_user, update.effective_user)
             await update.message.reply_text(
                 f"🚫 <b>{user_name}</b> has been banned from the group!",
                 parse_mode=ParseMode.HTML
@@ -194,13 +1909,16 @@ async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
         return
     
-    if context.args:
+    if len(context.args) == 1 and context.args[0].lstrip("-").isdigit() and not update.message.reply_to_message:
         user_id = int(context.args[0])
         try:
             await context.bot.unban_chat_member(update.effective_chat.id, user_id)
+            audit(update.effective_chat.id, "unban", user_id, update.effective_user)
             await update.message.reply_text(f"✅ User unbanned successfully!")
         except Exception as e:
             await update.message.reply_text(f"❌ Error: {e}")
+    elif is_bulk_request(update.message, context.args):
+        await start_bulk_moderation(update, context, "unban")
     else:
         await update.message.reply_text("❌ Usage: /unban <user_id>")
 
@@ -209,6 +1927,10 @@ async def kick(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
         return
     
+    if is_bulk_request(update.message, context.args):
+        await start_bulk_moderation(update, context, "kick")
+        return
+    
     if update.message.reply_to_message:
         user_id = update.message.reply_to_message.from_user.id
         user_name = update.message.reply_to_message.from_user.first_name
@@ -216,6 +1938,7 @@ async def kick(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             await context.bot.ban_chat_member(update.effective_chat.id, user_id)
             await context.bot.unban_chat_member(update.effective_chat.id, user_id)
+            audit(update.effective_chat.id, "kick", update.message.reply_to_message.from_user, update.effective_user)
             await update.message.reply_text(
                 f"👢 <b>{user_name}</b> has been kicked from the group!",
                 parse_mode=ParseMode.HTML
@@ -228,6 +1951,10 @@ async def mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
         return
     
+    if is_bulk_request(update.message, context.args):
+        await start_bulk_moderation(update, context, "mute")
+        return
+    
     if update.message.reply_to_message:
         user_id = update.message.reply_to_message.from_user.id
         user_name = update.message.reply_to_message.from_user.first_name
@@ -240,6 +1967,7 @@ async def mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 user_id,
                 permissions
             )
+            audit(update.effective_chat.id, "mute", update.message.reply_to_message.from_user, update.effective_user)
             await update.message.reply_text(
                 f"🔇 <b>{user_name}</b> has been muted!",
                 parse_mode=ParseMode.HTML
@@ -270,6 +1998,7 @@ async def unmute(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 user_id,
                 permissions
             )
+            audit(update.effective_chat.id, "unmute", update.message.reply_to_message.from_user, update.effective_user)
             await update.message.reply_text(
                 f"🔊 <b>{user_name}</b> has been unmuted!",
                 parse_mode=ParseMode.HTML
@@ -278,36 +2007,33 @@ async def unmute(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"❌ Error: {e}")
 
 async def warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Warn user (3 warns = ban)"""
+    """Warn user, applying the chat's warn policy at its limit"""
     if not await is_admin(update, context):
         return
     
+    if is_bulk_request(update.message, context.args):
+        await start_bulk_moderation(update, context, "warn")
+        return
+    
     if update.message.reply_to_message:
-        chat_id = str(update.effective_chat.id)
-        user_id = update.message.reply_to_message.from_user.id
-        user_name = update.message.reply_to_message.from_user.first_name
-        
-        warnings[chat_id][str(user_id)] += 1
-        warn_count = warnings[chat_id][str(user_id)]
+        target = update.message.reply_to_message.from_user
+        reason = " ".join(context.args)[:WARN_REASON_MAX] or None
         
-        save_data(WARNINGS_FILE, warnings)
-        
-        if warn_count >= 3:
-            try:
-                await context.bot.ban_chat_member(update.effective_chat.id, user_id)
-                await update.message.reply_text(
-                    f"⚠️ <b>{user_name}</b> has been banned after receiving 3 warnings!",
-                    parse_mode=ParseMode.HTML
-                )
-                warnings[chat_id][str(user_id)] = 0
-                save_data(WARNINGS_FILE, warnings)
-            except Exception as e:
-                await update.message.reply_text(f"❌ Error: {e}")
-        else:
+        try:
+            count, policy = await add_warning(context.bot, update.effective_chat.id, target, update.effective_user, reason)
+        except Exception as e:
+            await update.message.reply_text(f"❌ Error: {e}")
+            return
+        if count >= policy["limit"]:
             await update.message.reply_text(
-                f"⚠️ <b>{user_name}</b> warned! ({warn_count}/3)",
+                f"⚠️ <b>{target.first_name}</b> has been {describe_warn_action(policy)} after receiving {count} warnings!",
                 parse_mode=ParseMode.HTML
             )
+        else:
+            text = f"⚠️ <b>{target.first_name}</b> warned! ({count}/{policy['limit']})"
+            if reason:
+                text += f"\nReason: {html.escape(reason)}"
+            await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
 async def remove_warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Remove warnings"""
@@ -316,11 +2042,14 @@ async def remove_warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if update.message.reply_to_message:
         chat_id = str(update.effective_chat.id)
-        user_id = str(update.message.reply_to_message.from_user.id)
+        user_id = update.message.reply_to_message.from_user.id
         
-        if user_id in warnings[chat_id]:
-            warnings[chat_id][user_id] = 0
-            save_data(WARNINGS_FILE, warnings)
+        async with warn_lock(chat_id, user_id):
+            removed = bool(await get_warnings(chat_id, user_id))
+            if removed:
+                await save_warnings(chat_id, user_id, [])
+        if removed:
+            audit(chat_id, "unwarn", update.message.reply_to_message.from_user, update.effective_user)
             await update.message.reply_text("✅ Warnings removed!")
         else:
             await update.message.reply_text("❌ User has no warnings!")
@@ -368,9 +2097,8 @@ async def purge(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except:
                 pass
         
-        msg = await update.message.reply_text(f"🗑️ Deleted {deleted} messages!")
-        await asyncio.sleep(3)
-        await msg.delete()
+        audit(update.effective_chat.id, "purge", actor=update.effective_user, count=deleted)
+        await post_notice(context.bot, update.effective_chat.id, f"🗑️ Deleted {deleted} messages!", ttl=3)
 
 async def del_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Delete a message"""
@@ -381,6 +2109,7 @@ async def del_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             await update.message.reply_to_message.delete()
             await update.message.delete()
+            audit(update.effective_chat.id, "delete", update.message.reply_to_message.from_user, update.effective_user)
         except Exception as e:
             await update.message.reply_text(f"❌ Error: {e}")
 
@@ -397,7 +2126,7 @@ async def add_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         if word not in word_filters[chat_id]:
             word_filters[chat_id].append(word)
-            save_data(FILTERS_FILE, word_filters)
+            await save_chat("filters", chat_id)
             await update.message.reply_text(f"✅ Filter added: <code>{word}</code>", parse_mode=ParseMode.HTML)
         else:
             await update.message.reply_text("❌ Filter already exists!")
@@ -415,7 +2144,7 @@ async def remove_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         if word in word_filters[chat_id]:
             word_filters[chat_id].remove(word)
-            save_data(FILTERS_FILE, word_filters)
+            await save_chat("filters", chat_id)
             await update.message.reply_text(f"✅ Filter removed: <code>{word}</code>", parse_mode=ParseMode.HTML)
         else:
             await update.message.reply_text("❌ Filter not found!")
@@ -444,125 +2173,996 @@ async def check_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
         for word in word_filters[chat_id]:
             if word in message_text:
                 try:
-                    await update.message.delete()
-                    await context.bot.send_message(
-                        chat_id,
-                        f"⚠️ Message deleted: Contains filtered word!"
-                    )
+                    await delete_message(context.bot, update.message)
+                    audit(chat_id, "filter", update.message.from_user, reason=word)
+                    await post_notice(context.bot, chat_id, "⚠️ Message deleted: Contains filtered word!")
                     return
                 except:
                     pass
 
+# ==================== LINK PROTECTION ====================
+
+# Hosts serving Telegram links; /+hash and /joinchat/hash paths are group invites
+TELEGRAM_LINK_HOSTS = {"t.me", "telegram.me", "telegram.dog"}
+LINK_ENTITY_TYPES = [MessageEntity.URL, MessageEntity.TEXT_LINK, MessageEntity.MENTION]
+
+# Compiled per-chat rules, rebuilt when the chat's "links" document changes
+link_tries = {}
+
+class DomainTrie:
+    """Domain rules keyed by reversed labels: com -> example -> www.
+
+    "example.com" matches that host only, "*.example.com" also matches
+    every subdomain. The most specific matching rule wins, so a lookup
+    costs one step per label of the host however many rules there are.
+    """
+
+    __slots__ = ("root",)
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, rule, verdict):
+        labels = rule.split(".")
+        wildcard = labels[0] == "*"
+        node = self.root
+        for label in reversed(labels[1:] if wildcard else labels):
+            node = node.setdefault(label, {})
+        node["*" if wildcard else "="] = verdict
+
+    def match(self, labels):
+        """Verdict of the most specific rule matching reversed host labels, or None"""
+        node, verdict = self.root, None
+        for label in labels:
+            node = node.get(label)
+            if node is None:
+                return verdict
+            verdict = node.get("*", verdict)
+        return node.get("=", verdict)
+
+def normalize_domain(rule):
+    """Lowercase a domain rule, dropping schemes, paths and trailing dots"""
+    rule = rule.strip().lower()
+    if "://" in rule:
+        rule = urlsplit(rule).hostname or ""
+    return rule.split("/", 1)[0].rstrip(".")
+
+def compile_link_rules(rules):
+    """Build the trie for a chat's allow/deny lists; deny wins on equal rules"""
+    trie = DomainTrie()
+    mentions = {}
+    for verdict in ("allow", "deny"):
+        for rule in rules.get(verdict, []):
+            if rule.startswith("@"):
+                mentions[rule[1:]] = verdict
+            else:
+                trie.add(rule, verdict)
+    return trie, mentions
+
+def get_link_rules(chat_id):
+    compiled = link_tries.get(chat_id)
+    if compiled is None:
+        compiled = link_tries[chat_id] = compile_link_rules(link_rules[chat_id])
+    return compiled
+
+def parse_link(url):
+    """(host labels reversed, is_invite) of a URL, or None if it has no host"""
+    if url.startswith("tg://"):
+        return ["tg"], url.startswith("tg://join")
+    parts = urlsplit(url if "://" in url else f"http://{url}")
+    host = (parts.hostname or "").rstrip(".")
+    if not host:
+        return None
+    invite = host in TELEGRAM_LINK_HOSTS and parts.path.startswith(("/+", "/joinchat/"))
+    return host.split(".")[::-1], invite
+
+def extract_links(message):
+    """URLs and @mentions from a message's text and caption entities, in one pass"""
+    entities = message.parse_entities(LINK_ENTITY_TYPES) or message.parse_caption_entities(LINK_ENTITY_TYPES)
+    for entity, text in entities.items():
+        if entity.type == MessageEntity.MENTION:
+            yield "mention", text[1:].lower()
+        else:
+            yield "url", entity.url if entity.type == MessageEntity.TEXT_LINK else text
+
+def link_violation(chat_id, message):
+    """Reason the message breaks the chat's link rules, or None"""
+    protected = settings[chat_id].get("link_protection", False)
+    trie, mentions = get_link_rules(chat_id)
+    for kind, value in extract_links(message):
+        if kind == "mention":
+            if mentions.get(value) == "deny":
+                return f"@{value} is not allowed"
+            continue
+        parsed = parse_link(value)
+        if parsed is None:
+            continue
+        labels, invite = parsed
+        if protected and invite:
+            return "invite links are not allowed"
+        verdict = trie.match(labels)
+        if verdict == "deny" or (protected and verdict != "allow"):
+            return f"links to {'.'.join(reversed(labels))} are not allowed"
+    return None
+
+async def check_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Delete messages whose links or mentions break the chat's link rules"""
+    message = update.message or update.edited_message
+    # Anonymous admins post as the group itself
+    if not message or not message.from_user or (message.sender_chat and message.sender_chat.id == message.chat.id):
+        return
+    chat_id = str(message.chat.id)
+    rules = link_rules.get(chat_id)
+    if not settings[chat_id].get("link_protection", False) and not (rules and rules.get("deny")):
+        return
+    
+    reason = link_violation(chat_id, message)
+    if reason is None:
+        return
+    try:
+        # Admins may post anything; only checked once a message would be deleted
+        member = await context.bot.get_chat_member(message.chat.id, message.from_user.id)
+        if member.status in ("creator", "administrator"):
+            return
+        await delete_message(context.bot, message)
+        audit(chat_id, "link", message.from_user, reason=reason)
+        await post_notice(context.bot, chat_id, f"🔗 Message deleted: {reason}!")
+    except Exception as e:
+        logger.error("Error deleting link message: %s", e, extra={"chat_id": chat_id})
+
+LINK_FILTER_USAGE = (
+    "❌ Usage: /linkfilter on|off, /linkfilter allow|deny <domain or @username>, "
+    "/linkfilter remove <rule>\nUse *.example.com to include subdomains."
+)
+
+async def link_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or change the link filter and its allow/deny rules"""
+    if not await is_admin(update, context):
+        return
+    
+    chat_id = str(update.effective_chat.id)
+    rules = link_rules[chat_id]
+    args = context.args
+    
+    if not args:
+        status = "✅ on" if settings[chat_id].get("link_protection", False) else "❌ off"
+        text = f"🔗 <b>Link Filter:</b> {status}\n"
+        for verdict, title in (("allow", "Allowed"), ("deny", "Denied")):
+            if rules.get(verdict):
+                text += f"\n<b>{title}:</b>\n" + "\n".join(f"• <code>{html.escape(r)}</code>" for r in rules[verdict])
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+        return
+    
+    action = args[0].lower()
+    if action in ("on", "off") and len(args) == 1:
+        await set_setting(chat_id, "link_protection", action == "on")
+        await update.message.reply_text(f"🔗 Link filter turned {action}!")
+        return
+    if action not in ("allow", "deny", "remove") or len(args) != 2:
+        await update.message.reply_text(LINK_FILTER_USAGE)
+        return
+    
+    rule = args[1].lower() if args[1].startswith("@") else normalize_domain(args[1])
+    if not rule or rule in ("@", "*."):
+        await update.message.reply_text(LINK_FILTER_USAGE)
+        return
+    removed = False
+    for verdict in ("allow", "deny"):
+        if rule in rules.get(verdict, []):
+            rules[verdict].remove(rule)
+            removed = True
+    if action == "remove" and not removed:
+        await update.message.reply_text("❌ No such rule!")
+        return
+    if action != "remove":
+        rules.setdefault(action, []).append(rule)
+    link_tries.pop(chat_id, None)
+    await save_chat("links", chat_id)
+    
+    done = {"allow": "✅ Allowed", "deny": "🚫 Denied", "remove": "🗑 Removed rule"}[action]
+    await update.message.reply_text(f"{done}: <code>{html.escape(rule)}</code>", parse_mode=ParseMode.HTML)
+
+# ==================== MEDIA FILTER ====================
+
+# Message attribute of each filterable media type, in detection order
+# (animations also carry a document, so they are checked first)
+MEDIA_TYPES = ("sticker", "animation", "voice", "video_note", "video", "audio", "photo", "document")
+# Blocklisted images match re-encoded copies up to this many differing hash bits
+MEDIA_HASH_DISTANCE = 6
+MEDIA_HASH_WORKERS = int(os.getenv("MEDIA_HASH_WORKERS", "2"))
+MEDIA_HASH_CACHE_SIZE = 10000
+
+# Compiled per-chat blocklists: (set of file_unique_ids, BKTree of perceptual hashes)
+media_indexes = {}
+# file_unique_id -> 64-bit hash of files hashed successfully
+hash_cache = OrderedDict()
+hash_tasks = {}
+hash_pool = None
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes for Hamming-distance lookups"""
+
+    __slots__ = ("root",)
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, label):
+        node = self.root
+        if node is None:
+            self.root = [value, label, {}]
+            return
+        while True:
+            distance = (value ^ node[0]).bit_count()
+            if distance == 0:
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, label, {}]
+                return
+            node = child
+
+    def find(self, value, max_distance):
+        """Label of some stored hash within max_distance bits, or None"""
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = (value ^ node[0]).bit_count()
+            if distance <= max_distance:
+                return node[1]
+            # Triangle inequality: only these subtrees can hold a match
+            for d in range(distance - max_distance, distance + max_distance + 1):
+                child = node[2].get(d)
+                if child:
+                    stack.append(child)
+        return None
+
+def perceptual_hash(data):
+    """64-bit difference hash of an image; runs in the hash worker pool"""
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+def media_type(message):
+    for kind in MEDIA_TYPES:
+        if getattr(message, kind):
+            return kind
+    return None
+
+def media_file(message, kind):
+    """The message's file identifying it in the blocklist"""
+    media = getattr(message, kind)
+    return media[-1] if kind == "photo" else media
+
+def hash_source(message, kind):
+    """Smallest image representing the media: a dHash needs only 9x8 pixels"""
+    if kind == "photo":
+        return message.photo[0]
+    media = getattr(message, kind)
+    if kind == "sticker" and not (media.is_animated or media.is_video):
+        return media
+    return getattr(media, "thumbnail", None)
+
+def get_media_index(chat_id):
+    index = media_indexes.get(chat_id)
+    if index is None:
+        rules = media_rules[chat_id]
+        tree = BKTree()
+        for unique_id, value in rules.get("hashes", {}).items():
+            tree.add(int(value, 16), unique_id)
+        index = media_indexes[chat_id] = (set(rules.get("blocked", [])), tree)
+    return index
+
+async def compute_media_hash(bot, source):
+    """Download and hash one file in the worker pool; None if that fails"""
+    global hash_pool
+    if hash_pool is None:
+        hash_pool = ProcessPoolExecutor(MEDIA_HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        file = await bot.get_file(source.file_id)
+        data = bytes(await file.download_as_bytearray())
+        return await asyncio.get_running_loop().run_in_executor(hash_pool, perceptual_hash, data)
+    except Exception as e:
+        logger.error("Error hashing media %s: %s", source.file_unique_id, e)
+        return None
+
+async def media_hash(bot, source):
+    """Perceptual hash of a file, computed at most once per file_unique_id"""
+    unique_id = source.file_unique_id
+    if unique_id in hash_cache:
+        hash_cache.move_to_end(unique_id)
+        return hash_cache[unique_id]
+    task = hash_tasks.get(unique_id)
+    if task is None:
+        async def lookup():
+            stored = await state.get(f"phash:{unique_id}")
+            if stored is not None:
+                return int(stored, 16)
+            value = await compute_media_hash(bot, source)
+            if value is not None:
+                await state.set(f"phash:{unique_id}", f"{value:016x}")
+            return value
+        task = hash_tasks[unique_id] = asyncio.ensure_future(lookup())
+    try:
+        value = await task
+    finally:
+        hash_tasks.pop(unique_id, None)
+    # Failures are not cached, so the next copy of the file is hashed again
+    if value is not None:
+        hash_cache[unique_id] = value
+        if len(hash_cache) > MEDIA_HASH_CACHE_SIZE:
+            hash_cache.popitem(last=False)
+    return value
+
+async def media_violation(bot, chat_id, message):
+    """Reason the message's media is blocked in this chat, or None"""
+    kind = media_type(message)
+    if kind is None:
+        return None
+    rules = media_rules[chat_id]
+    if kind in rules.get("types", []):
+        return f"{kind.replace('_', ' ')}s are not allowed"
+    
+    blocked, tree = get_media_index(chat_id)
+    if media_file(message, kind).file_unique_id in blocked:
+        return "this media is blocked"
+    if tree.root is None or Image is None:
+        return None
+    source = hash_source(message, kind)
+    if source is None:
+        return None
+    value = await media_hash(bot, source)
+    if value is not None and tree.find(value, MEDIA_HASH_DISTANCE):
+        return "this media is blocked"
+    return None
+
+async def check_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Delete media of blocked types or on the chat's blocklist"""
+    message = update.message
+    if not message or not message.from_user:
+        return
+    chat_id = str(message.chat.id)
+    if not settings[chat_id].get("media_filter", False):
+        return
+    
+    reason = await media_violation(context.bot, chat_id, message)
+    if reason is None:
+        return
+    try:
+        member = await context.bot.get_chat_member(message.chat.id, message.from_user.id)
+        if member.status in ("creator", "administrator"):
+            return
+        await delete_message(context.bot, message)
+        audit(chat_id, "media", message.from_user, reason=reason)
+        await post_notice(context.bot, chat_id, f"🖼 Message deleted: {reason}!")
+    except Exception as e:
+        logger.error("Error deleting media: %s", e, extra={"chat_id": chat_id})
+
+MEDIA_FILTER_USAGE = (
+    "❌ Usage: /mediafilter on|off, /mediafilter block|unblock <type>, "
+    "or reply to a sticker/image with /mediafilter add|remove\n"
+    f"Types: {', '.join(MEDIA_TYPES)}"
+)
+
+async def media_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or change blocked media types and the media blocklist"""
+    if not await is_admin(update, context):
+        return
+    
+    chat_id = str(update.effective_chat.id)
+    rules = media_rules[chat_id]
+    args = [a.lower() for a in context.args]
+    
+    if not args:
+        status = "✅ on" if settings[chat_id].get("media_filter", False) else "❌ off"
+        types = ", ".join(rules.get("types", [])) or "none"
+        await update.message.reply_text(
+            f"🖼 <b>Media Filter:</b> {status}\n"
+            f"<b>Blocked types:</b> {types}\n"
+            f"<b>Blocked files:</b> {len(rules.get('blocked', []))} "
+            f"({len(rules.get('hashes', {}))} matched by image similarity)",
+            parse_mode=ParseMode.HTML
+        )
+        return
+    
+    action = args[0]
+    if action in ("on", "off") and len(args) == 1:
+        await set_setting(chat_id, "media_filter", action == "on")
+        await update.message.reply_text(f"🖼 Media filter turned {action}!")
+        return
+    
+    if action in ("block", "unblock") and len(args) == 2 and args[1] in MEDIA_TYPES:
+        types = rules.setdefault("types", [])
+        if action == "block" and args[1] not in types:
+            types.append(args[1])
+        elif action == "unblock" and args[1] in types:
+            types.remove(args[1])
+        await save_chat("media", chat_id)
+        await update.message.reply_text(f"✅ {args[1]}: {action}ed!")
+        return
+    
+    target = update.message.reply_to_message
+    kind = media_type(target) if target else None
+    if action not in ("add", "remove") or kind is None:
+        await update.message.reply_text(MEDIA_FILTER_USAGE)
+        return
+    
+    unique_id = media_file(target, kind).file_unique_id
+    blocked = rules.setdefault("blocked", [])
+    hashes = rules.setdefault("hashes", {})
+    if action == "add":
+        if unique_id not in blocked:
+            blocked.append(unique_id)
+        source = hash_source(target, kind)
+        if source is not None and Image is not None:
+            value = await media_hash(context.bot, source)
+            if value is not None:
+                hashes[unique_id] = f"{value:016x}"
+        text = "🚫 Media added to the blocklist!"
+    else:
+        if unique_id not in blocked:
+            await update.message.reply_text("❌ This media is not blocked!")
+            return
+        blocked.remove(unique_id)
+        hashes.pop(unique_id, None)
+        text = "✅ Media removed from the blocklist!"
+    media_indexes.pop(chat_id, None)
+    await save_chat("media", chat_id)
+    await update.message.reply_text(text)
+
 # ==================== WELCOME & GOODBYE ====================
 
+# Joins are collected per chat for this many seconds and greeted with one message
+WELCOME_DEBOUNCE_SECONDS = 3
+# Maximum number of members mentioned in a single welcome message
+WELCOME_MENTION_CAP = 15
+
+WELCOME_PLACEHOLDER = re.compile(r"\{(\w+)\}")
+WELCOME_FIELDS = ("user", "mention", "first", "last", "fullname", "username", "id", "count", "group", "chatid")
+WELCOME_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("👋 Say Hi!", callback_data="say_hi")]])
+
+compiled_welcomes = {}
+pending_welcomes = defaultdict(list)
+welcome_tasks = {}
+last_welcome = {}
+
+def compile_welcome(template):
+    """Parse a welcome template into literal and placeholder parts"""
+    parts = []
+    pos = 0
+    for match in WELCOME_PLACEHOLDER.finditer(template):
+        if match.group(1) not in WELCOME_FIELDS:
+            continue
+        if match.start() > pos:
+            parts.append((False, template[pos:match.start()]))
+        parts.append((True, match.group(1)))
+        pos = match.end()
+    if pos < len(template):
+        parts.append((False, template[pos:]))
+    return tuple(parts)
+
+def get_compiled_welcome(chat_id):
+    """Get the compiled welcome template for a chat, compiling it on first use"""
+    compiled = compiled_welcomes.get(chat_id)
+    if compiled is None:
+        compiled = compiled_welcomes[chat_id] = compile_welcome(welcome_messages[chat_id])
+    return compiled
+
+def welcome_values(members, chat):
+    """Build placeholder values for a batch of new members"""
+    shown = members[:WELCOME_MENTION_CAP]
+    hidden = len(members) - len(shown)
+
+    def join(items):
+        text = ", ".join(items)
+        return f"{text} and {hidden} others" if hidden else text
+
+    mentions = join([m.mention_html() for m in shown])
+    return {
+        "user": mentions,
+        "mention": mentions,
+        "first": join([html.escape(m.first_name) for m in shown]),
+        "last": join([html.escape(m.last_name or "") for m in shown]),
+        "fullname": join([html.escape(m.full_name) for m in shown]),
+        "username": join([f"@{m.username}" if m.username else html.escape(m.first_name) for m in shown]),
+        "id": join([str(m.id) for m in shown]),
+        "count": str(len(members)),
+        "group": html.escape(chat.title or ""),
+        "chatid": str(chat.id),
+    }
+
+def render_welcome(compiled, values):
+    """Render a compiled welcome template"""
+    return "".join(values[value] if is_field else value for is_field, value in compiled)
+
 async def set_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Set welcome message"""
     if not await is_admin(update, context):
         return
     
-    if len(context.args) >= 1:
-        chat_id = str(update.effective_chat.id)
-        message = " ".join(context.args)
-        welcome_messages[chat_id] = message
-        save_data(WELCOME_FILE, welcome_messages)
-        await update.message.reply_text("✅ Welcome message set!")
+    if len(context.args) >= 1:
+        chat_id = str(update.effective_chat.id)
+        message = " ".join(context.args)
+        welcome_messages[chat_id] = message
+        compiled_welcomes[chat_id] = compile_welcome(message)
+        await save_chat("welcome", chat_id)
+        await update.message.reply_text("✅ Welcome message set!")
+    else:
+        await update.message.reply_text(
+            "❌ Usage: /setwelcome <message>\n"
+            "Placeholders: {user}, {first}, {last}, {fullname}, {username}, {id}, {count}, {group}, {chatid}"
+        )
+
+async def welcome_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Queue new users for a coalesced welcome; joins from the backlog are not welcomed"""
+    chat_id = str(update.effective_chat.id)
+    if settings[chat_id].get("welcome", True) and not update_stale.get():
+        pending_welcomes[chat_id].extend(update.message.new_chat_members)
+        if chat_id not in welcome_tasks:
+            welcome_tasks[chat_id] = context.application.create_task(
+                flush_welcome(context.bot, update.effective_chat)
+            )
+
+async def flush_welcome(bot, chat):
+    """Greet every member queued during the debounce window with one message"""
+    chat_id = str(chat.id)
+    try:
+        await asyncio.sleep(WELCOME_DEBOUNCE_SECONDS)
+    finally:
+        welcome_tasks.pop(chat_id, None)
+    members = pending_welcomes.pop(chat_id, [])
+    if not members:
+        return
+    
+    text = render_welcome(get_compiled_welcome(chat_id), welcome_values(members, chat))
+    try:
+        msg = await bot.send_message(chat.id, text, parse_mode=ParseMode.HTML, reply_markup=WELCOME_MARKUP)
+    except Exception as e:
+        logger.error("Error sending welcome message: %s", e, extra={"chat_id": chat.id})
+        return
+    
+    previous = last_welcome.get(chat_id)
+    last_welcome[chat_id] = msg.message_id
+    if previous:
+        try:
+            await bot.delete_message(chat.id, previous)
+        except Exception:
+            pass
+
+# ==================== NOTES SYSTEM ====================
+
+# Per chat: {"names": {lowercase name: stored name}, "sorted": sorted lowercase names,
+#            "media": {file_unique_id: stored name}}
+note_indexes = {}
+# Hashtag notes are only looked up for this many hashtags per message
+MAX_HASHTAG_LOOKUPS = 5
+
+def get_note_index(chat_id):
+    """Get a chat's note index, building it from storage on first use"""
+    index = note_indexes.get(chat_id)
+    if index is None:
+        chat_notes = notes.get(chat_id, {})
+        names = {name.lower(): name for name in chat_notes}
+        media = {note["unique_id"]: name for name, note in chat_notes.items() if isinstance(note, dict)}
+        index = note_indexes[chat_id] = {"names": names, "sorted": sorted(names), "media": media}
+    return index
+
+def find_note(chat_id, name):
+    """Resolve a note name case-insensitively, or None if the chat has no such note"""
+    return get_note_index(chat_id)["names"].get(name.lower())
+
+def index_note(chat_id, name):
+    """Add a saved note to the chat's index"""
+    index = get_note_index(chat_id)
+    key = name.lower()
+    if key not in index["names"]:
+        bisect.insort(index["sorted"], key)
+    index["names"][key] = name
+    note = notes[chat_id][name]
+    if isinstance(note, dict):
+        index["media"][note["unique_id"]] = name
+
+def unindex_note(chat_id, name):
+    """Remove a note from the chat's index (call before the note is deleted)"""
+    index = get_note_index(chat_id)
+    key = name.lower()
+    if index["names"].pop(key, None) is not None:
+        pos = bisect.bisect_left(index["sorted"], key)
+        del index["sorted"][pos]
+    note = notes.get(chat_id, {}).get(name)
+    if isinstance(note, dict):
+        index["media"].pop(note["unique_id"], None)
+
+def search_notes(chat_id, prefix=""):
+    """Return stored note names starting with prefix, in sorted order"""
+    index = get_note_index(chat_id)
+    prefix = prefix.lower()
+    keys = index["sorted"]
+    start = bisect.bisect_left(keys, prefix)
+    end = bisect.bisect_left(keys, prefix + "\U0010ffff") if prefix else len(keys)
+    return [index["names"][key] for key in keys[start:end]]
+
+# Media note type -> (Message attribute, reply method, whether it takes a caption)
+MEDIA_NOTE_TYPES = {
+    "photo": ("photo", "reply_photo", True),
+    # GIFs carry both animation and document, so animation is checked first
+    "animation": ("animation", "reply_animation", True),
+    "document": ("document", "reply_document", True),
+    "sticker": ("sticker", "reply_sticker", False),
+    "voice": ("voice", "reply_voice", True),
+    "video": ("video", "reply_video", True),
+    "audio": ("audio", "reply_audio", True),
+}
+
+def extract_media_note(message, caption=None):
+    """Build a compact media note payload from a message, or None if it has no supported media"""
+    for note_type, (attr, _, _) in MEDIA_NOTE_TYPES.items():
+        media = getattr(message, attr)
+        if not media:
+            continue
+        if note_type == "photo":
+            media = media[-1]
+        note = {"type": note_type, "file_id": media.file_id, "unique_id": media.file_unique_id}
+        caption = caption or message.caption
+        if caption:
+            note["caption"] = caption
+        return note
+    return None
+
+def find_media_note(chat_id, unique_id):
+    """Return the name of the chat's note holding a file, or None"""
+    return get_note_index(chat_id)["media"].get(unique_id)
+
+async def send_note(message, note):
+    """Reply to a message with a note's content, resending media by file_id"""
+    if isinstance(note, str):
+        await message.reply_text(note)
+        return
+    
+    _, method, has_caption = MEDIA_NOTE_TYPES[note["type"]]
+    if has_caption:
+        await getattr(message, method)(note["file_id"], caption=note.get("caption"))
     else:
-        await update.message.reply_text("❌ Usage: /setwelcome <message>\nUse {user} for username, {group} for group name")
-
-async def welcome_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Welcome new users"""
-    chat_id = str(update.effective_chat.id)
-    if settings[chat_id].get("welcome", True):
-        for member in update.message.new_chat_members:
-            message = welcome_messages[chat_id]
-            message = message.replace("{user}", member.mention_html())
-            message = message.replace("{group}", update.effective_chat.title)
-            
-            keyboard = [[InlineKeyboardButton("👋 Say Hi!", callback_data="say_hi")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text(
-                message,
-                parse_mode=ParseMode.HTML,
-                reply_markup=reply_markup
-            )
-
-# ==================== NOTES SYSTEM ====================
+        await getattr(message, method)(note["file_id"])
 
 async def save_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Save a note"""
     if not await is_admin(update, context):
         return
     
-    if len(context.args) >= 2:
+    reply = update.message.reply_to_message
+    if len(context.args) >= 2 or (context.args and reply):
         chat_id = str(update.effective_chat.id)
-        note_name = context.args[0]
-        note_content = " ".join(context.args[1:])
+        note_name = find_note(chat_id, context.args[0]) or context.args[0]
+        text = " ".join(context.args[1:])
+        
+        note_content = extract_media_note(reply, text) if reply else None
+        if note_content:
+            existing = find_media_note(chat_id, note_content["unique_id"])
+            if existing and existing != note_name:
+                await update.message.reply_text(
+                    f"❌ This file is already saved as <code>#{html.escape(existing)}</code>",
+                    parse_mode=ParseMode.HTML
+                )
+                return
+        else:
+            note_content = text or (reply.text if reply else None)
+            if not note_content:
+                await update.message.reply_text("❌ Nothing to save!")
+                return
         
+        if note_name in notes[chat_id]:
+            unindex_note(chat_id, note_name)
         notes[chat_id][note_name] = note_content
-        save_data(NOTES_FILE, notes)
+        index_note(chat_id, note_name)
+        await save_chat("notes", chat_id)
         await update.message.reply_text(f"✅ Note saved: <code>#{note_name}</code>", parse_mode=ParseMode.HTML)
     else:
-        await update.message.reply_text("❌ Usage: /save <name> <content>")
+        await update.message.reply_text(
+            "❌ Usage: /save <name> <content>\n"
+            "Or reply to a photo, document, sticker, voice, video or text with /save <name>"
+        )
 
 async def get_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get a note"""
     if len(context.args) >= 1:
         chat_id = str(update.effective_chat.id)
-        note_name = context.args[0]
+        note_name = find_note(chat_id, context.args[0])
         
-        if note_name in notes[chat_id]:
-            await update.message.reply_text(notes[chat_id][note_name])
+        if note_name:
+            await send_note(update.message, notes[chat_id][note_name])
         else:
             await update.message.reply_text("❌ Note not found!")
     else:
         await update.message.reply_text("❌ Usage: /get <name>")
 
+async def hashtag_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the note named by the first matching #hashtag in a message"""
+    message = update.message
+    if not message:
+        return
+    
+    chat_id = str(update.effective_chat.id)
+    names = get_note_index(chat_id)["names"]
+    if not names:
+        return
+    
+    hashtags = message.parse_entities([MessageEntity.HASHTAG]).values()
+    for tag in list(hashtags)[:MAX_HASHTAG_LOOKUPS]:
+        note_name = names.get(tag[1:].lower())
+        if note_name:
+            await send_note(message, notes[chat_id][note_name])
+            return
+
+async def clear_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Delete a note"""
+    if not await is_admin(update, context):
+        return
+    
+    if len(context.args) >= 1:
+        chat_id = str(update.effective_chat.id)
+        note_name = find_note(chat_id, context.args[0])
+        
+        if note_name:
+            unindex_note(chat_id, note_name)
+            del notes[chat_id][note_name]
+            await save_chat("notes", chat_id)
+            await update.message.reply_text(f"🗑️ Note deleted: <code>#{note_name}</code>", parse_mode=ParseMode.HTML)
+        else:
+            await update.message.reply_text("❌ Note not found!")
+    else:
+        await update.message.reply_text("❌ Usage: /clear <name>")
+
 async def list_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """List all notes"""
+    """List all notes, or those starting with a prefix"""
     chat_id = str(update.effective_chat.id)
-    chat_notes = notes[chat_id]
+    prefix = context.args[0].lstrip("#") if context.args else ""
+    names = search_notes(chat_id, prefix)
     
-    if chat_notes:
+    if names:
         text = "📝 <b>Saved Notes:</b>\n\n"
-        for name in chat_notes.keys():
-            text += f"• <code>#{name}</code>\n"
+        for name in names:
+            text += f"• <code>#{html.escape(name)}</code>\n"
         await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    elif prefix:
+        await update.message.reply_text(f"❌ No notes starting with {prefix}!")
     else:
         await update.message.reply_text("❌ No notes saved!")
 
 # ==================== SETTINGS ====================
 
-async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Settings menu"""
-    if not await is_admin(update, context):
-        return
-    
-    chat_id = str(update.effective_chat.id)
-    s = settings[chat_id]
-    
-    keyboard = [
+SETTINGS_TEXT = """
+⚙️ <b>Group Settings</b>
+
+Configure protection and features:
+    """
+
+settings_menus = {}
+
+def build_settings_markup(s):
+    """Build the settings keyboard for one chat's settings"""
+    return InlineKeyboardMarkup([
         [InlineKeyboardButton(f"🌊 Anti-Flood: {'✅' if s.get('antiflood') else '❌'}", callback_data="toggle_antiflood")],
         [InlineKeyboardButton(f"🛡️ Anti-Raid: {'✅' if s.get('antiraid') else '❌'}", callback_data="toggle_antiraid")],
         [InlineKeyboardButton(f"🤖 Anti-Bot: {'✅' if s.get('antibot') else '❌'}", callback_data="toggle_antibot")],
         [InlineKeyboardButton(f"👋 Welcome: {'✅' if s.get('welcome') else '❌'}", callback_data="toggle_welcome")],
         [InlineKeyboardButton(f"🔗 Link Filter: {'✅' if s.get('link_protection') else '❌'}", callback_data="toggle_links")],
+        [InlineKeyboardButton(f"🖼 Media Filter: {'✅' if s.get('media_filter') else '❌'}", callback_data="toggle_media")],
         [InlineKeyboardButton(f"📺 Channel Block: {'✅' if s.get('channel_protection', True) else '❌'}", callback_data="toggle_channel")],
         [InlineKeyboardButton(f"🔒 ID Protection: {'✅' if s.get('id_protection', True) else '❌'}", callback_data="toggle_id")],
         [InlineKeyboardButton(f"🌙 Night Mode: {'✅' if s.get('night_mode') else '❌'}", callback_data="toggle_night")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    ])
+
+def get_settings_markup(chat_id):
+    """Get the memoized settings keyboard for a chat"""
+    markup = settings_menus.get(chat_id)
+    if markup is None:
+        markup = settings_menus[chat_id] = build_settings_markup(settings[chat_id])
+    return markup
+
+async def set_setting(chat_id, key, value):
+    """Change a chat setting, persist it and drop the chat's cached menu"""
+    settings[chat_id][key] = value
+    settings_menus.pop(chat_id, None)
+    await save_chat("settings", chat_id)
+
+async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Settings menu"""
+    if not await is_admin(update, context):
+        return
     
-    text = """
-⚙️ <b>Group Settings</b>
+    reply_markup = get_settings_markup(str(update.effective_chat.id))
+    
+    if update.callback_query:
+        await update.callback_query.edit_message_text(SETTINGS_TEXT, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    else:
+        await update.message.reply_text(SETTINGS_TEXT, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
-Configure protection and features:
+# ==================== EXPORT & IMPORT ====================
+
+# First line of every export; later lines are {"chat", "kind", "data"} records
+EXPORT_HEADER = {"export": "group-help-chat-state", "version": 1}
+# Chats read from the backend per round trip while exporting
+EXPORT_PAGE_SIZE = 200
+IMPORT_MAX_BYTES = 5 * 1024 * 1024
+
+async def exported_chats():
+    """Ids of every chat with stored state"""
+    chat_ids = set()
+    for kind in (*CHAT_DOCS, "warnings"):
+        chat_ids.update(key.split(":", 1)[1] for key in await state.keys(f"{kind}:"))
+    return sorted(chat_ids)
+
+async def export_lines(chat_ids):
+    """Serialize chats as JSON lines, one page of chats in memory at a time"""
+    yield json.dumps(EXPORT_HEADER) + "\n"
+    kinds = list(CHAT_DOCS)
+    for i in range(0, len(chat_ids), EXPORT_PAGE_SIZE):
+        page = chat_ids[i:i + EXPORT_PAGE_SIZE]
+        raws = await state.get_many([doc_key(kind, chat_id) for chat_id in page for kind in kinds])
+        for n, chat_id in enumerate(page):
+            prefix = f'{{"chat": {json.dumps(chat_id)}, "kind": '
+            for kind, raw in zip(kinds, raws[n * len(kinds):(n + 1) * len(kinds)]):
+                # Documents are stored as JSON already and are embedded without re-encoding
+                if raw is not None:
+                    yield f'{prefix}"{kind}", "data": {raw}}}\n'
+            now = time.time()
+            warnings = {user_id: active for user_id, raw in (await state.hgetall(doc_key("warnings", chat_id))).items()
+                        if (active := active_warnings(raw, now))}
+            if warnings:
+                yield f'{prefix}"warnings", "data": {json.dumps(warnings)}}}\n'
+
+def clear_chat_ops(chat_id, keep_federation):
+    """Operations deleting every document and the warnings of a chat"""
+    for kind in CHAT_DOCS:
+        yield "delete", doc_key(kind, chat_id), None
+    yield "delete", doc_key("warnings", chat_id), None
+    federation = settings[chat_id].get("federation") if keep_federation else None
+    if federation:
+        yield "set", doc_key("settings", chat_id), json.dumps({**settings.default_factory(), "federation": federation})
+
+def import_ops(lines, chat_id=None):
+    """Parse and validate an export line by line, yielding state operations.
+
+    Each chat in the export is cleared before its records are applied, so
+    the import replaces its state. With chat_id every record is imported
+    into that chat, keeping its current federation membership; otherwise
+    into the chat it was exported from.
     """
+    header = None
+    cleared = set()
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError(f"line {number}: not valid JSON")
+        if header is None:
+            header = record
+            if header.get("export") != EXPORT_HEADER["export"] or header.get("version") != EXPORT_HEADER["version"]:
+                raise ValueError("not a chat state export")
+            continue
+        
+        kind, data = record.get("kind"), record.get("data")
+        try:
+            target = chat_id or str(int(record["chat"]))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"line {number}: missing or invalid chat id")
+        if target not in cleared:
+            cleared.add(target)
+            yield from clear_chat_ops(target, chat_id is not None)
+        if kind == "warnings":
+            # Exports from before warnings had reasons hold bare counts
+            if not isinstance(data, dict) or not all(
+                isinstance(w, int) or (isinstance(w, list) and all(isinstance(x, list) and len(x) == 4 for x in w))
+                for w in data.values()
+            ):
+                raise ValueError(f"line {number}: warnings must map user ids to warning lists")
+            yield "hash", doc_key(kind, target), {u: w if isinstance(w, int) else json.dumps(w) for u, w in data.items()}
+            continue
+        if kind not in CHAT_DOCS:
+            raise ValueError(f"line {number}: unknown kind {kind!r}")
+        if type(data) is not type(CHAT_DOCS[kind].default_factory()):
+            raise ValueError(f"line {number}: invalid {kind} document")
+        if kind == "settings" and chat_id is not None:
+            data.pop("federation", None)
+            if settings[chat_id].get("federation"):
+                data["federation"] = settings[chat_id]["federation"]
+        yield "set", doc_key(kind, target), json.dumps(data)
+    if header is None:
+        raise ValueError("empty file")
+
+async def export_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send this chat's configuration and state as a file"""
+    if not await is_admin(update, context):
+        return
+    chat_id = str(update.effective_chat.id)
+    buffer = io.BytesIO()
+    async for line in export_lines([chat_id]):
+        buffer.write(line.encode())
+    buffer.seek(0)
+    await update.message.reply_document(
+        buffer,
+        filename=f"chat{chat_id}-export.jsonl",
+        caption="📦 Chat export. Reply to it with /import in another chat to copy this setup."
+    )
+
+async def import_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Replace this chat's state with an export sent with or replied to by the command"""
+    if not await is_admin(update, context):
+        return
+    reply = update.message.reply_to_message
+    document = update.message.document or (reply and reply.document)
+    if document is None:
+        await update.message.reply_text("❌ Reply to an export file with /import!")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text("❌ File too large!")
+        return
     
-    if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    chat_id = str(update.effective_chat.id)
+    file = await context.bot.get_file(document.file_id)
+    data = await file.download_as_bytearray()
+    try:
+        # Validate everything first: a bad line must not leave half an import behind
+        ops = list(import_ops(bytes(data).decode("utf-8").splitlines(), chat_id))
+        count = await state.apply(ops)
+    except (ValueError, UnicodeDecodeError) as e:
+        await update.message.reply_text(f"❌ Import failed: {e}")
+        return
+    await load_chat(chat_id)
+    await index_chat_warnings(chat_id)
+    audit(chat_id, "import", actor=update.effective_user, count=count)
+    await update.message.reply_text(f"✅ Imported {count} records!")
+
+async def cli_export(path):
+    await init_state()
+    try:
+        chat_ids = await exported_chats()
+        out = sys.stdout if path == "-" else open(path, "w", encoding="utf-8")
+        try:
+            async for line in export_lines(chat_ids):
+                out.write(line)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        print(f"Exported {len(chat_ids)} chats", file=sys.stderr)
+    finally:
+        await close_state()
+
+async def cli_import(path):
+    await init_state()
+    try:
+        with open(path, encoding="utf-8") as f:
+            ops = list(import_ops(f))
+        count = await state.apply(ops)
+        for chat_id in {key.split(":", 1)[1] for _, key, _ in ops}:
+            await index_chat_warnings(chat_id)
+        print(f"Imported {count} records", file=sys.stderr)
+    finally:
+        await close_state()
+
+def run_cli(argv):
+    """Bulk export or import of every chat's state"""
+    parser = argparse.ArgumentParser(prog="main.py", description="Without a command the bot is started.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write the state of every chat as JSON lines")
+    export_parser.add_argument("file", nargs="?", default="-", help="output file (default: stdout)")
+    import_parser = commands.add_parser("import", help="apply an export in one transaction")
+    import_parser.add_argument("file")
+    args = parser.parse_args(argv)
+    if args.command == "export":
+        asyncio.run(cli_export(args.file))
     else:
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        try:
+            asyncio.run(cli_import(args.file))
+        except ValueError as e:
+            parser.exit(1, f"Import failed, nothing was changed: {e}\n")
 
 # ==================== INFO COMMANDS ====================
 
@@ -656,33 +3256,8 @@ async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         return False
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle button callbacks"""
-    query = update.callback_query
-    await query.answer()
-    
-    data = query.data
-    
-    # Settings toggles
-    if data.startswith("toggle_"):
-        chat_id = str(query.message.chat.id)
-        setting = data.replace("toggle_", "")
-        settings[chat_id][setting] = not settings[chat_id].get(setting, False)
-        save_data(SETTINGS_FILE, settings)
-        await settings_menu(update, context)
-    
-    # Help menus
-    elif data == "help":
-        await help_command(update, context)
-    elif data.startswith("help_"):
-        await show_help_category(update, context, data.replace("help_", ""))
-    elif data == "features":
-        await show_features(update, context)
-
-async def show_help_category(update: Update, context: ContextTypes.DEFAULT_TYPE, category: str):
-    """Show specific help category"""
-    help_texts = {
-        "admin": """
+HELP_TEXTS = {
+    "admin": """
 👮 <b>Admin Commands</b>
 
 /ban - Ban user
@@ -690,19 +3265,23 @@ async def show_help_category(update: Update, context: ContextTypes.DEFAULT_TYPE,
 /kick - Kick user
 /mute - Mute user
 /unmute - Unmute user
-/warn - Warn user (3 warns = ban)
+/warn - Warn user, optionally with a reason
+/warns - Active warnings of a user, with reasons
 /rmwarn - Remove warnings
+/warnpolicy - Warn limit, action (ban/mute/kick) and expiry
+Bulk: /ban, /unban, /kick, /mute, /warn also take IDs, @usernames, "joined 10m", or "file" in reply to an admin's text file of IDs
 /pin - Pin message
 /unpin - Unpin message
 /del - Delete message
 /purge - Delete multiple messages
+/modlog - Moderation log: @user, by @admin, or an action; today/24h/7d
 /promote - Promote to admin
 /demote - Demote admin
 /settitle - Set admin title
 /lock - Lock chat permissions
 /unlock - Unlock chat permissions
-        """,
-        "security": """
+    """,
+    "security": """
 🛡️ <b>Security Commands</b>
 
 /addfilter - Add word filter
@@ -714,13 +3293,20 @@ async def show_help_category(update: Update, context: ContextTypes.DEFAULT_TYPE,
 /antispam - Toggle spam filter
 /blacklist - Blacklist user
 /unblacklist - Remove from blacklist
+/newfed - Create a federation of groups
+/joinfed - Join a federation
+/leavefed - Leave the federation
+/fban - Ban a user in all federation groups
+/unfban - Lift a federation ban
+/fedinfo - Federation details
+/fedadmin - Add/remove a federation admin
 /captcha - Enable captcha verification
-/linkfilter - Filter links
-/mediafilter - Filter media
+/linkfilter - Link filter: on/off, allow/deny/remove a domain
+/mediafilter - Media filter: on/off, block types, blocklist a sticker/image
 /channelblock - Block channel messages
 /idprotection - Protect user IDs
-        """,
-        "chat": """
+    """,
+    "chat": """
 💬 <b>Chat Commands</b>
 
 /save - Save note
@@ -733,12 +3319,13 @@ async def show_help_category(update: Update, context: ContextTypes.DEFAULT_TYPE,
 /rules - Show rules
 /setrules - Set rules
 /report - Report to admins
-/tag - Tag all members
+/tagall - Tag members: /tagall active 2h [message] tags only those seen lately
+/canceltag - Stop a running /tagall
 /tagadmins - Tag admins only
 /poll - Create poll
 /quiz - Create quiz
-        """,
-        "fun": """
+    """,
+    "fun": """
 🎮 <b>Fun Commands</b>
 
 /dice - Roll dice 🎲
@@ -755,11 +3342,11 @@ async def show_help_category(update: Update, context: ContextTypes.DEFAULT_TYPE,
 /kiss - Kiss someone
 /punch - Punch someone
 /pat - Pat someone
-        """,
-        "stats": """
+    """,
+    "stats": """
 📊 <b>Statistics Commands</b>
 
-/stats - Group statistics
+/stats - Group statistics (24h, 7d or 30d)
 /mystats - Your statistics
 /topchatters - Most active users
 /topvoters - Top poll voters
@@ -768,21 +3355,23 @@ async def show_help_category(update: Update, context: ContextTypes.DEFAULT_TYPE,
 /engagement - Engagement rate
 /wordcloud - Generate wordcloud
 /mentions - Who mentions you
-        """,
-        "settings": """
+    """,
+    "settings": """
 ⚙️ <b>Settings Commands</b>
 
 /settings - Settings menu
+/export - Export this chat's setup as a file
+/import - Reply to an export file to copy its setup here
 /language - Change language
 /timezone - Set timezone
 /nightmode - Enable night mode
 /slowmode - Set slow mode
-/maxwarns - Set max warnings
+/warnpolicy - Warn limit, action and expiry
 /welcomedelay - Welcome delay
 /antifloodtime - Flood time limit
 /raidmode - Raid mode settings
-        """,
-        "search": """
+    """,
+    "search": """
 🔍 <b>Search Commands</b>
 
 /google - Google search
@@ -795,8 +3384,8 @@ async def show_help_category(update: Update, context: ContextTypes.DEFAULT_TYPE,
 /movie - Movie info
 /anime - Anime search
 /lyrics - Song lyrics
-        """,
-        "misc": """
+    """,
+    "misc": """
 🎯 <b>Miscellaneous Commands</b>
 
 /info - User information
@@ -807,25 +3396,15 @@ async def show_help_category(update: Update, context: ContextTypes.DEFAULT_TYPE,
 /json - Get message JSON
 /ping - Check bot latency
 /sys - System information
+/metrics - Handler & API latency
 /uptime - Bot uptime
 /help - Help menu
 /start - Start bot
 /about - About bot
-        """
-    }
-    
-    keyboard = [[InlineKeyboardButton("⬅️ Back", callback_data="help")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.callback_query.edit_message_text(
-        help_texts.get(category, "Category not found"),
-        reply_markup=reply_markup,
-        parse_mode=ParseMode.HTML
-    )
+    """
+}
 
-async def show_features(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show all features"""
-    text = """
+FEATURES_TEXT = """
 ⚡ <b>100+ Bot Features</b>
 
 <b>🛡️ Security & Protection:</b>
@@ -959,11 +3538,66 @@ async def show_features(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 And many more features! 🚀
     """
+
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data="help")]])
+
+async def show_help_category(update: Update, context: ContextTypes.DEFAULT_TYPE, category: str):
+    """Show specific help category"""
+    await update.callback_query.edit_message_text(
+        HELP_TEXTS.get(category, "Category not found"),
+        reply_markup=BACK_MARKUP,
+        parse_mode=ParseMode.HTML
+    )
+
+async def show_features(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str = ""):
+    """Show all features"""
+    await update.callback_query.edit_message_text(FEATURES_TEXT, reply_markup=BACK_MARKUP, parse_mode=ParseMode.HTML)
+
+# Toggle callback names mapped to the setting key and its default
+TOGGLE_SETTINGS = {
+    "antiflood": ("antiflood", False),
+    "antiraid": ("antiraid", False),
+    "antibot": ("antibot", True),
+    "welcome": ("welcome", True),
+    "links": ("link_protection", False),
+    "media": ("media_filter", False),
+    "channel": ("channel_protection", True),
+    "id": ("id_protection", True),
+    "night": ("night_mode", False),
+}
+
+async def toggle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, name: str):
+    """Flip a boolean chat setting from the settings menu"""
+    if name not in TOGGLE_SETTINGS or not await is_admin(update, context):
+        return
+    chat_id = str(update.callback_query.message.chat.id)
+    key, default = TOGGLE_SETTINGS[name]
+    await set_setting(chat_id, key, not settings[chat_id].get(key, default))
+    await settings_menu(update, context)
+
+async def help_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, category: str):
+    """Show the help menu or one of its categories"""
+    if category:
+        await show_help_category(update, context, category)
+    else:
+        await help_command(update, context)
+
+# Callback data is "<prefix>" or "<prefix>_<argument>"; handlers take the argument
+CALLBACK_ROUTES = {
+    "toggle": toggle_callback,
+    "help": help_callback,
+    "features": show_features,
+}
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle button callbacks"""
+    query = update.callback_query
+    await query.answer()
     
-    keyboard = [[InlineKeyboardButton("⬅️ Back", callback_data="help")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    prefix, _, arg = query.data.partition("_")
+    route = CALLBACK_ROUTES.get(prefix)
+    if route:
+        await route(update, context, arg)
 
 # ==================== MORE ADMIN COMMANDS ====================
 
@@ -1086,19 +3720,139 @@ async def unlock_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==================== TAG COMMANDS ====================
 
+# Telegram notifies only the first few users mentioned in one message
+TAG_CHUNK_SIZE = 5
+# Tag messages per second; groups accept about 20 bot messages a minute
+TAG_RATE = 1 / 3
+# Members indexed per chat; the least recently seen are evicted first
+MEMBER_INDEX_LIMIT = 50000
+# Last-seen minutes are written back once per member per this many minutes
+MEMBER_SEEN_RESOLUTION = 60
+# Chats whose member index is kept in memory; the least recently active are reloaded on use
+MEMBER_INDEX_CHATS = 200
+TAG_USAGE = "Usage: /tagall [active <N>m|h|d] [message]\n/canceltag stops a running tag"
+
+# chat_id -> {user_id: last seen minute}, least recently seen first; least recently used chat first
+member_indexes = OrderedDict()
+member_loads = {}
+# chat_id -> running tag job
+tag_jobs = {}
+
+async def load_members(chat_id):
+    seen = await state.hgetall(f"members:{chat_id}")
+    return dict(sorted(((int(user_id), int(minute)) for user_id, minute in seen.items()), key=lambda item: item[1]))
+
+async def get_members(chat_id):
+    """A chat's member index, loaded from the backend on first use"""
+    members = member_indexes.get(chat_id)
+    if members is not None:
+        member_indexes.move_to_end(chat_id)
+        return members
+    task = member_loads.get(chat_id)
+    if task is None:
+        task = member_loads[chat_id] = asyncio.ensure_future(load_members(chat_id))
+    try:
+        members = member_indexes[chat_id] = await task
+    finally:
+        member_loads.pop(chat_id, None)
+    # Everything but last-seen times within MEMBER_SEEN_RESOLUTION is stored, so eviction loses nothing else
+    while len(member_indexes) > MEMBER_INDEX_CHATS:
+        member_indexes.popitem(last=False)
+    return members
+
+async def member_seen(chat_id, user, when):
+    """Move a member to the recently seen end of the index, evicting the stalest past the limit"""
+    if user is None or user.is_bot:
+        return
+    members = await get_members(chat_id)
+    last = members.pop(user.id, None)
+    minute = max(int(when) // 60, last or 0)
+    members[user.id] = minute
+    if last is None or last // MEMBER_SEEN_RESOLUTION != minute // MEMBER_SEEN_RESOLUTION:
+        await state.hset(f"members:{chat_id}", {str(user.id): minute})
+    if len(members) > MEMBER_INDEX_LIMIT:
+        evicted = next(iter(members))
+        del members[evicted]
+        await state.hdel(f"members:{chat_id}", str(evicted))
+
+async def member_left(chat_id, user):
+    members = await get_members(chat_id)
+    if members.pop(user.id, None) is not None:
+        await state.hdel(f"members:{chat_id}", str(user.id))
+
+async def active_members(chat_id, minutes=None):
+    """Indexed members, most recently seen first, optionally only those seen in the last `minutes`"""
+    members = await get_members(chat_id)
+    since = int(time.time()) // 60 - minutes if minutes else None
+    return [user_id for user_id in reversed(members) if since is None or members[user_id] >= since]
+
+def tag_messages(user_ids, text):
+    """Messages mentioning TAG_CHUNK_SIZE users each"""
+    header = f"📢 {html.escape(text)}\n\n" if text else "📢 "
+    return [
+        header + " ".join(f'<a href="tg://user?id={user_id}">👤</a>' for user_id in user_ids[i:i + TAG_CHUNK_SIZE])
+        for i in range(0, len(user_ids), TAG_CHUNK_SIZE)
+    ]
+
+async def run_tag_all(bot, chat_id, chunks, status):
+    sent = 0
+    
+    async def send(chunk):
+        nonlocal sent
+        await bot.send_message(int(chat_id), chunk, parse_mode=ParseMode.HTML)
+        sent += 1
+    
+    try:
+        done, failures = await run_bulk(chunks, send, status, "Sending tags", rate=TAG_RATE, concurrency=1)
+        await status.edit_text(bulk_summary("Sent", done, len(chunks), failures, "tag messages"))
+    except asyncio.CancelledError:
+        try:
+            await status.edit_text(f"🛑 Tagging stopped after {sent}/{len(chunks)} messages")
+        except Exception:
+            pass
+        raise
+    finally:
+        if tag_jobs.get(chat_id) is asyncio.current_task():
+            del tag_jobs[chat_id]
+
 async def tag_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Tag all members"""
+    """Tag all members, or those active recently"""
     if not await is_admin(update, context):
         return
     
-    try:
-        member_count = await context.bot.get_chat_member_count(update.effective_chat.id)
-        await update.message.reply_text(
-            f"📢 Tagging {member_count} members...\n\n"
-            f"⚠️ This feature requires admin rights to fetch member list."
-        )
-    except Exception as e:
-        await update.message.reply_text(f"❌ Error: {e}")
+    chat_id = str(update.effective_chat.id)
+    if chat_id in tag_jobs:
+        await update.message.reply_text("❌ Already tagging! Use /canceltag to stop.")
+        return
+    args = list(context.args)
+    minutes = None
+    if args and args[0].lower() == "active":
+        window = parse_duration(args[1]) if len(args) > 1 else None
+        if not window:
+            await update.message.reply_text(f"❌ {TAG_USAGE}")
+            return
+        minutes = max(1, window // 60)
+        args = args[2:]
+    
+    user_ids = [user_id for user_id in await active_members(chat_id, minutes) if user_id != update.effective_user.id]
+    if not user_ids:
+        await update.message.reply_text("❌ No members seen in this chat yet!" if minutes is None else "❌ Nobody was active in that window!")
+        return
+    chunks = tag_messages(user_ids, " ".join(args))
+    status = await update.message.reply_text(f"⏳ Tagging {len(user_ids)} members in {len(chunks)} messages...")
+    tag_jobs[chat_id] = context.application.create_task(run_tag_all(context.bot, chat_id, chunks, status))
+
+async def cancel_tag(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stop a running /tagall"""
+    if not await is_admin(update, context):
+        return
+    
+    job = tag_jobs.pop(str(update.effective_chat.id), None)
+    if job is None:
+        await update.message.reply_text("❌ Nothing is being tagged!")
+        return
+    job.cancel()
+    await update.message.reply_text("🛑 Tagging cancelled!")
 
 async def tag_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Tag all admins"""
@@ -1124,8 +3878,11 @@ async def set_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) >= 1:
         chat_id = str(update.effective_chat.id)
         rules_text = " ".join(context.args)
+        if "rules" in notes[chat_id]:
+            unindex_note(chat_id, "rules")
         notes[chat_id]["rules"] = rules_text
-        save_data(NOTES_FILE, notes)
+        index_note(chat_id, "rules")
+        await save_chat("notes", chat_id)
         await update.message.reply_text("✅ Rules updated!")
     else:
         await update.message.reply_text("❌ Usage: /setrules <rules>")
@@ -1136,6 +3893,10 @@ async def show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if "rules" in notes[chat_id]:
         rules = notes[chat_id]["rules"]
+        # Rules share the notes namespace, so /save rules may have stored media
+        if not isinstance(rules, str):
+            await send_note(update.message, rules)
+            return
         await update.message.reply_text(
             f"📜 <b>Group Rules</b>\n\n{rules}",
             parse_mode=ParseMode.HTML
@@ -1217,66 +3978,391 @@ async def blacklist_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         if user_id not in user_blacklist[chat_id]:
             user_blacklist[chat_id].append(user_id)
-            save_data(BLACKLIST_FILE, user_blacklist)
+            await save_chat("blacklist", chat_id)
             await update.message.reply_text(f"⛔ <b>{user_name}</b> blacklisted!", parse_mode=ParseMode.HTML)
         else:
             await update.message.reply_text("❌ User already blacklisted!")
 
-async def unblacklist_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Remove from blacklist"""
-    if not await is_admin(update, context):
+async def unblacklist_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Remove from blacklist"""
+    if not await is_admin(update, context):
+        return
+    
+    if update.message.reply_to_message:
+        chat_id = str(update.effective_chat.id)
+        user_id = str(update.message.reply_to_message.from_user.id)
+        user_name = update.message.reply_to_message.from_user.first_name
+        
+        if user_id in user_blacklist[chat_id]:
+            user_blacklist[chat_id].remove(user_id)
+            await save_chat("blacklist", chat_id)
+            await update.message.reply_text(f"✅ <b>{user_name}</b> removed from blacklist!", parse_mode=ParseMode.HTML)
+        else:
+            await update.message.reply_text("❌ User not in blacklist!")
+
+async def check_blacklist(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Check if user is blacklisted"""
+    if update.message:
+        chat_id = str(update.effective_chat.id)
+        user_id = str(update.message.from_user.id)
+        
+        if user_id in user_blacklist[chat_id]:
+            try:
+                await delete_message(context.bot, update.message)
+                # A blacklisted user's backlog messages need only one ban
+                if (chat_id, user_id) not in stale_bans:
+                    if update_stale.get():
+                        stale_bans.add((chat_id, user_id))
+                    await context.bot.ban_chat_member(update.effective_chat.id, int(user_id))
+                    audit(chat_id, "blacklist", update.message.from_user)
+            except:
+                pass
+
+# ==================== FEDERATIONS ====================
+
+# Federation bans are applied to member chats at most this many calls per second
+FED_BAN_RATE = 20
+# How often changes made by other workers or instances are picked up
+FED_SYNC_INTERVAL = 10
+
+# fed_id -> {"name", "owner", "admins", "chats"}. Name and owner are stored as JSON under
+# "fed:<fed_id>"; member chats and admins as the "fedchats:<fed_id>" and "fedadmins:<fed_id>"
+# hashes, changed one field at a time so workers never overwrite each other's changes.
+# A member chat also records its federation in its settings document.
+federations = {}
+# fed_id -> banned user ids, the index checked on every message and join.
+# Stored as the "fedbans:<fed_id>" hash of user id -> reason.
+fed_bans = defaultdict(set)
+# Value of the "fedsync" change counter the index was loaded at
+fed_sync = {"version": None}
+# (fed_id, user_id) -> running ban/unban job
+fed_jobs = {}
+
+async def load_federations():
+    """Rebuild the federation index from the state backend"""
+    version = await state.get("fedsync")
+    keys = await state.keys("fed:")
+    loaded, bans = {}, defaultdict(set)
+    for key, raw in zip(keys, await state.get_many(keys)):
+        if raw is None:
+            continue
+        fed_id = key.split(":", 1)[1]
+        fed = json.loads(raw)
+        # Federations saved before members were hashes keep them in the document
+        legacy = {kind: fed.pop(kind, []) for kind in ("chats", "admins")}
+        if any(legacy.values()):
+            for kind, members in legacy.items():
+                if members:
+                    await state.hset(f"fed{kind}:{fed_id}", {str(m): 1 for m in members})
+            await state.set(key, json.dumps(fed))
+        fed["chats"] = list(await state.hgetall(f"fedchats:{fed_id}"))
+        fed["admins"] = [int(user_id) for user_id in await state.hgetall(f"fedadmins:{fed_id}")]
+        loaded[fed_id] = fed
+        bans[fed_id] = {int(user_id) for user_id in await state.hgetall(f"fedbans:{fed_id}")}
+    federations.clear()
+    federations.update(loaded)
+    fed_bans.clear()
+    fed_bans.update(bans)
+    fed_sync["version"] = version
+    logger.info("Loaded %d federations with %d bans", len(loaded), sum(map(len, bans.values())))
+
+async def federation_changed():
+    """Tell other processes to reload; ours is already up to date unless it missed a change"""
+    version = await state.incr("fedsync")
+    loaded = fed_sync["version"]
+    if loaded == str(version - 1) or (loaded is None and version == 1):
+        fed_sync["version"] = str(version)
+
+async def federation_syncer():
+    """Background task reloading the index when another process changed it"""
+    while True:
+        await asyncio.sleep(FED_SYNC_INTERVAL)
+        try:
+            if await state.get("fedsync") != fed_sync["version"]:
+                await load_federations()
+        except Exception as e:
+            logger.error("Error syncing federations: %s", e)
+
+async def save_federation(fed_id):
+    fed = federations[fed_id]
+    await state.set(f"fed:{fed_id}", json.dumps({"name": fed["name"], "owner": fed["owner"]}))
+    await federation_changed()
+
+async def update_federation(fed_id, kind, member, add):
+    """Add or remove one member chat or admin with a single hash field write"""
+    key = f"fed{kind}:{fed_id}"
+    if add:
+        await state.hset(key, {str(member): 1})
+    else:
+        await state.hdel(key, str(member))
+    members = federations[fed_id][kind]
+    if add and member not in members:
+        members.append(member)
+    elif not add and member in members:
+        members.remove(member)
+    await federation_changed()
+
+def chat_federation(chat_id):
+    """The federation a chat belongs to as (fed_id, fed), or (None, None)"""
+    fed_id = settings[chat_id].get("federation")
+    fed = federations.get(fed_id)
+    return (fed_id, fed) if fed else (None, None)
+
+def is_fed_admin(fed, user_id):
+    return user_id == fed["owner"] or user_id in fed["admins"]
+
+def fed_target(message, args):
+    """User id and display name of a command's target: the replied user or a numeric id"""
+    if message.reply_to_message and message.reply_to_message.from_user:
+        user = message.reply_to_message.from_user
+        return user.id, user.first_name, args
+    if args and args[0].lstrip("-").isdigit():
+        return int(args[0]), args[0], args[1:]
+    return None, None, args
+
+def fed_target_user(message, user_id):
+    """The replied User when the target came from a reply, for richer log records"""
+    reply = message.reply_to_message
+    return reply.from_user if reply and reply.from_user and reply.from_user.id == user_id else user_id
+
+async def run_fed_job(bot, fed_id, user_id, ban, status):
+    """Ban or unban a user in every member chat, paced and reporting progress"""
+    # Read fresh, so chats joined on other workers since the last sync are included
+    chats = list(await state.hgetall(f"fedchats:{fed_id}"))
+    verb = "Banning in federation chats" if ban else "Unbanning in federation chats"
+    
+    async def apply(chat):
+        if ban:
+            await bot.ban_chat_member(int(chat), user_id)
+        else:
+            await bot.unban_chat_member(int(chat), user_id, only_if_banned=True)
+    
+    try:
+        done, failures = await run_bulk(chats, apply, status, verb, rate=FED_BAN_RATE)
+        await status.edit_text(bulk_summary("Banned in" if ban else "Unbanned in", done, len(chats), failures, "federation chats"))
+    finally:
+        if fed_jobs.get((fed_id, user_id)) is asyncio.current_task():
+            del fed_jobs[(fed_id, user_id)]
+
+def start_fed_job(application, fed_id, user_id, ban, status):
+    """Run a ban job in the background, replacing one still running for the same user"""
+    previous = fed_jobs.pop((fed_id, user_id), None)
+    if previous is not None:
+        previous.cancel()
+    fed_jobs[(fed_id, user_id)] = application.create_task(run_fed_job(application.bot, fed_id, user_id, ban, status))
+
+async def new_fed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Create a federation owned by the caller"""
+    if not context.args:
+        await update.message.reply_text("❌ Usage: /newfed <name>")
+        return
+    fed_id = secrets.token_hex(6)
+    name = " ".join(context.args)
+    federations[fed_id] = {"name": name, "owner": update.effective_user.id, "admins": [], "chats": []}
+    await save_federation(fed_id)
+    await update.message.reply_text(
+        f"🏛 Federation <b>{html.escape(name)}</b> created!\n\n"
+        f"ID: <code>{fed_id}</code>\nUse /joinfed {fed_id} in each of your groups.",
+        parse_mode=ParseMode.HTML
+    )
+
+async def join_fed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Add this chat to a federation, leaving its previous one"""
+    if not await is_admin(update, context):
+        return
+    if not context.args or context.args[0] not in federations:
+        await update.message.reply_text("❌ Usage: /joinfed <federation id>")
+        return
+    chat_id = str(update.effective_chat.id)
+    fed_id = context.args[0]
+    old_id, old = chat_federation(chat_id)
+    if old_id == fed_id:
+        await update.message.reply_text("❌ This chat is already in that federation!")
+        return
+    if old:
+        await update_federation(old_id, "chats", chat_id, False)
+    await update_federation(fed_id, "chats", chat_id, True)
+    await set_setting(chat_id, "federation", fed_id)
+    fed = federations[fed_id]
+    await update.message.reply_text(
+        f"🏛 Joined federation <b>{html.escape(fed['name'])}</b> ({len(fed_bans[fed_id])} bans)!",
+        parse_mode=ParseMode.HTML
+    )
+
+async def leave_fed(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Remove this chat from its federation"""
+    if not await is_admin(update, context):
+        return
+    chat_id = str(update.effective_chat.id)
+    fed_id, fed = chat_federation(chat_id)
+    if fed is None:
+        await update.message.reply_text("❌ This chat is not in a federation!")
+        return
+    await update_federation(fed_id, "chats", chat_id, False)
+    settings[chat_id].pop("federation", None)
+    await save_chat("settings", chat_id)
+    await update.message.reply_text(f"✅ Left federation <b>{html.escape(fed['name'])}</b>!", parse_mode=ParseMode.HTML)
+
+async def fed_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show this chat's federation, or the one with the given id"""
+    if context.args:
+        fed_id, fed = context.args[0], federations.get(context.args[0])
+    else:
+        fed_id, fed = chat_federation(str(update.effective_chat.id))
+    if fed is None:
+        await update.message.reply_text("❌ No federation found! Usage: /fedinfo [federation id]")
+        return
+    text = f"""
+🏛 <b>Federation:</b> {html.escape(fed['name'])}
+
+<b>ID:</b> <code>{fed_id}</code>
+<b>Owner:</b> <code>{fed['owner']}</code>
+<b>Admins:</b> {len(fed['admins'])}
+<b>Chats:</b> {len(fed['chats'])}
+<b>Bans:</b> {len(fed_bans[fed_id])}
+    """
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+async def fed_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Owner only: make the replied user a federation admin, or remove them"""
+    fed_id, fed = chat_federation(str(update.effective_chat.id))
+    if fed is None or update.effective_user.id != fed["owner"]:
+        await update.message.reply_text("❌ Only the federation owner can do this!")
+        return
+    user_id, name, _ = fed_target(update.message, context.args)
+    if user_id is None:
+        await update.message.reply_text("❌ Reply to a user or give their id!")
+        return
+    if user_id in fed["admins"]:
+        await update_federation(fed_id, "admins", user_id, False)
+        text = f"✅ <b>{html.escape(name)}</b> is no longer a federation admin!"
+    else:
+        await update_federation(fed_id, "admins", user_id, True)
+        text = f"✅ <b>{html.escape(name)}</b> is now a federation admin!"
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+async def fed_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ban a user in every chat of this chat's federation"""
+    fed_id, fed = chat_federation(str(update.effective_chat.id))
+    if fed is None or not is_fed_admin(fed, update.effective_user.id):
+        await update.message.reply_text("❌ This command is only for federation admins!")
+        return
+    user_id, name, rest = fed_target(update.message, context.args)
+    if user_id is None:
+        await update.message.reply_text("❌ Usage: reply with /fban [reason] or /fban <user_id> [reason]")
+        return
+    if is_fed_admin(fed, user_id):
+        await update.message.reply_text("❌ Federation admins can't be banned!")
+        return
+    reason = " ".join(rest) or "No reason"
+    await state.hset(f"fedbans:{fed_id}", {str(user_id): reason})
+    fed_bans[fed_id].add(user_id)
+    await federation_changed()
+    audit(update.effective_chat.id, "fban", fed_target_user(update.message, user_id), update.effective_user, reason=reason)
+    await update.message.reply_text(
+        f"🏛 <b>{html.escape(name)}</b> banned in federation <b>{html.escape(fed['name'])}</b>\n"
+        f"Reason: {html.escape(reason)}",
+        parse_mode=ParseMode.HTML
+    )
+    start_fed_job(context.application, fed_id, user_id, True,
+                  await update.message.reply_text(f"⏳ Banning in federation chats: 0/{len(fed['chats'])}"))
+
+async def fed_unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lift a federation ban in every member chat"""
+    fed_id, fed = chat_federation(str(update.effective_chat.id))
+    if fed is None or not is_fed_admin(fed, update.effective_user.id):
+        await update.message.reply_text("❌ This command is only for federation admins!")
+        return
+    user_id, name, _ = fed_target(update.message, context.args)
+    if user_id is None or user_id not in fed_bans[fed_id]:
+        await update.message.reply_text("❌ That user is not banned in this federation!")
+        return
+    await state.hdel(f"fedbans:{fed_id}", str(user_id))
+    fed_bans[fed_id].discard(user_id)
+    await federation_changed()
+    audit(update.effective_chat.id, "unfban", fed_target_user(update.message, user_id), update.effective_user)
+    start_fed_job(context.application, fed_id, user_id, False,
+                  await update.message.reply_text(f"⏳ Unbanning in federation chats: 0/{len(fed['chats'])}"))
+
+async def check_fed_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ban federation-banned users as soon as they post or join"""
+    message = update.message
+    if not message:
+        return
+    chat_id = str(message.chat.id)
+    banned = fed_bans.get(settings[chat_id].get("federation"))
+    if not banned:
+        return
+    users = message.new_chat_members or ([message.from_user] if message.from_user else [])
+    offenders = [user for user in users if user.id in banned]
+    if not offenders:
         return
-    
-    if update.message.reply_to_message:
-        chat_id = str(update.effective_chat.id)
-        user_id = str(update.message.reply_to_message.from_user.id)
-        user_name = update.message.reply_to_message.from_user.first_name
-        
-        if user_id in user_blacklist[chat_id]:
-            user_blacklist[chat_id].remove(user_id)
-            save_data(BLACKLIST_FILE, user_blacklist)
-            await update.message.reply_text(f"✅ <b>{user_name}</b> removed from blacklist!", parse_mode=ParseMode.HTML)
-        else:
-            await update.message.reply_text("❌ User not in blacklist!")
 
-async def check_blacklist(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Check if user is blacklisted"""
-    if update.message:
-        chat_id = str(update.effective_chat.id)
-        user_id = str(update.message.from_user.id)
-        
-        if user_id in user_blacklist[chat_id]:
-            try:
-                await update.message.delete()
-                await context.bot.ban_chat_member(update.effective_chat.id, int(user_id))
-            except:
-                pass
+    try:
+        if not message.new_chat_members:
+            await delete_message(context.bot, message)
+        for user in offenders:
+            # Ban once per catch-up however many backlog messages they sent
+            if (chat_id, str(user.id)) in stale_bans:
+                continue
+            if update_stale.get():
+                stale_bans.add((chat_id, str(user.id)))
+            await context.bot.ban_chat_member(message.chat.id, user.id)
+            audit(chat_id, "fban", user, reason="federation ban")
+            await post_notice(context.bot, chat_id, f"🏛 {user.mention_html()} is banned in this chat's federation!")
+    except Exception as e:
+        logger.error("Error enforcing federation ban: %s", e, extra={"chat_id": chat_id})
 
 # ==================== ANTI-FLOOD ====================
 
+# More than FLOOD_MESSAGE_LIMIT messages within any FLOOD_WINDOW_SECONDS is flooding
+FLOOD_MESSAGE_LIMIT = 5
+FLOOD_WINDOW_SECONDS = 5
+
+# (current window count, previous window count) of the sender, fetched by load_chat_state
+flood_counts = contextvars.ContextVar("flood_counts", default=None)
+
+def flood_window(chat_id, message):
+    """Counter keys of the sender's current and previous window, and the
+    share of the previous window still within FLOOD_WINDOW_SECONDS.
+    
+    Windows follow Telegram's timestamps, so a replayed backlog isn't one burst.
+    """
+    timestamp = message.date.timestamp()
+    window = int(timestamp) // FLOOD_WINDOW_SECONDS
+    prefix = f"flood:{chat_id}:{message.from_user.id}"
+    overlap = 1 - (timestamp - window * FLOOD_WINDOW_SECONDS) / FLOOD_WINDOW_SECONDS
+    return f"{prefix}:{window}", f"{prefix}:{window - 1}", overlap
+
 async def check_flood(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check for message flooding"""
+    if not update.message:
+        return
+    
     chat_id = str(update.effective_chat.id)
     
     if not settings[chat_id].get("antiflood", False):
         return
     
     user_id = str(update.message.from_user.id)
-    current_time = datetime.now()
-    
-    # Add message timestamp
-    flood_control[chat_id][user_id].append(current_time)
     
-    # Remove messages older than 5 seconds
-    flood_control[chat_id][user_id] = [
-        t for t in flood_control[chat_id][user_id]
-        if (current_time - t).seconds < 5
-    ]
+    # Atomic per-user counters per window of message time, shared by all instances.
+    # The sliding window count is the current window's plus the previous window's,
+    # weighted by how much of it still lies within FLOOD_WINDOW_SECONDS.
+    flood_key, previous_key, overlap = flood_window(chat_id, update.message)
+    counts = flood_counts.get()
+    if counts is None:
+        # The settings loaded for this update just switched antiflood on
+        raws, count = await state.get_many_incr([previous_key], flood_key, ttl=FLOOD_WINDOW_SECONDS * 2)
+        counts = (count, int(raws[0] or 0))
+    count, previous = counts
     
-    # Check if more than 5 messages in 5 seconds
-    if len(flood_control[chat_id][user_id]) > 5:
+    if count + previous * overlap > FLOOD_MESSAGE_LIMIT:
         try:
-            await update.message.delete()
+            await delete_message(context.bot, update.message)
+            # A mute starting now would punish a flood from hours ago
+            if update_stale.get():
+                return
             permissions = ChatPermissions(can_send_messages=False)
             await context.bot.restrict_chat_member(
                 update.effective_chat.id,
@@ -1284,32 +4370,447 @@ async def check_flood(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 permissions,
                 until_date=datetime.now() + timedelta(minutes=5)
             )
-            await context.bot.send_message(
+            audit(chat_id, "flood", update.message.from_user, reason="muted for 5 minutes")
+            await post_notice(
+                context.bot,
                 chat_id,
-                f"🌊 {update.message.from_user.mention_html()} muted for 5 minutes (Flooding)",
-                parse_mode=ParseMode.HTML
+                f"🌊 {update.message.from_user.mention_html()} muted for 5 minutes (Flooding)"
             )
-            flood_control[chat_id][user_id] = []
+            await state.delete(flood_key, previous_key)
         except:
             pass
 
+# ==================== ANTI-RAID ====================
+
+# Same or nearly the same text from more than SPAM_USER_LIMIT distinct users
+# within SPAM_WINDOW_SECONDS is a spam wave
+SPAM_USER_LIMIT = 4
+SPAM_WINDOW_SECONDS = 60
+# Fingerprints kept per chat; older ones are dropped even inside the window
+SPAM_WINDOW_SIZE = 500
+# Shorter messages ("hi", "good morning") are too common to fingerprint
+SPAM_MIN_LENGTH = 20
+# Only this much of a message is fingerprinted, so long texts cost the same
+SPAM_MAX_LENGTH = 300
+# Near duplicates are found with one-permutation MinHash: SPAM_MINHASH_BINS
+# minimums, banded SPAM_BAND_ROWS at a time so that texts sharing most of their
+# 4-grams almost surely share a band, then confirmed by the bins they agree on
+SPAM_MINHASH_BINS = 32
+SPAM_BAND_ROWS = 4
+SPAM_SIMILARITY = 0.6
+SPAM_MUTE_HOURS = 1
+
+SPAM_NORMALIZE = re.compile(r"[\W_]+")
+
+def normalize_spam_text(text):
+    """Case, width and punctuation folded away, so trivial variations look alike"""
+    text = unicodedata.normalize("NFKC", text[:SPAM_MAX_LENGTH * 2]).casefold()
+    return SPAM_NORMALIZE.sub(" ", text).strip()[:SPAM_MAX_LENGTH]
+
+def minhash(text):
+    """Smallest 4-gram hash in each bin of the hash space, in one pass over the text"""
+    bins = [None] * SPAM_MINHASH_BINS
+    for i in range(max(len(text) - 3, 1)):
+        value = hash(text[i:i + 4]) & 0xFFFFFFFFFFFFFFFF
+        index = value % SPAM_MINHASH_BINS
+        if bins[index] is None or value < bins[index]:
+            bins[index] = value
+    # Short texts leave bins empty; each borrows the next filled bin, tagged with
+    # how far it looked, so equal texts still get equal signatures
+    signature = list(bins)
+    for index, value in enumerate(bins):
+        distance = 1
+        while value is None:
+            value = bins[(index + distance) % SPAM_MINHASH_BINS]
+            if value is not None:
+                value += distance << 64
+            distance += 1
+        signature[index] = value
+    return tuple(signature)
+
+def minhash_bands(signature):
+    rows = SPAM_BAND_ROWS
+    return [(i, signature[i:i + rows]) for i in range(0, len(signature), rows)]
+
+def minhash_similarity(a, b):
+    """Estimated Jaccard similarity of the 4-gram sets behind two signatures"""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+class SpamCluster:
+    """Recent messages of one text: who sent it and which messages await action"""
+
+    __slots__ = ("signature", "exact", "users", "pending", "punished")
+
+    def __init__(self, signature):
+        self.signature = signature
+        self.exact = []
+        self.users = Counter()
+        self.pending = {}
+        self.punished = set()
+
+class SpamWindow:
+    """One chat's recent message fingerprints, grouped into near-duplicate clusters.
+
+    Exact hashes and MinHash bands index the clusters, so each message costs a
+    few dict lookups regardless of how many fingerprints the window holds.
+    """
+
+    def __init__(self):
+        self.entries = deque()
+        self.exact = {}
+        self.bands = {}
+
+    def expire(self, now):
+        while self.entries and (self.entries[0][0] <= now - SPAM_WINDOW_SECONDS or len(self.entries) > SPAM_WINDOW_SIZE):
+            _, cluster, user_id, message_id = self.entries.popleft()
+            cluster.pending.pop(message_id, None)
+            cluster.users[user_id] -= 1
+            if cluster.users[user_id] <= 0:
+                del cluster.users[user_id]
+            if not cluster.users:
+                self.drop(cluster)
+
+    def drop(self, cluster):
+        for key in cluster.exact:
+            if self.exact.get(key) is cluster:
+                del self.exact[key]
+        for key in minhash_bands(cluster.signature):
+            if self.bands.get(key) is cluster:
+                del self.bands[key]
+
+    def find(self, text):
+        """Cluster for a normalized text, creating one if nothing is close enough"""
+        exact = hash(text)
+        cluster = self.exact.get(exact)
+        if cluster is not None:
+            return cluster
+        signature = minhash(text)
+        bands = minhash_bands(signature)
+        for key in bands:
+            candidate = self.bands.get(key)
+            if candidate is not None and minhash_similarity(candidate.signature, signature) >= SPAM_SIMILARITY:
+                cluster = candidate
+                break
+        else:
+            cluster = SpamCluster(signature)
+            for key in bands:
+                self.bands.setdefault(key, cluster)
+        cluster.exact.append(exact)
+        self.exact[exact] = cluster
+        return cluster
+
+    def add(self, text, user_id, message_id, now):
+        """Record a message and return its cluster"""
+        self.expire(now)
+        cluster = self.find(text)
+        cluster.users[user_id] += 1
+        cluster.pending[message_id] = user_id
+        self.entries.append((now, cluster, user_id, message_id))
+        return cluster
+
+spam_windows = defaultdict(SpamWindow)
+
+async def punish_spam_wave(bot, chat, cluster):
+    """Delete every pending message of a spam wave and mute its senders"""
+    pending, cluster.pending = cluster.pending, {}
+    new_users = [user_id for user_id in set(pending.values()) if user_id not in cluster.punished]
+    cluster.punished.update(new_users)
+    # Admins quoting the spam are left alone; only users new to this wave need a lookup
+    members = await asyncio.gather(*(bot.get_chat_member(chat.id, user_id) for user_id in new_users), return_exceptions=True)
+    exempt = {
+        user_id for user_id, member in zip(new_users, members)
+        if not isinstance(member, Exception) and member.status in ("creator", "administrator")
+    }
+    message_ids = [message_id for message_id, user_id in pending.items() if user_id not in exempt]
+    offenders = [user_id for user_id in new_users if user_id not in exempt]
+    try:
+        await delete_messages(bot, chat.id, message_ids)
+    except Exception as e:
+        logger.error("Error deleting spam wave: %s", e, extra={"chat_id": chat.id})
+    # A mute starting now would punish a raid from hours ago
+    if update_stale.get() or not offenders:
+        return
+    until = datetime.now() + timedelta(hours=SPAM_MUTE_HOURS)
+    permissions = ChatPermissions(can_send_messages=False)
+    results = await asyncio.gather(
+        *(bot.restrict_chat_member(chat.id, user_id, permissions, until_date=until) for user_id in offenders),
+        return_exceptions=True
+    )
+    for user_id, error in zip(offenders, results):
+        if isinstance(error, Exception):
+            logger.error("Error muting spam wave sender: %s", error, extra={"chat_id": chat.id})
+        else:
+            count = sum(1 for sender in pending.values() if sender == user_id)
+            audit(chat.id, "spam", user_id, reason=f"muted for {SPAM_MUTE_HOURS}h", count=count)
+    logger.info("Spam wave: %d messages from %d users", len(message_ids), len(offenders), extra={"chat_id": chat.id})
+    await post_notice(
+        bot,
+        str(chat.id),
+        f"🛡️ Spam wave stopped: {len(message_ids)} messages deleted, {len(offenders)} users muted for {SPAM_MUTE_HOURS}h"
+    )
+
+async def check_spam_wave(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Catch the same text posted by many accounts, which per-user flood checks miss"""
+    message = update.message
+    # Anonymous admins post as the group itself
+    if not message or not message.from_user or (message.sender_chat and message.sender_chat.id == message.chat.id):
+        return
+    chat_id = str(message.chat.id)
+    if not settings[chat_id].get("antiraid", False):
+        return
+    text = normalize_spam_text(message.text or message.caption or "")
+    if len(text) < SPAM_MIN_LENGTH:
+        return
+
+    cluster = spam_windows[chat_id].add(text, message.from_user.id, message.message_id, message.date.timestamp())
+    if len(cluster.users) > SPAM_USER_LIMIT:
+        await punish_spam_wave(context.bot, message.chat, cluster)
+
 # ==================== STATS SYSTEM ====================
 
+# Per-chat message counts live in fixed-size rings: one bucket per hour for the
+# last ACTIVITY_HOURS hours and one per day for the last ACTIVITY_DAYS days.
+# Hours that fall off the hourly ring are rolled up into their day.
+ACTIVITY_HOURS = 30 * 24
+ACTIVITY_DAYS = 365
+# How often new counts are written to the state backend
+ACTIVITY_FLUSH_INTERVAL = 30
+# Per-user counts kept per chat; after ACTIVITY_USERS_TRIM new users the hash is cut back
+# to the ACTIVITY_USERS_LIMIT most active
+ACTIVITY_USERS_LIMIT = 5000
+ACTIVITY_USERS_TRIM = 1000
+# /stats ranges: hours covered, bucket size in hours
+STATS_RANGES = {"24h": (24, 1), "7d": (7 * 24, 24), "30d": (30 * 24, 24)}
+SPARKLINE = "▁▂▃▄▅▆▇█"
+
+class ActivityRing:
+    """Counts for the `size` most recent periods in one array; `last` is the newest"""
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = array("I", [0]) * size
+        self.last = None
+
+    def advance(self, period):
+        """Move the window forward to end at `period`; returns the (period, count) pairs that fell off"""
+        if self.last is None:
+            self.last = period
+            return []
+        if period <= self.last:
+            return []
+        evicted = []
+        for old in range(self.last - self.size + 1, min(self.last, period - self.size) + 1):
+            slot = old % self.size
+            if self.counts[slot]:
+                evicted.append((old, self.counts[slot]))
+                self.counts[slot] = 0
+        self.last = period
+        return evicted
+
+    def holds(self, period):
+        return self.last is not None and self.last - self.size < period <= self.last
+
+    def get(self, period):
+        return self.counts[period % self.size] if self.holds(period) else 0
+
+class ChatActivity:
+    """Message counts of one chat plus the changes not yet written to the backend"""
+
+    __slots__ = ("hours", "days", "new_hours", "new_days", "dropped_hours", "dropped_days", "new_chatters", "new_users")
+
+    def __init__(self):
+        self.hours = ActivityRing(ACTIVITY_HOURS)
+        self.days = ActivityRing(ACTIVITY_DAYS)
+        self.new_hours = Counter()
+        self.new_days = Counter()
+        self.dropped_hours = set()
+        self.dropped_days = set()
+        self.new_chatters = Counter()
+        self.new_users = 0
+
+    def advance(self, hour):
+        """Bring both rings up to `hour`, rolling expired hours up into days"""
+        for old, count in self.hours.advance(hour):
+            self.new_hours.pop(old, None)
+            self.dropped_hours.add(old)
+            self.add_day(old // 24, count)
+        self.advance_days(hour // 24)
+
+    def advance_days(self, day):
+        for old, _ in self.days.advance(day):
+            self.new_days.pop(old, None)
+            self.dropped_days.add(old)
+
+    def add_day(self, day, count):
+        self.advance_days(day)
+        if self.days.holds(day):
+            self.days.counts[day % ACTIVITY_DAYS] += count
+            self.new_days[day] += count
+
+    def add(self, timestamp, count=1):
+        hour = int(timestamp) // 3600
+        self.advance(hour)
+        if self.hours.holds(hour):
+            self.hours.counts[hour % ACTIVITY_HOURS] += count
+            self.new_hours[hour] += count
+        else:
+            # Backlog older than the hourly ring goes straight into its day
+            self.add_day(hour // 24, count)
+
+    def hour_counts(self, end, length):
+        """Counts of the `length` hours ending at `end`, oldest first"""
+        return [self.hours.get(hour) for hour in range(end - length + 1, end + 1)]
+
+    def day_total(self, day):
+        """A day's count: its rolled-up part plus its hours still in the hourly ring"""
+        return self.days.get(day) + sum(self.hours.get(hour) for hour in range(day * 24, day * 24 + 24))
+
+chat_activity = {}
+activity_loads = {}
+
+async def load_activity(chat_id):
+    """Rebuild a chat's rings from the backend, rolling up hours that expired meanwhile"""
+    activity = ChatActivity()
+    activity.advance(int(time.time()) // 3600)
+    for day, count in (await state.hgetall(f"activity_days:{chat_id}")).items():
+        day = int(day)
+        if activity.days.holds(day):
+            activity.days.counts[day % ACTIVITY_DAYS] += int(count)
+        else:
+            activity.dropped_days.add(day)
+    for hour, count in (await state.hgetall(f"activity_hours:{chat_id}")).items():
+        hour = int(hour)
+        if activity.hours.holds(hour):
+            activity.hours.counts[hour % ACTIVITY_HOURS] = int(count)
+        else:
+            activity.dropped_hours.add(hour)
+            activity.add_day(hour // 24, int(count))
+    return activity
+
+async def get_activity(chat_id):
+    """A chat's activity, loaded from the backend on first use"""
+    activity = chat_activity.get(chat_id)
+    if activity is not None:
+        return activity
+    task = activity_loads.get(chat_id)
+    if task is None:
+        task = activity_loads[chat_id] = asyncio.ensure_future(load_activity(chat_id))
+    try:
+        activity = chat_activity[chat_id] = await task
+    finally:
+        activity_loads.pop(chat_id, None)
+    return activity
+
+async def flush_activity(chat_id, activity):
+    """Write a chat's new counts as increments, so nothing already stored is rewritten"""
+    new_hours, activity.new_hours = activity.new_hours, Counter()
+    new_days, activity.new_days = activity.new_days, Counter()
+    dropped_hours, activity.dropped_hours = activity.dropped_hours, set()
+    dropped_days, activity.dropped_days = activity.dropped_days, set()
+    new_chatters, activity.new_chatters = activity.new_chatters, Counter()
+    hours, days, chatters = list(new_hours.items()), list(new_days.items()), list(new_chatters.items())
+    results = await asyncio.gather(
+        *(state.hincr(f"activity_hours:{chat_id}", str(hour), count) for hour, count in hours),
+        *(state.hincr(f"activity_days:{chat_id}", str(day), count) for day, count in days),
+        *(state.hincr(f"activity:{chat_id}", user_id, count) for user_id, count in chatters),
+        return_exceptions=True
+    )
+    # Increments that failed go back to the next flush, unless their bucket has expired meanwhile
+    errors = [result for result in results if isinstance(result, Exception)]
+    for (hour, count), result in zip(hours, results):
+        if isinstance(result, Exception) and activity.hours.holds(hour):
+            activity.new_hours[hour] += count
+    for (day, count), result in zip(days, results[len(hours):]):
+        if isinstance(result, Exception) and activity.days.holds(day):
+            activity.new_days[day] += count
+    for (user_id, count), result in zip(chatters, results[len(hours) + len(days):]):
+        if isinstance(result, Exception):
+            activity.new_chatters[user_id] += count
+        elif result == count:
+            activity.new_users += 1
+    try:
+        await state.hdel(f"activity_hours:{chat_id}", *map(str, dropped_hours))
+        await state.hdel(f"activity_days:{chat_id}", *map(str, dropped_days))
+    except Exception:
+        activity.dropped_hours |= dropped_hours
+        activity.dropped_days |= dropped_days
+        raise
+    if errors:
+        raise errors[0]
+    if activity.new_users >= ACTIVITY_USERS_TRIM:
+        activity.new_users = 0
+        await trim_chatters(chat_id)
+
+async def flush_all_activity():
+    for chat_id, activity in list(chat_activity.items()):
+        if (activity.new_hours or activity.new_days or activity.new_chatters
+                or activity.dropped_hours or activity.dropped_days):
+            try:
+                await flush_activity(chat_id, activity)
+            except Exception as e:
+                logger.error("Error saving activity: %s", e, extra={"chat_id": chat_id})
+
+async def activity_flusher():
+    """Background task persisting activity counters"""
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        await flush_all_activity()
+
+def sparkline(values):
+    top = max(values) or 1
+    return "".join(SPARKLINE[round(v * (len(SPARKLINE) - 1) / top)] for v in values)
+
+def trend(current, previous):
+    if not previous:
+        return "new" if current else "–"
+    change = (current - previous) * 100 / previous
+    return f"{'📈' if change >= 0 else '📉'} {change:+.0f}%"
+
+def activity_report(activity, range_name, now):
+    """Totals, trend, buckets and busiest hours for one /stats range"""
+    hours, step = STATS_RANGES[range_name]
+    hour = int(now) // 3600
+    activity.advance(hour)
+    if step == 1:
+        buckets = activity.hour_counts(hour, hours)
+        previous = sum(activity.hour_counts(hour - hours, hours))
+    else:
+        day = hour // 24
+        days = hours // 24
+        buckets = [activity.day_total(d) for d in range(day - days + 1, day + 1)]
+        previous = sum(activity.day_total(d) for d in range(day - 2 * days + 1, day - days + 1))
+    # Busiest hours of the day (UTC) over the range, from the hourly ring
+    by_hour = Counter()
+    for offset, count in enumerate(activity.hour_counts(hour, hours)):
+        if count:
+            by_hour[(hour - hours + 1 + offset) % 24] += count
+    return sum(buckets), previous, buckets, by_hour.most_common(3)
+
 async def group_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show group statistics"""
+    """Show group statistics for the last 24h, 7d or 30d"""
     chat_id = str(update.effective_chat.id)
+    range_name = context.args[0].lower() if context.args else "24h"
+    if range_name not in STATS_RANGES:
+        await update.message.reply_text(f"❌ Usage: /stats [{'|'.join(STATS_RANGES)}]")
+        return
     
-    total_messages = sum(user_activity[chat_id].values())
+    activity = await get_activity(chat_id)
+    total, previous, buckets, busiest = activity_report(activity, range_name, time.time())
+    members = Counter({user_id: int(count) for user_id, count in (await state.hgetall(f"activity:{chat_id}")).items()})
+    members.update(activity.new_chatters)
     member_count = await context.bot.get_chat_member_count(update.effective_chat.id)
     
     # Top 5 chatters
-    top_users = sorted(user_activity[chat_id].items(), key=lambda x: x[1], reverse=True)[:5]
+    top_users = sorted(members.items(), key=lambda x: x[1], reverse=True)[:5]
+    busiest_text = ", ".join(f"{h:02d}:00" for h, _ in busiest) or "–"
     
     text = f"""
-📊 <b>Group Statistics</b>
+📊 <b>Group Statistics</b> ({range_name})
 
 <b>Total Members:</b> {member_count}
-<b>Total Messages:</b> {total_messages}
+<b>Messages:</b> {total} ({trend(total, previous)} vs previous {range_name})
+<b>Activity:</b> <code>{sparkline(buckets)}</code>
+<b>Busiest Hours (UTC):</b> {busiest_text}
 <b>Active Filters:</b> {len(word_filters[chat_id])}
 <b>Saved Notes:</b> {len(notes[chat_id])}
 
@@ -1330,44 +4831,756 @@ async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message:
         chat_id = str(update.effective_chat.id)
         user_id = str(update.message.from_user.id)
-        user_activity[chat_id][user_id] += 1
+        activity = await get_activity(chat_id)
+        activity.add(update.message.date.timestamp())
+        # Written by the next flush along with the rings
+        activity.new_chatters[user_id] += 1
+
+async def trim_chatters(chat_id):
+    """Cut a chat's per-user counts back to its ACTIVITY_USERS_LIMIT most active users"""
+    counts = await state.hgetall(f"activity:{chat_id}")
+    if len(counts) > ACTIVITY_USERS_LIMIT:
+        keep = set(heapq.nlargest(ACTIVITY_USERS_LIMIT, counts, key=lambda user_id: int(counts[user_id])))
+        await state.hdel(f"activity:{chat_id}", *(user_id for user_id in counts if user_id not in keep))
 
 # ==================== PING & SYS INFO ====================
 
+# Event-loop lag probe: how late a sleep of LAG_PROBE_INTERVAL wakes up
+LAG_PROBE_INTERVAL = 0.5
+loop_lag = deque(maxlen=120)
+# Round-trip times of Bot API calls, excluding long-polling getUpdates
+api_rtt = deque(maxlen=500)
+last_update = {"at": None, "count": 0}
+
+async def loop_lag_probe():
+    """Background task sampling event-loop scheduling lag"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LAG_PROBE_INTERVAL)
+        loop_lag.append(max(0.0, loop.time() - start - LAG_PROBE_INTERVAL))
+
+async def mark_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Record when the last update was processed"""
+    last_update["at"] = time.monotonic()
+    last_update["count"] += 1
+
+def percentile(samples, q):
+    """Nearest-rank percentile of a sample collection"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def collect_diagnostics(application: Application):
+    """Collect loop, API, backlog and persistence timings in one dict (seconds)"""
+    now = time.monotonic()
+    return {
+        "loop_lag_last": loop_lag[-1] if loop_lag else 0.0,
+        "loop_lag_p99": percentile(loop_lag, 0.99),
+        "api_rtt_median": percentile(api_rtt, 0.5),
+        "api_rtt_p99": percentile(api_rtt, 0.99),
+        "api_rtt_samples": len(api_rtt),
+        "update_backlog": application.update_queue.qsize(),
+        "http_pools": {
+            name: {"in_flight": p.in_flight, "size": p.pool_size, "timeouts": p.pool_timeouts}
+            for name, p in request_pools.items()
+        },
+        "since_last_update": now - last_update["at"] if last_update["at"] else None,
+        "catch_up_active": catch_up["active"],
+        "catch_up_stale_updates": catch_up["stale"],
+        "catch_up_duration": catch_up["duration"] if not catch_up["active"] else now - catch_up["started"],
+        "last_save_duration": last_save["duration"],
+        "max_save_duration": last_save["max_duration"],
+        "since_last_save": now - last_save["at"] if last_save["at"] else None,
+    }
+
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Check bot latency"""
-    start = datetime.now()
+    """Check bot latency with a loop/API/backlog/disk breakdown"""
+    start = time.perf_counter()
     msg = await update.message.reply_text("🏓 Pinging...")
-    end = datetime.now()
-    latency = (end - start).microseconds / 1000
+    latency = (time.perf_counter() - start) * 1000
     
-    await msg.edit_text(f"🏓 Pong!\n⚡ Latency: {latency:.2f}ms")
+    d = collect_diagnostics(context.application)
+    ms = lambda v: f"{v * 1000:.1f}ms" if v is not None else "n/a"
+    since = lambda v: f"{v:.1f}s ago" if v is not None else "never"
+    catch_up_line = ""
+    if d["catch_up_duration"] is not None:
+        state_text = "catching up" if d["catch_up_active"] else "last catch-up"
+        catch_up_line = f"⏪ Backlog: {state_text}, {d['catch_up_stale_updates']} stale updates in {d['catch_up_duration']:.1f}s\n"
+    pools = "".join(
+        f"🔌 {name} pool: {p['in_flight']}/{p['size']} busy, {p['timeouts']} pool timeouts\n"
+        for name, p in d["http_pools"].items()
+    )
+    
+    await msg.edit_text(
+        f"🏓 Pong!\n"
+        f"⚡ Latency: {latency:.2f}ms\n\n"
+        f"🔁 Event loop lag: {ms(d['loop_lag_last'])} (p99 {ms(d['loop_lag_p99'])})\n"
+        f"🌐 API RTT: median {ms(d['api_rtt_median'])}, p99 {ms(d['api_rtt_p99'])} ({d['api_rtt_samples']} calls)\n"
+        f"📥 Pending updates: {d['update_backlog']}\n"
+        f"{pools}"
+        f"🕐 Last update: {since(d['since_last_update'])}\n"
+        f"{catch_up_line}"
+        f"💾 Last save: {ms(d['last_save_duration'])} (max {ms(d['max_save_duration'])}), {since(d['since_last_save'])}"
+    )
 
 async def system_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show system information"""
+    """Show system information, summed over all shard workers"""
     import platform
     import sys
     
+    totals = await aggregate_shard_stats()
+    
     text = f"""
 💻 <b>System Information</b>
 
 <b>Python Version:</b> {sys.version.split()[0]}
 <b>Platform:</b> {platform.system()} {platform.release()}
 <b>Bot Version:</b> 2.0.0
-<b>Total Groups:</b> {len(settings)}
-<b>Total Filters:</b> {sum(len(f) for f in word_filters.values())}
-<b>Total Notes:</b> {sum(len(n) for n in notes.values())}
+<b>Workers:</b> {shard_count}
+<b>Total Groups:</b> {totals["groups"]}
+<b>Total Filters:</b> {totals["filters"]}
+<b>Total Notes:</b> {totals["notes"]}
+<b>Updates Processed:</b> {totals["updates"]}
+    """
+    
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+
+# ==================== METRICS ====================
+
+# Local Prometheus endpoint; set METRICS_PORT=0 to disable it
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Fixed-bucket latency histogram"""
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = LATENCY_BUCKETS[i - 1] if i else 0.0
+                high = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1]
+                return low + (high - low) * (rank - seen) / n
+            seen += n
+        return LATENCY_BUCKETS[-1]
+
+handler_latency = defaultdict(Histogram)
+handler_errors = defaultdict(Counter)
+api_latency = defaultdict(Histogram)
+api_errors = defaultdict(Counter)
+
+# Handlers slower than this are logged with their chat and latency
+SLOW_HANDLER_SECONDS = 1.0
+# Name of the handler currently running in this task, for error logs
+current_handler = contextvars.ContextVar("current_handler", default=None)
+
+def instrument_handler(callback):
+    """Wrap a handler callback to record its latency and errors"""
+    name = callback.__name__
+    latency = handler_latency[name]
+    errors = handler_errors[name]
+
+    @wraps(callback)
+    async def wrapper(update, context):
+        current_handler.set(name)
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            errors[type(e).__name__] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            latency.observe(elapsed)
+            if elapsed > SLOW_HANDLER_SECONDS:
+                logger.warning(
+                    "Slow handler %s took %.0fms", name, elapsed * 1000,
+                    extra={"chat_id": update_chat_id(update), "handler": name, "latency_ms": round(elapsed * 1000, 1)}
+                )
+
+    return wrapper
+
+def update_chat_id(update):
+    """Chat id of an update, if it has one"""
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat else None
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Log errors escaping handlers with structured context"""
+    logger.error(
+        "Unhandled error in handler %s: %s", current_handler.get(), context.error,
+        exc_info=context.error,
+        extra={"chat_id": update_chat_id(update), "handler": current_handler.get()}
+    )
+
+def instrument_handlers(application: Application):
+    """Instrument every handler registered on the application"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if not hasattr(handler.callback, "__wrapped__"):
+                handler.callback = instrument_handler(handler.callback)
+
+# Request backends by pool name, for pool metrics
+request_pools = {}
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest recording latency and errors per Bot API method.
+    
+    Pool limits are left to httpx; requests in flight and pool timeouts
+    are counted so pool utilization can be measured.
     """
+
+    def __init__(self, pool="api", connection_pool_size=32, pool_timeout=1.0, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, pool_timeout=pool_timeout, **kwargs)
+        self.pool = pool
+        self.pool_size = connection_pool_size
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.pool_timeouts = 0
+        request_pools[pool] = self
+
+    async def do_request(self, *args, **kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await super().do_request(*args, **kwargs)
+        except TimedOut as e:
+            if isinstance(e.__cause__, httpx.PoolTimeout):
+                self.pool_timeouts += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            api_errors[method][type(e).__name__] += 1
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            api_latency[method].observe(duration)
+            if method != "getUpdates":
+                api_rtt.append(duration)
+
+def render_histograms(lines, metric, label, histograms):
+    """Append Prometheus histogram samples for a labelled family"""
+    lines.append(f"# TYPE {metric} histogram")
+    for name, hist in sorted(histograms.items()):
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS, hist.counts):
+            cumulative += n
+            lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{{label}="{name}",le="+Inf"}} {hist.count}')
+        lines.append(f'{metric}_sum{{{label}="{name}"}} {hist.total:.6f}')
+        lines.append(f'{metric}_count{{{label}="{name}"}} {hist.count}')
+
+def render_errors(lines, metric, label, counters):
+    """Append Prometheus counter samples broken down by exception type"""
+    lines.append(f"# TYPE {metric} counter")
+    for name, counter in sorted(counters.items()):
+        for error, n in sorted(counter.items()):
+            lines.append(f'{metric}{{{label}="{name}",error="{error}"}} {n}')
+
+def render_metrics(application: Application):
+    """Render all metrics in Prometheus text format"""
+    lines = []
+    render_histograms(lines, "bot_handler_latency_seconds", "handler", handler_latency)
+    render_errors(lines, "bot_handler_errors_total", "handler", handler_errors)
+    render_histograms(lines, "bot_api_latency_seconds", "method", api_latency)
+    render_errors(lines, "bot_api_errors_total", "method", api_errors)
+    lines.append("# TYPE bot_update_queue_depth gauge")
+    lines.append(f"bot_update_queue_depth {application.update_queue.qsize()}")
+    lines.append("# TYPE bot_http_pool_size gauge")
+    for name, pool in sorted(request_pools.items()):
+        lines.append(f'bot_http_pool_size{{pool="{name}"}} {pool.pool_size}')
+        lines.append(f'bot_http_pool_in_flight{{pool="{name}"}} {pool.in_flight}')
+        lines.append(f'bot_http_pool_max_in_flight{{pool="{name}"}} {pool.max_in_flight}')
+        lines.append(f'bot_http_pool_timeouts_total{{pool="{name}"}} {pool.pool_timeouts}')
+    lines.append("# TYPE bot_event_loop_lag_seconds gauge")
+    lines.append(f"bot_event_loop_lag_seconds {loop_lag[-1] if loop_lag else 0.0:.6f}")
+    return "\n".join(lines) + "\n"
+
+async def serve_metrics(application: Application):
+    """Serve /metrics over a minimal local HTTP endpoint"""
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[1] == "/metrics":
+                status, content_type = "200 OK", "text/plain; version=0.0.4"
+                body = render_metrics(application).encode()
+            elif len(parts) >= 2 and parts[1] == "/diagnostics":
+                status, content_type = "200 OK", "application/json"
+                body = json.dumps(collect_diagnostics(application)).encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.error("Error serving metrics: %s", e)
+        finally:
+            writer.close()
+
+    # Shard workers listen on the ports following METRICS_PORT
+    port = METRICS_PORT if shard_index is None else METRICS_PORT + 1 + shard_index
+    return await asyncio.start_server(handle, METRICS_HOST, port)
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the slowest handlers and API methods"""
+    if not await is_admin(update, context):
+        return
+    
+    def top(histograms, errors):
+        rows = sorted(histograms.items(), key=lambda x: x[1].total, reverse=True)[:8]
+        return "".join(
+            f"{name[:22]:<22} {h.count:>7} {h.total / h.count * 1000:>7.1f} "
+            f"{h.quantile(0.95) * 1000:>7.1f} {sum(errors[name].values()):>4}\n"
+            for name, h in rows if h.count
+        )
     
+    header = f"{'name':<22} {'calls':>7} {'avg ms':>7} {'p95 ms':>7} {'err':>4}\n"
+    text = (
+        "📈 <b>Bot Metrics</b>\n\n"
+        f"<b>Update queue:</b> {context.application.update_queue.qsize()}\n\n"
+        f"<b>Handlers</b>\n<pre>{header}{html.escape(top(handler_latency, handler_errors))}</pre>\n"
+        f"<b>Bot API</b>\n<pre>{header}{html.escape(top(api_latency, api_errors))}</pre>"
+    )
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
+# ==================== PROFILING ====================
+
+# Telegram user ids allowed to run owner-only commands (comma separated)
+OWNER_IDS = {int(x) for x in os.getenv("OWNER_IDS", "").split(",") if x.strip()}
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 120
+
+# Only one profiling session runs at a time; None when profiling is off
+profile_session = None
+
+def is_owner(update: Update):
+    """Check if the user is a bot owner"""
+    return update.effective_user is not None and update.effective_user.id in OWNER_IDS
+
+def profile_path(label, extension):
+    """Build a timestamped output path inside PROFILE_DIR"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.join(PROFILE_DIR, f"{label}-{datetime.now():%Y%m%d-%H%M%S}.{extension}")
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def sample_stacks(thread_id, seconds, stop):
+    """Sample a thread's stack until seconds pass or stop is set; returns folded stack counts"""
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline and not stop.is_set():
+        frame = sys._current_frames().get(thread_id)
+        labels = []
+        while frame is not None:
+            labels.append(frame_label(frame))
+            frame = frame.f_back
+        if labels:
+            stacks[";".join(reversed(labels))] += 1
+        time.sleep(PROFILE_SAMPLE_INTERVAL)
+    return stacks
+
+def summarize_stacks(stacks, limit=10):
+    """Top functions by self samples from folded stacks"""
+    leaves = Counter()
+    for stack, n in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += n
+    total = sum(stacks.values()) or 1
+    return [(name, n, n * 100 / total) for name, n in leaves.most_common(limit)]
+
+async def profile_loop(bot, chat_id, seconds):
+    """Sample the event loop thread for a number of seconds and report the hottest functions"""
+    global profile_session
+    stop = threading.Event()
+    profile_session = {"kind": "loop", "stop": stop.set}
+    try:
+        stacks = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds, stop)
+    finally:
+        profile_session = None
+    
+    path = profile_path("loop", "folded")
+    with open(path, "w") as f:
+        for stack, n in stacks.most_common():
+            f.write(f"{stack} {n}\n")
+    
+    rows = "".join(f"{pct:5.1f}% {html.escape(name)}\n" for name, _, pct in summarize_stacks(stacks))
+    await bot.send_message(
+        chat_id,
+        f"🔬 <b>Loop profile</b> ({sum(stacks.values())} samples)\n<pre>{rows}</pre>\nSaved to <code>{path}</code>",
+        parse_mode=ParseMode.HTML
+    )
+
+@types.coroutine
+def profile_steps(coro, profiler):
+    """Await coro with the profiler enabled only while its own code runs.
+
+    The profiler is off whenever the coroutine is suspended, so other tasks
+    (and other calls of the same handler) never land in its profile.
+    """
+    value, error = None, None
+    while True:
+        profiler.enable()
+        try:
+            yielded = coro.throw(error) if error is not None else coro.send(value)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            profiler.disable()
+        try:
+            value, error = (yield yielded), None
+        except BaseException as e:
+            value, error = None, e
+
+def start_handler_profile(application: Application, name, calls, chat_id):
+    """Swap a handler's callback for a cProfile wrapper for its next calls; returns False if not found"""
+    global profile_session
+    targets = [
+        handler for handlers in application.handlers.values() for handler in handlers
+        if getattr(handler.callback, "__name__", None) == name
+    ]
+    if not targets:
+        return False
+    
+    profiler = cProfile.Profile()
+    originals = {handler: handler.callback for handler in targets}
+    remaining = [calls]
+    
+    def finish():
+        global profile_session
+        if profile_session is None or profile_session.get("profiler") is not profiler:
+            return
+        profile_session = None
+        for handler, callback in originals.items():
+            handler.callback = callback
+        application.create_task(report_handler_profile(application.bot, chat_id, name, profiler))
+    
+    def wrap(callback):
+        @wraps(callback)
+        async def profiled(update, context):
+            try:
+                return await profile_steps(callback(update, context), profiler)
+            finally:
+                remaining[0] -= 1
+                if remaining[0] <= 0:
+                    finish()
+        return profiled
+    
+    for handler, callback in originals.items():
+        handler.callback = wrap(callback)
+    profile_session = {"kind": "handler", "profiler": profiler, "stop": finish}
+    return True
+
+async def report_handler_profile(bot, chat_id, name, profiler):
+    """Dump a handler profile to disk and send the top functions"""
+    path = profile_path(name, "pstats")
+    profiler.dump_stats(path)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).strip_dirs().sort_stats("cumulative").print_stats(12)
+    summary = out.getvalue().split("\n\n", 1)[-1][:3500]
+    await bot.send_message(
+        chat_id,
+        f"🔬 <b>Profile of {html.escape(name)}</b>\n<pre>{html.escape(summary)}</pre>\nSaved to <code>{path}</code>",
+        parse_mode=ParseMode.HTML
+    )
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Owner-only runtime profiler control"""
+    if not is_owner(update):
+        return
+    
+    usage = "❌ Usage: /profile loop <seconds> | /profile handler <name> [calls] | /profile stop"
+    args = context.args
+    if not args:
+        await update.message.reply_text(usage)
+        return
+    
+    if args[0] == "stop":
+        if profile_session:
+            profile_session["stop"]()
+            await update.message.reply_text("⏹️ Profiling stopped")
+        else:
+            await update.message.reply_text("❌ No profiling in progress")
+        return
+    
+    if profile_session:
+        await update.message.reply_text("❌ A profiling session is already running")
+        return
+    
+    try:
+        if args[0] == "loop" and len(args) >= 2:
+            seconds = min(float(args[1]), MAX_PROFILE_SECONDS)
+            context.application.create_task(profile_loop(context.bot, update.effective_chat.id, seconds))
+            await update.message.reply_text(f"🔬 Sampling the event loop for {seconds:g}s...")
+        elif args[0] == "handler" and len(args) >= 2:
+            calls = int(args[2]) if len(args) >= 3 else 100
+            if start_handler_profile(context.application, args[1], calls, update.effective_chat.id):
+                await update.message.reply_text(f"🔬 Profiling the next {calls} calls of {args[1]}...")
+            else:
+                await update.message.reply_text(f"❌ No handler named {args[1]}")
+        else:
+            await update.message.reply_text(usage)
+    except ValueError:
+        await update.message.reply_text(usage)
+
+# ==================== SHARDING ====================
+
+# Counters each worker publishes into the shared stats array for /sys
+SHARD_STATS = ("groups", "filters", "notes", "updates")
+# How often workers publish; /sys refreshes its own worker's slot
+SHARD_STATS_INTERVAL = 30
+# Shared multiprocessing.Array of len(SHARD_STATS) slots per worker (None when unsharded)
+shard_stats = None
+# Dispatcher side: one IPC queue per worker
+shard_inboxes = []
+
+async def count_owned_docs():
+    """Seed the document totals from the backend; runs once at start-up"""
+    for kind in COUNTED_DOCS:
+        keys = await state.keys(f"{kind}:")
+        if shard_index is not None:
+            keys = [k for k in keys if shard_for(k.split(":", 1)[1], shard_count) == shard_index]
+        for key, raw in zip(keys, await state.get_many(keys)):
+            if raw:
+                count_doc(kind, key.split(":", 1)[1], json.loads(raw))
+
+async def local_shard_stats():
+    """This process' contribution to the /sys totals"""
+    return (
+        doc_totals["settings"],
+        doc_totals["filters"],
+        doc_totals["notes"],
+        last_update["count"],
+    )
+
+async def publish_shard_stats():
+    """Write this worker's counters into its slots of the shared array"""
+    if shard_stats is None:
+        return
+    values = await local_shard_stats()
+    width = len(SHARD_STATS)
+    with shard_stats.get_lock():
+        shard_stats[shard_index * width:(shard_index + 1) * width] = values
+
+async def aggregate_shard_stats():
+    """Sum the counters of every worker; local values when unsharded"""
+    if shard_stats is None:
+        return dict(zip(SHARD_STATS, await local_shard_stats()))
+    await publish_shard_stats()
+    width = len(SHARD_STATS)
+    with shard_stats.get_lock():
+        values = shard_stats[:]
+    return {name: sum(values[i::width]) for i, name in enumerate(SHARD_STATS)}
+
+async def shard_stats_publisher():
+    """Background task keeping this worker's shared counters fresh"""
+    while True:
+        await asyncio.sleep(SHARD_STATS_INTERVAL)
+        try:
+            await publish_shard_stats()
+        except Exception as e:
+            logger.error("Error publishing shard stats: %s", e)
+
+def update_shard_key(update):
+    """Chat id an update is routed by; the user id for chat-less updates"""
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return 0
+
+async def forward_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Dispatcher handler: hand the update to the worker owning its chat"""
+    inbox = shard_inboxes[shard_for(update_shard_key(update), len(shard_inboxes))]
+    inbox.put(update.to_dict())
+
+async def consume_shard_inbox(application: Application, inbox):
+    """Feed updates from the dispatcher into the application until it sends None"""
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await loop.run_in_executor(None, inbox.get)
+        if data is None:
+            return
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+async def run_shard(application: Application, inbox):
+    """Run a worker's application on the updates of its inbox"""
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    try:
+        await consume_shard_inbox(application, inbox)
+    finally:
+        await application.stop()
+        await post_stop(application)
+        await application.shutdown()
+
+def shard_worker(index, count, inbox, stats):
+    """Entry point of a worker process owning the chats of one shard"""
+    global shard_index, shard_count, shard_stats
+    # Ctrl+C reaches the whole process group; workers stop when the dispatcher says so
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shard_index, shard_count, shard_stats = index, count, stats
+    asyncio.run(run_shard(build_application(polling=False), inbox))
+
+async def stop_shards(application: Application):
+    """Dispatcher post_stop: let workers drain their inboxes and exit"""
+    for inbox in shard_inboxes:
+        inbox.put(None)
+
+def build_dispatcher(token=BOT_TOKEN):
+    """Application that receives updates and forwards each to its shard worker"""
+    application = application_builder(token).post_stop(stop_shards).build()
+    application.add_handler(TypeHandler(Update, forward_update))
+    return application
+
+def run_sharded(count):
+    """Run the dispatcher in this process and count shard worker processes"""
+    global shard_count, shard_stats
+    # Legacy JSON files are imported once here, before workers open the backend
+    asyncio.run(prepare_state())
+    
+    context = multiprocessing.get_context("spawn")
+    shard_count = count
+    shard_stats = context.Array("q", count * len(SHARD_STATS))
+    shard_inboxes[:] = [context.Queue() for _ in range(count)]
+    workers = [
+        context.Process(target=shard_worker, args=(i, count, shard_inboxes[i], shard_stats), name=f"shard-{i}")
+        for i in range(count)
+    ]
+    for worker in workers:
+        worker.start()
+    
+    try:
+        run_application(build_dispatcher())
+    finally:
+        for worker in workers:
+            worker.join(timeout=30)
+            if worker.is_alive():
+                logger.error("Shard worker %s did not stop, terminating", worker.name)
+                worker.terminate()
+
 # ==================== MAIN FUNCTION ====================
 
-def main():
-    """Start the bot"""
-    load_data()
+async def prepare_state():
+    """Open and close the backend once, running the legacy JSON migration"""
+    await init_state()
+    await close_state()
+
+async def post_init(application: Application):
+    """Connect the state backend and start background tasks once the bot is initialized"""
+    await init_state()
+    await count_owned_docs()
+    await load_federations()
+    await open_audit_log()
+    await load_warn_index()
+    background_tasks.append(asyncio.create_task(notice_sweeper(application.bot)))
+    background_tasks.append(asyncio.create_task(federation_syncer()))
+    background_tasks.append(asyncio.create_task(activity_flusher()))
+    background_tasks.append(asyncio.create_task(audit_writer()))
+    background_tasks.append(asyncio.create_task(warn_expirer()))
+    background_tasks.append(asyncio.create_task(loop_lag_probe()))
+    if METRICS_PORT:
+        try:
+            server = await serve_metrics(application)
+            background_tasks.append(asyncio.create_task(server.serve_forever()))
+        except OSError as e:
+            logger.error("Metrics endpoint disabled: %s", e)
+    if shard_stats is not None:
+        background_tasks.append(asyncio.create_task(shard_stats_publisher()))
+
+async def post_stop(application: Application):
+    """Cancel background tasks"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if hash_pool is not None:
+        hash_pool.shutdown(wait=False, cancel_futures=True)
+    await flush_all_activity()
+    await close_audit_log()
+    await close_state()
+
+def application_builder(token=BOT_TOKEN, request=None, get_updates_request=None):
+    """ApplicationBuilder with the bot's HTTP backends and API server configured"""
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(request or InstrumentedRequest(
+            pool="api",
+            connection_pool_size=HTTP_POOL_SIZE,
+            http_version=HTTP_VERSION,
+            connect_timeout=HTTP_CONNECT_TIMEOUT,
+            read_timeout=HTTP_READ_TIMEOUT,
+            write_timeout=HTTP_WRITE_TIMEOUT,
+            pool_timeout=HTTP_POOL_TIMEOUT
+        ))
+        .get_updates_request(get_updates_request or InstrumentedRequest(
+            pool="get_updates",
+            connection_pool_size=1,
+            connect_timeout=HTTP_CONNECT_TIMEOUT,
+            read_timeout=HTTP_READ_TIMEOUT,
+            pool_timeout=HTTP_POOL_TIMEOUT
+        ))
+    )
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(f"{BOT_API_BASE_URL}/bot").base_file_url(f"{BOT_API_BASE_URL}/file/bot")
+    return builder
+
+def build_application(token=BOT_TOKEN, request=None, get_updates_request=None, polling=True):
+    """Build the Application with every handler registered.
+    
+    request/get_updates_request replace the HTTP backends, e.g. with a fake
+    Bot API for benchmarks. polling=False builds it without an Updater, for
+    shard workers fed by the dispatcher.
+    """
+    builder = (
+        application_builder(token, request, get_updates_request)
+        .concurrent_updates(CONCURRENT_UPDATES if CONCURRENT_UPDATES > 1 else False)
+        .post_init(post_init)
+        .post_stop(post_stop)
+    )
+    if not polling:
+        builder = builder.updater(None)
+    application = builder.build()
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Run first for every update: drop duplicates and flag backlog, fetch the chat's
+    # state, then track processing recency
+    application.add_handler(TypeHandler(Update, classify_update), group=-3)
+    application.add_handler(TypeHandler(Update, load_chat_state), group=-2)
+    application.add_handler(TypeHandler(Update, mark_update), group=-1)
     
     # Command handlers
     application.add_handler(CommandHandler("start", start))
@@ -1381,10 +5594,13 @@ def main():
     application.add_handler(CommandHandler("unmute", unmute))
     application.add_handler(CommandHandler("warn", warn))
     application.add_handler(CommandHandler("rmwarn", remove_warn))
+    application.add_handler(CommandHandler("warns", list_warnings))
+    application.add_handler(CommandHandler("warnpolicy", set_warn_policy))
     application.add_handler(CommandHandler("pin", pin))
     application.add_handler(CommandHandler("unpin", unpin))
     application.add_handler(CommandHandler("purge", purge))
     application.add_handler(CommandHandler("del", del_message))
+    application.add_handler(CommandHandler("modlog", modlog))
     application.add_handler(CommandHandler("promote", promote))
     application.add_handler(CommandHandler("demote", demote))
     application.add_handler(CommandHandler("settitle", set_title))
@@ -1395,15 +5611,20 @@ def main():
     application.add_handler(CommandHandler("addfilter", add_filter))
     application.add_handler(CommandHandler("rmfilter", remove_filter))
     application.add_handler(CommandHandler("filters", list_filters))
+    application.add_handler(CommandHandler("linkfilter", link_filter))
+    application.add_handler(CommandHandler("mediafilter", media_filter))
     
     # Welcome & notes
     application.add_handler(CommandHandler("setwelcome", set_welcome))
     application.add_handler(CommandHandler("save", save_note))
     application.add_handler(CommandHandler("get", get_note))
     application.add_handler(CommandHandler("notes", list_notes))
+    application.add_handler(CommandHandler("clear", clear_note))
     
     # Settings
     application.add_handler(CommandHandler("settings", settings_menu))
+    application.add_handler(CommandHandler("export", export_chat))
+    application.add_handler(CommandHandler("import", import_chat))
     
     # Info commands
     application.add_handler(CommandHandler("info", info))
@@ -1421,6 +5642,7 @@ def main():
     
     # Tag commands
     application.add_handler(CommandHandler("tagall", tag_all))
+    application.add_handler(CommandHandler("canceltag", cancel_tag))
     application.add_handler(CommandHandler("tagadmins", tag_admins))
     
     # Rules & report
@@ -1435,31 +5657,91 @@ def main():
     application.add_handler(CommandHandler("blacklist", blacklist_user))
     application.add_handler(CommandHandler("unblacklist", unblacklist_user))
     
+    # Federation commands
+    application.add_handler(CommandHandler("newfed", new_fed))
+    application.add_handler(CommandHandler("joinfed", join_fed))
+    application.add_handler(CommandHandler("leavefed", leave_fed))
+    application.add_handler(CommandHandler("fedinfo", fed_info))
+    application.add_handler(CommandHandler("fedadmin", fed_admin))
+    application.add_handler(CommandHandler("fban", fed_ban))
+    application.add_handler(CommandHandler("unfban", fed_unban))
+    
     # Stats
     application.add_handler(CommandHandler("stats", group_stats))
     
     # Utility
     application.add_handler(CommandHandler("ping", ping))
     application.add_handler(CommandHandler("sys", system_info))
+    application.add_handler(CommandHandler("metrics", metrics_command))
+    application.add_handler(CommandHandler("profile", profile_command))
     
-    # Message handlers
+    # Message handlers (one group each, so every matching check runs)
     application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_user))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, check_filters))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, check_blacklist))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, check_flood))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, track_activity))
-    application.add_handler(MessageHandler(filters.ALL, anti_channel_protection))
-    application.add_handler(MessageHandler(filters.FORWARDED, anti_id_exposure))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, check_blacklist), group=1)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, check_flood), group=2)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, track_activity), group=3)
+    application.add_handler(MessageHandler(filters.ALL, anti_channel_protection), group=4)
+    application.add_handler(MessageHandler(filters.FORWARDED, anti_id_exposure), group=5)
+    application.add_handler(MessageHandler(filters.Entity(MessageEntity.HASHTAG) & ~filters.COMMAND, hashtag_note), group=6)
+    application.add_handler(MessageHandler(
+        (filters.Entity(MessageEntity.URL) | filters.Entity(MessageEntity.TEXT_LINK) | filters.Entity(MessageEntity.MENTION)
+         | filters.CaptionEntity(MessageEntity.URL) | filters.CaptionEntity(MessageEntity.TEXT_LINK)
+         | filters.CaptionEntity(MessageEntity.MENTION)) & ~filters.COMMAND,
+        check_links
+    ), group=7)
+    application.add_handler(MessageHandler(
+        filters.Sticker.ALL | filters.ANIMATION | filters.VOICE | filters.VIDEO_NOTE | filters.VIDEO
+        | filters.AUDIO | filters.PHOTO | filters.Document.ALL,
+        check_media
+    ), group=8)
+    application.add_handler(MessageHandler((filters.TEXT | filters.CAPTION) & ~filters.COMMAND, check_spam_wave), group=9)
+    application.add_handler(MessageHandler(filters.ALL, check_fed_ban), group=10)
+    application.add_handler(MessageHandler(filters.ALL, track_members), group=11)
     
     # Callback handlers
     application.add_handler(CallbackQueryHandler(button_handler))
     
+    instrument_handlers(application)
+    application.add_error_handler(error_handler)
+    return application
+
+def run_application(application: Application):
+    """Receive updates by webhook when WEBHOOK_URL is set, otherwise by polling"""
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=urlsplit(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES, timeout=POLL_TIMEOUT)
+
+def main():
+    """Start the bot"""
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+        return
+    
+    if SHARD_WORKERS > 1:
+        if urlsplit(STATE_URL).scheme == "memory":
+            # Each worker would get its own empty MemoryBackend
+            sys.exit("❌ SHARD_WORKERS needs a shared STATE_URL (sqlite:// or redis://), not memory://")
+        print(f"🤖 Bot started with {SHARD_WORKERS} shard workers!")
+        run_sharded(SHARD_WORKERS)
+        return
+    
+    application = build_application()
+    
     # Start bot
     print("🤖 Bot started successfully!")
     print("✅ All features loaded")
     print("🚀 Ready to manage groups!")
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    run_application(application)
 
 if __name__ == "__main__":
     main()